@@ -0,0 +1,221 @@
+#
+# Benchmark suite for the controller's hot paths
+# - feeds SDK-shaped gaze objects (simulator.GazeData) straight into
+#   on_gazedata for sessions at several sampling rates and lengths
+# - reports the callback cost per sample, the memory held by gazeData,
+#   the time flushData takes (csv and binary) and the cost per call of the
+#   current-sample getters and acsd2pix
+# - runs headless: the controller uses the simulated backend and no
+#   window, and psychopy is not needed (none of these paths draw)
+# - timings are averaged over batches of calls, so they are not
+#   quantised by the timer's resolution; the median and best batch are
+#   reported
+# - results can be saved as JSON and compared against an earlier run. a
+#   metric only counts as a regression if it got worse by more than the
+#   tolerance and by more than an absolute floor
+#
+# usage:
+#   python benchmarks/bench_controller.py [--rates 60,300,600,1200]
+#       [--durations 60,600,7200] [--save results.json]
+#       [--compare baseline.json] [--tolerance 0.1] [--floor-us 0.5]
+#       [--floor-s 0.05]
+#
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import sys
+import tempfile
+import timeit
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, 'tobii-psychopy'))
+
+import tobiicontroller  # noqa: E402
+from bench_csv import synthetic_samples  # noqa: E402
+from simulator import GazeData, SimulatedBackend  # noqa: E402
+from tobiicontroller import TobiiController  # noqa: E402
+
+try:
+    import psychopy  # noqa: F401
+except ImportError:
+    # nothing benchmarked here draws, so run without psychopy
+    tobiicontroller.import_psychopy = lambda: None
+
+timer = timeit.default_timer
+
+GETTERS = ['getCurrentGazePosition', 'getCurrentGazeAverage',
+           'getCurrentEyePosition', 'getCurrentPupilSize',
+           'getCurrentValidity']
+
+
+class Window(object):
+    # the parts of a psychopy window the benchmarked paths use
+    size = (1920, 1080)
+    monitor = None
+
+
+def batch_timings(method, args, number=1000, repeat=100):
+    # times repeat batches of number calls; returns the median and best
+    # cost per call (us)
+    times = []
+    for i in range(repeat):
+        t0 = timer()
+        for j in range(number):
+            method(*args)
+        times.append((timer() - t0) / number * 1e6)
+    return {'median_us': float(np.median(times)),
+            'best_us': float(min(times))}
+
+
+def bench_session(rate, duration, poolSize=10000, chunkSize=1000):
+    n = int(rate * duration)
+    controller = TobiiController(Window(), backend=SimulatedBackend())
+    records = synthetic_samples(min(n, poolSize), rate=rate)
+    pool = [GazeData(r) for r in records.tolist()]
+    period = 1e6 / rate
+
+    # on_gazedata: the pool is reused, with timestamps moved on between
+    # chunks (outside the timed part). each chunk of chunkSize samples is
+    # timed on its own, and the median cost per sample is reported
+    costs = []
+    done = 0
+    callback = controller.on_gazedata
+    while done < n:
+        chunk = pool[:min(len(pool), n - done)]
+        for i, gaze in enumerate(chunk):
+            gaze.Timestamp = int((done + i) * period)
+        for start in range(0, len(chunk), chunkSize):
+            part = chunk[start:start + chunkSize]
+            t0 = timer()
+            for gaze in part:
+                callback(0, gaze)
+            costs.append((timer() - t0) / len(part) * 1e6)
+        done += len(chunk)
+    result = {'samples': n,
+              'callback_us': float(np.median(costs)),
+              'buffer_bytes': controller.gazeData.nbytes,
+              'buffer_bytes_per_sample':
+                  controller.gazeData.nbytes / float(n)}
+
+    # the current-sample getters
+    for name in GETTERS + ['acsd2pix']:
+        if name == 'acsd2pix':
+            method = controller.acsd2pix
+            args = ((0.25, 0.75),)
+        else:
+            method = getattr(controller, name)
+            args = ()
+        result[name] = batch_timings(method, args)
+
+    # flushData, once per output format
+    directory = tempfile.mkdtemp()
+    for dataFormat in ('csv', 'binary'):
+        filename = os.path.join(directory, 'session.' + dataFormat)
+        stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+        try:
+            controller.setDataFile(filename, dataFormat=dataFormat)
+            t0 = timer()
+            controller.flushData()
+            result['flush_%s_s' % dataFormat] = timer() - t0
+            controller.closeDataFile()
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+        result['file_%s_bytes' % dataFormat] = os.path.getsize(filename)
+        os.remove(filename)
+    os.rmdir(directory)
+    controller.destroy()
+    return result
+
+
+def flatten(results, prefix=''):
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, prefix + key + '.'))
+        else:
+            flat[prefix + key] = value
+    return flat
+
+
+def compare(old, new, tolerance, floorUs=0.5, floorS=0.05):
+    # prints every metric of both runs; all metrics are lower-is-better.
+    # returns the metrics that got worse by more than tolerance and, for
+    # timings, by more than floorUs (us metrics) or floorS (s metrics).
+    # the best batches only show what is possible and are not counted
+    floors = {'_us': floorUs, '_s': floorS}
+    old, new = flatten(old['results']), flatten(new['results'])
+    regressions = []
+    print('%-58s %12s %12s %8s' % ('metric', 'baseline', 'current', 'change'))
+    for key in sorted(set(old) & set(new)):
+        if key.endswith('.samples') or not old[key]:
+            continue
+        change = (new[key] - old[key]) / float(old[key])
+        floor = [f for unit, f in floors.items() if key.endswith(unit)]
+        flag = ''
+        if (change > tolerance and not key.endswith('best_us') and
+                new[key] - old[key] > (floor[0] if floor else 0)):
+            flag = '  REGRESSION'
+            regressions.append(key)
+        print('%-58s %12.4g %12.4g %+7.1f%%%s' % (key, old[key], new[key],
+                                                 change * 100, flag))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmarks the hot paths of TobiiController.')
+    parser.add_argument('--rates', default='60,300,600,1200',
+                        help='sampling rates in Hz, comma separated')
+    parser.add_argument('--durations', default='60,600,7200',
+                        help='session lengths in s, comma separated')
+    parser.add_argument('--save', help='write the results to this file')
+    parser.add_argument('--compare', help='compare against earlier results')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='relative slow-down reported as regression')
+    parser.add_argument('--floor-us', type=float, default=0.5,
+                        help='smallest slow-down (us) of a per-call or '
+                             'per-sample cost reported as regression')
+    parser.add_argument('--floor-s', type=float, default=0.05,
+                        help='smallest slow-down (s) of a flush reported '
+                             'as regression')
+    args = parser.parse_args()
+
+    results = {}
+    for rate in [int(r) for r in args.rates.split(',')]:
+        for duration in [int(d) for d in args.durations.split(',')]:
+            key = '%dHz_%ds' % (rate, duration)
+            result = bench_session(rate, duration)
+            results[key] = result
+            print('%-14s callback %6.2f us/sample  buffer %6.1f B/sample  '
+                  'flush csv %7.2f s  binary %6.3f s  '
+                  'getCurrentGazePosition %5.2f us' %
+                  (key, result['callback_us'],
+                   result['buffer_bytes_per_sample'], result['flush_csv_s'],
+                   result['flush_binary_s'],
+                   result['getCurrentGazePosition']['median_us']))
+            sys.stdout.flush()
+
+    run = {'meta': {'date': datetime.datetime.now().isoformat(),
+                    'python': platform.python_version(),
+                    'numpy': np.__version__,
+                    'platform': platform.platform()},
+           'results': results}
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(run, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(baseline, run, args.tolerance, args.floor_us,
+                   args.floor_s):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+#
+# Benchmark of the csv export used by flushData
+# - compares the old per-sample formatting loop with the batched CsvWriter
+#   on a synthetic session
+#
+# usage: python benchmarks/bench_csv.py [number of samples]
+#
+
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, 'tobii-psychopy'))
+
+from gazebuffer import SAMPLE_DTYPE  # noqa: E402
+from datawriter import CsvWriter  # noqa: E402
+
+
+def synthetic_samples(n, rate=300.0, seed=0):
+    # a session of n samples at rate Hz with plausible values
+    rng = np.random.RandomState(seed)
+    samples = np.zeros(n, dtype=SAMPLE_DTYPE)
+    samples['timestamp'] = (np.arange(n) * 1e6 / rate).astype(np.int64)
+    for eye, x in (('left', -30.0), ('right', 30.0)):
+        samples[eye + '_gaze'] = rng.uniform(0, 1, (n, 2))
+        samples[eye + '_pupil'] = rng.normal(3.0, 0.2, n)
+        samples[eye + '_eye'] = (rng.normal(0, 2, (n, 3)) +
+                                 np.array([x, 0.0, 600.0]))
+        samples[eye + '_validity'] = rng.choice([0, 4], n, p=[0.95, 0.05])
+    return samples
+
+
+def write_per_sample(datafile, samples):
+    # the formatting loop flushData used before the batched writer
+    timeStampStart = samples[0]['timestamp']
+    for g in samples:
+        datafile.write(', '.join([
+            '%.4f' % ((g['timestamp'] - timeStampStart) / 1000.0),
+            '%.4f' % g['left_gaze'][0],
+            '%.4f' % g['left_gaze'][1],
+            '%.4f' % g['left_pupil'],
+            '%.4f' % g['left_eye'][0],
+            '%.4f' % g['left_eye'][1],
+            '%.4f' % g['left_eye'][2],
+            '%d' % g['left_validity'],
+            '%.4f' % g['right_gaze'][0],
+            '%.4f' % g['right_gaze'][1],
+            '%.4f' % g['right_pupil'],
+            '%.4f' % g['right_eye'][0],
+            '%.4f' % g['right_eye'][1],
+            '%.4f' % g['right_eye'][2],
+            '%d' % g['right_validity']
+        ]) + '\n')
+
+
+def main(n):
+    samples = synthetic_samples(n)
+    directory = tempfile.mkdtemp()
+    before = os.path.join(directory, 'before.csv')
+    after = os.path.join(directory, 'after.csv')
+
+    t0 = time.time()
+    with open(before, 'w') as datafile:
+        write_per_sample(datafile, samples)
+    tBefore = time.time() - t0
+
+    writer = CsvWriter(after, (1920, 1080))
+    t0 = time.time()
+    writer.beginBlock()
+    writer.writeSamples(samples)
+    writer.flush()
+    tAfter = time.time() - t0
+    writer.close()
+
+    # the batched writer must produce the same rows
+    with open(before) as f:
+        rowsBefore = f.read()
+    with open(after) as f:
+        rowsAfter = f.read().split('\n', 5)[5]
+    assert rowsBefore == rowsAfter, "csv output differs"
+
+    print('%d samples' % n)
+    print('per-sample loop: %8.2f s  %10.0f samples/s' % (tBefore,
+                                                         n / tBefore))
+    print('batched writer:  %8.2f s  %10.0f samples/s' % (tAfter,
+                                                         n / tAfter))
+    print('speedup:         %8.1fx' % (tBefore / tAfter))
+    os.remove(before)
+    os.remove(after)
+    os.rmdir(directory)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000000)
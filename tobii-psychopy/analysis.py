@@ -0,0 +1,28 @@
+#
+# Headless analysis entry point for the Tobii controller
+# - everything needed to work with saved recordings: loading, coordinate
+#   transforms, event detection, filtering, AOIs, heatmaps and quality
+#   metrics
+# - imports numpy only: no psychopy, no display and no Tobii SDK, so it
+#   can be used on machines without either
+#
+# usage:
+#   from analysis import Recording, ScreenTransform, detect_events
+#   recording = Recording('session.bin')
+#   transform = ScreenTransform(recording.header['resolution'], 51, 60)
+#   deg = transform.convertSamples(recording.samples, 'deg')
+#
+
+from gazebuffer import (SAMPLE_DTYPE, GazeBuffer, average_gaze,
+                        eye_distance, epoch_times)
+from recording import Recording, export_csv
+from datawriter import CsvWriter, sample_columns
+from transforms import ScreenTransform
+from eventdetection import GazeEvent, IVTDetector, IDTDetector, detect_events
+from filters import (MovingAverage, Median, OneEuro, Kalman, GazeFilter,
+                     filter_samples)
+from aoi import AOIRegistry, RectAOI, CircleAOI, PolygonAOI
+from calibrationquality import (Quality, gaze_quality, binocular_quality,
+                                calibration_quality, failing_points)
+from instrumentation import Histogram, Instrumentation
+from heatmap import Heatmap, gaussian_smooth
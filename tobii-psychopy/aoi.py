@@ -0,0 +1,186 @@
+#
+# Areas of interest for gaze-contingent displays
+# - AOIs are given in pixels relative to the screen centre, i.e. the space
+#   acsd2pix returns
+# - a uniform grid maps each cell to the AOIs overlapping it, so a lookup
+#   only tests the few AOIs near the gaze position
+#
+
+import math
+
+import numpy as np
+
+
+class RectAOI(object):
+
+    def __init__(self, name, pos, size):
+        self.name = name
+        self.pos = pos
+        self.size = size
+        self.bounds = (pos[0] - size[0] / 2.0, pos[1] - size[1] / 2.0,
+                       pos[0] + size[0] / 2.0, pos[1] + size[1] / 2.0)
+
+    def contains(self, x, y):
+        # x and y are floats or arrays
+        left, bottom, right, top = self.bounds
+        return (x >= left) & (x <= right) & (y >= bottom) & (y <= top)
+
+
+class CircleAOI(object):
+
+    def __init__(self, name, pos, radius):
+        self.name = name
+        self.pos = pos
+        self.radius = radius
+        self.bounds = (pos[0] - radius, pos[1] - radius,
+                       pos[0] + radius, pos[1] + radius)
+
+    def contains(self, x, y):
+        return ((x - self.pos[0]) ** 2 +
+                (y - self.pos[1]) ** 2) <= self.radius ** 2
+
+
+class PolygonAOI(object):
+
+    def __init__(self, name, vertices):
+        self.name = name
+        self.vertices = np.asarray(vertices, dtype=float)
+        self.bounds = tuple(self.vertices.min(axis=0)) + \
+            tuple(self.vertices.max(axis=0))
+
+    def contains(self, x, y):
+        # even-odd rule, vectorised over the points
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        inside = np.zeros(x.shape, dtype=bool)
+        x1, y1 = self.vertices[-1]
+        for x2, y2 in self.vertices:
+            crosses = (y1 > y) != (y2 > y)
+            if y1 != y2:
+                xCross = x1 + (y - y1) * (x2 - x1) / (y2 - y1)
+                inside ^= crosses & (x < xCross)
+            x1, y1 = x2, y2
+        return inside
+
+
+class AOIRegistry(object):
+    # Holds the AOIs of a display. Where AOIs overlap, the one added last
+    # wins (as if they were drawn in order). Dwell times are accumulated
+    # from the samples passed to addSample; the time between two samples
+    # counts for at most maxGap ms, so lost samples don't count as dwell.
+
+    def __init__(self, screenSize, cellSize=64, maxGap=100.0):
+        self.screenSize = screenSize
+        self.cellSize = float(cellSize)
+        self.maxGap = maxGap
+        self.clear()
+
+    def clear(self):
+        self.aois = []
+        self.names = []
+        self._grid = {}
+        self.resetDwell()
+
+    def resetDwell(self):
+        self.dwellTimes = dict((name, 0.0) for name in self.names)
+        self.newBlock()
+
+    def newBlock(self):
+        # forgets the previous sample, so the pause between two tracking
+        # blocks isn't added to the dwell time of the AOI gaze was last in
+        self.currentAOI = None
+        self._lastTime = None
+
+    def __len__(self):
+        return len(self.aois)
+
+    def _cells(self, bounds):
+        left, bottom, right, top = bounds
+        for cx in range(int(math.floor(left / self.cellSize)),
+                        int(math.floor(right / self.cellSize)) + 1):
+            for cy in range(int(math.floor(bottom / self.cellSize)),
+                            int(math.floor(top / self.cellSize)) + 1):
+                yield cx, cy
+
+    def add(self, aoi):
+        if aoi.name in self.names:
+            raise ValueError("There already is an AOI called %r." %
+                             (aoi.name,))
+        index = len(self.aois)
+        self.aois.append(aoi)
+        self.names.append(aoi.name)
+        self.dwellTimes[aoi.name] = 0.0
+        for cell in self._cells(aoi.bounds):
+            self._grid.setdefault(cell, []).append(index)
+        return aoi
+
+    def addRect(self, name, pos, size):
+        return self.add(RectAOI(name, pos, size))
+
+    def addCircle(self, name, pos, radius):
+        return self.add(CircleAOI(name, pos, radius))
+
+    def addPolygon(self, name, vertices):
+        return self.add(PolygonAOI(name, vertices))
+
+    def remove(self, name):
+        aois = [aoi for aoi in self.aois if aoi.name != name]
+        dwellTimes = self.dwellTimes
+        self.clear()
+        for aoi in aois:
+            self.add(aoi)
+        self.dwellTimes.update((n, t) for n, t in dwellTimes.items()
+                               if n in self.dwellTimes)
+
+    def hit(self, x, y):
+        # returns the name of the AOI at (x, y), or None
+        if x is None or y is None or x != x or y != y:
+            return None
+        cell = (int(math.floor(x / self.cellSize)),
+                int(math.floor(y / self.cellSize)))
+        for index in reversed(self._grid.get(cell, ())):
+            if self.aois[index].contains(x, y):
+                return self.names[index]
+        return None
+
+    def label(self, x, y):
+        # labels arrays of points with the index (into self.names) of the
+        # AOI they fall in, -1 for none; NaN points are never in an AOI
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        labels = np.full(x.shape, -1, dtype=np.int32)
+        valid = np.flatnonzero((x == x) & (y == y))
+        if len(valid) == 0 or not self.aois:
+            return labels
+        # sort the points by grid cell so each AOI only looks at the
+        # points in the cells it covers
+        cx = np.floor(x[valid] / self.cellSize).astype(np.int64)
+        cy = np.floor(y[valid] / self.cellSize).astype(np.int64)
+        cells = (cx << 32) + (cy & 0xffffffff)
+        order = np.argsort(cells, kind='mergesort')
+        cells = cells[order]
+        points = valid[order]
+        for index, aoi in enumerate(self.aois):
+            candidates = []
+            for cellX, cellY in self._cells(aoi.bounds):
+                key = (cellX << 32) + (cellY & 0xffffffff)
+                start = np.searchsorted(cells, key, 'left')
+                stop = np.searchsorted(cells, key, 'right')
+                if stop > start:
+                    candidates.append(points[start:stop])
+            if not candidates:
+                continue
+            candidates = np.concatenate(candidates)
+            inside = aoi.contains(x[candidates], y[candidates])
+            labels[candidates[inside]] = index
+        return labels
+
+    def addSample(self, t, x, y):
+        # updates the current AOI and the dwell time of the AOI gaze was in
+        # since the previous sample (t in microseconds, dwell in ms)
+        if self._lastTime is not None and self.currentAOI is not None:
+            self.dwellTimes[self.currentAOI] += min(
+                (t - self._lastTime) / 1000.0, self.maxGap)
+        self._lastTime = t
+        self.currentAOI = self.hit(x, y)
+        return self.currentAOI
@@ -0,0 +1,33 @@
+#
+# Eye tracker backends for the Tobii controller
+# - a backend provides the parts of the Tobii SDK the controller uses:
+#   init(), Clock, MainloopThread, EyetrackerBrowser, Eyetracker
+#   (create_async), SyncManager, Point2D and Calibration (made from the
+#   raw data of a saved calibration)
+# - TobiiBackend is the Tobii Analytics SDK 3.x; simulator.SimulatedBackend
+#   stands in for it without hardware
+#
+
+
+class TobiiBackend(object):
+    # The SDK is only imported when the backend is created, so the package
+    # can be used without it (e.g. with the simulator).
+
+    def __init__(self):
+        import tobii.eye_tracking_io
+        import tobii.eye_tracking_io.mainloop
+        import tobii.eye_tracking_io.browsing
+        import tobii.eye_tracking_io.eyetracker
+        import tobii.eye_tracking_io.time.clock
+        import tobii.eye_tracking_io.time.sync
+        import tobii.eye_tracking_io.types
+
+        self.init = tobii.eye_tracking_io.init
+        self.Clock = tobii.eye_tracking_io.time.clock.Clock
+        self.MainloopThread = tobii.eye_tracking_io.mainloop.MainloopThread
+        self.EyetrackerBrowser = \
+            tobii.eye_tracking_io.browsing.EyetrackerBrowser
+        self.Eyetracker = tobii.eye_tracking_io.eyetracker.Eyetracker
+        self.SyncManager = tobii.eye_tracking_io.time.sync.SyncManager
+        self.Point2D = tobii.eye_tracking_io.types.Point2D
+        self.Calibration = tobii.eye_tracking_io.types.Calibration
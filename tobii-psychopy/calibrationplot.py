@@ -0,0 +1,109 @@
+#
+# Calibration result display for the Tobii controller
+# - plot_arrays turns Calibration.plot_data into numpy arrays in one pass
+# - CalibrationPlot draws the result with three ElementArrayStims: the
+#   targets, the tolerance rings around them and every left / right error
+#   vector (each vector is a thin bar rotated from the target to the mapped
+#   gaze point). That is three draw calls however many samples there are,
+#   and the stimuli are reused across retries
+#
+
+import numpy as np
+
+LEFT_COLOR = (1.0, 1.0, -1.0)  # yellow
+RIGHT_COLOR = (-1.0, -1.0, 1.0)  # blue
+
+
+def plot_arrays(plot_data):
+    # returns the true points, left mapped points, left validity, right
+    # mapped points and right validity of a calibration's plot_data, as
+    # (n, 2) arrays (ACSD) and (n,) boolean arrays
+    values = np.array([(d.true_point.x, d.true_point.y,
+                        d.left.map_point.x, d.left.map_point.y,
+                        d.left.status,
+                        d.right.map_point.x, d.right.map_point.y,
+                        d.right.status) for d in plot_data],
+                      dtype=float).reshape(-1, 8)
+    return (values[:, 0:2], values[:, 2:4], values[:, 4] == 1,
+            values[:, 5:7], values[:, 7] == 1)
+
+
+def ring_mask(size=128, width=0.06):
+    # an element mask that is a ring of the given relative width
+    r = np.hypot(*np.mgrid[-1:1:size * 1j, -1:1:size * 1j])
+    return np.where((r <= 1) & (r >= 1 - width), 1.0, -1.0)
+
+
+class CalibrationPlot(object):
+
+    def __init__(self, win, transform, targetRadius=2.0,
+                 toleranceRadius=None, lineWidth=1.0):
+        # transform is a transforms.ScreenTransform for win; radii and
+        # lineWidth are in pixels. toleranceRadius=None draws no rings.
+        # psychopy is only needed for drawing, not for plot_arrays
+        import psychopy.visual
+        self.visual = psychopy.visual
+        self.win = win
+        self.transform = transform
+        self.targetRadius = targetRadius
+        self.toleranceRadius = toleranceRadius
+        self.lineWidth = lineWidth
+        self.targets = None
+        self.rings = None
+        self.vectors = None
+        self._ringMask = ring_mask()
+
+    def _elements(self, stim, xys, sizes, colors, oris=None, mask='circle'):
+        # updates stim in place if it has the right number of elements,
+        # and makes a new one otherwise; None if there is nothing to draw
+        n = len(xys)
+        if n == 0:
+            return None
+        if oris is None:
+            oris = np.zeros(n)
+        if stim is None or stim.nElements != n:
+            return self.visual.ElementArrayStim(
+                self.win, units='pix', nElements=n, elementTex=None,
+                elementMask=mask, xys=xys, sizes=sizes, oris=oris,
+                colors=colors, colorSpace='rgb')
+        stim.xys = xys
+        stim.sizes = sizes
+        stim.oris = oris
+        stim.colors = colors
+        return stim
+
+    def update(self, plot_data, targets):
+        # targets are the calibration points in ACSD
+        true, left, leftValid, right, rightValid = plot_arrays(plot_data)
+        targets = self.transform.toPix(np.reshape(targets, (-1, 2)))
+        n = len(targets)
+
+        self.targets = self._elements(
+            self.targets, targets, np.full(n, 2.0 * self.targetRadius),
+            np.ones((n, 3)))
+        if self.toleranceRadius is not None:
+            self.rings = self._elements(
+                self.rings, targets, np.full(n, 2.0 * self.toleranceRadius),
+                np.full((n, 3), -0.5), mask=self._ringMask)
+
+        # error vectors: a bar from the target to the mapped point
+        starts = self.transform.toPix(np.concatenate((true[leftValid],
+                                                      true[rightValid])))
+        ends = self.transform.toPix(np.concatenate((left[leftValid],
+                                                    right[rightValid])))
+        delta = ends - starts
+        lengths = np.hypot(delta[:, 0], delta[:, 1])
+        colors = np.concatenate((np.tile(LEFT_COLOR, (leftValid.sum(), 1)),
+                                 np.tile(RIGHT_COLOR,
+                                         (rightValid.sum(), 1))))
+        self.vectors = self._elements(
+            self.vectors, (starts + ends) / 2.0,
+            np.column_stack((lengths, np.full(len(lengths),
+                                              self.lineWidth))),
+            colors, oris=-np.degrees(np.arctan2(delta[:, 1], delta[:, 0])),
+            mask=None)
+
+    def draw(self):
+        for stim in (self.rings, self.vectors, self.targets):
+            if stim is not None:
+                stim.draw()
@@ -0,0 +1,152 @@
+#
+# Calibration quality metrics for the Tobii controller
+# - accuracy: mean angular offset between gaze and target (deg)
+# - precision: RMS of the sample-to-sample angular distance and the SD of
+#   the gaze positions (deg)
+# - computed per target for all samples at once, from a calibration's
+#   plot_data or from gaze recorded during a validation
+#
+
+from collections import namedtuple
+
+import numpy as np
+
+from calibrationplot import plot_arrays
+
+
+class Quality(namedtuple('Quality', ['points', 'samples', 'accuracy',
+                                     'rms', 'sd'])):
+    # points is a (k, 2) array of targets (ACSD); samples, accuracy, rms
+    # and sd are (k,) arrays with one value per target (NaN if a target
+    # has no valid samples)
+    __slots__ = ()
+
+    def summary(self):
+        # the means over the targets
+        summary = {'samples': int(self.samples.sum())}
+        for name in ('accuracy', 'rms', 'sd'):
+            values = getattr(self, name)
+            values = values[np.isfinite(values)]
+            summary[name] = float(values.mean()) if len(values) else None
+        return summary
+
+    def passes(self, accuracy=None, rms=None, sd=None):
+        # True if every target is within the given limits (deg); a target
+        # without valid samples fails
+        if len(self.points) == 0:
+            return False
+        for values, limit in ((self.accuracy, accuracy), (self.rms, rms),
+                              (self.sd, sd)):
+            if limit is not None and not np.all(values <= limit):
+                return False
+        return True
+
+
+def gaze_quality(targets, gaze, valid, transform, eyeDistance=None):
+    # targets and gaze are (n, 2) arrays of ACSD points, one row per
+    # sample in time order, valid is an (n,) boolean array and transform a
+    # transforms.ScreenTransform. eyeDistance (cm) is as for
+    # ScreenTransform.toDeg
+    targets = np.asarray(targets, dtype=float).reshape(-1, 2)
+    gaze = np.asarray(gaze, dtype=float).reshape(-1, 2)
+    n = len(targets)
+    valid = np.asarray(valid, dtype=bool) & np.isfinite(gaze).all(axis=1)
+    if eyeDistance is not None:
+        eyeDistance = np.broadcast_to(np.asarray(eyeDistance, dtype=float),
+                                      (n,))
+    if n == 0:
+        empty = np.zeros(0)
+        return Quality(np.zeros((0, 2)), np.zeros(0, int), empty, empty,
+                       empty)
+    points, group = np.unique(targets, axis=0, return_inverse=True)
+    group = group.ravel()
+    k = len(points)
+
+    index = np.flatnonzero(valid)
+    g = group[index]
+    distance = None if eyeDistance is None else eyeDistance[index]
+    samples = np.bincount(g, minlength=k)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        # accuracy
+        offset = transform.angularDistance(targets[index], gaze[index],
+                                           distance)
+        accuracy = np.bincount(g, offset, k) / samples
+
+        # RMS sample-to-sample: successive valid samples of one target
+        pair = g[1:] == g[:-1]
+        a, b = index[:-1][pair], index[1:][pair]
+        step = transform.angularDistance(
+            gaze[a], gaze[b], None if eyeDistance is None else eyeDistance[b])
+        rms = np.sqrt(np.bincount(group[b], step ** 2, k) /
+                      np.bincount(group[b], minlength=k))
+
+        # SD of the gaze positions
+        deg = transform.toDeg(gaze[index], distance)
+        variance = np.zeros(k)
+        for axis in range(2):
+            mean = np.bincount(g, deg[:, axis], k) / samples
+            variance += (np.bincount(g, deg[:, axis] ** 2, k) / samples -
+                         mean ** 2)
+        sd = np.sqrt(np.maximum(variance, 0))
+    return Quality(points, samples, accuracy, rms, sd)
+
+
+def binocular_quality(targets, left, leftValid, right, rightValid,
+                      transform, leftDistance=None, rightDistance=None):
+    # quality of both eyes, averaged per target and weighted by the number
+    # of valid samples of each eye
+    qualities = [gaze_quality(targets, left, leftValid, transform,
+                              leftDistance),
+                 gaze_quality(targets, right, rightValid, transform,
+                              rightDistance)]
+    samples = qualities[0].samples + qualities[1].samples
+    metrics = []
+    for name in ('accuracy', 'rms', 'sd'):
+        total = np.zeros(len(samples))
+        weight = np.zeros(len(samples))
+        for quality in qualities:
+            values = getattr(quality, name)
+            use = np.isfinite(values)
+            total[use] += values[use] * quality.samples[use]
+            weight[use] += quality.samples[use]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            metrics.append(total / weight)
+    return Quality(qualities[0].points, samples, *metrics)
+
+
+def calibration_quality(calibration, transform):
+    # quality of a calibration, from its plot_data (at the monitor's
+    # viewing distance)
+    true, left, leftValid, right, rightValid = \
+        plot_arrays(calibration.plot_data)
+    return binocular_quality(true, left, leftValid, right, rightValid,
+                             transform)
+
+
+def failing_points(calibration, points, transform=None, accuracy=1.0,
+                   minValid=0.5):
+    # returns an array telling which of points (ACSD) to calibrate again:
+    # those with no samples in the calibration, with fewer than minValid
+    # of their samples valid (in either eye) or, given a transform, with
+    # an accuracy worse than accuracy (deg)
+    true, left, leftValid, right, rightValid = \
+        plot_arrays(calibration.plot_data)
+    points = np.asarray(points, dtype=float).reshape(-1, 2)
+    # (samples, points): which point each sample belongs to
+    match = np.all(np.abs(true[:, None, :] - points[None, :, :]) < 1e-6,
+                   axis=2)
+    samples = match.sum(axis=0)
+    valid = (match & (leftValid | rightValid)[:, None]).sum(axis=0)
+    failing = (samples == 0) | (valid < minValid * samples)
+    if transform is not None:
+        quality = binocular_quality(true, left, leftValid, right,
+                                    rightValid, transform)
+        match = np.all(np.abs(quality.points[:, None, :] -
+                              points[None, :, :]) < 1e-6, axis=2)
+        pointAccuracy = np.full(len(points), np.nan)
+        found = match.any(axis=0)
+        pointAccuracy[found] = quality.accuracy[match.argmax(axis=0)[found]]
+        with np.errstate(invalid='ignore'):
+            failing |= ~(pointAccuracy <= accuracy)
+    return failing
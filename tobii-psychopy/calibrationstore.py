@@ -0,0 +1,118 @@
+#
+# Calibration store for the Tobii controller
+# - keeps the raw calibration data (Calibration.rawData) of each
+#   participant and eye tracker (product_id) on disk, with its quality
+#   and calibration points, so a returning participant can skip
+#   calibrating (see TobiiController.doCachedCalibration)
+# - one file per calibration plus an index (index.json) in a directory
+# - entries older than maxAge seconds are dropped, and so are the least
+#   recently used ones beyond maxEntries
+#
+
+import hashlib
+import json
+import os
+import time
+
+
+class CalibrationStore(object):
+
+    def __init__(self, directory, maxEntries=100, maxAge=7 * 24 * 3600):
+        # maxAge=None keeps calibrations until they are evicted
+        self.directory = directory
+        self.maxEntries = maxEntries
+        self.maxAge = maxAge
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._indexFile = os.path.join(directory, 'index.json')
+        if os.path.exists(self._indexFile):
+            with open(self._indexFile) as f:
+                self.index = json.load(f)
+        else:
+            self.index = {}
+
+    def _key(self, participant, productId):
+        return u'%s/%s' % (participant, productId)
+
+    def _path(self, key):
+        name = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, name + '.calib')
+
+    def _write(self, path, data, mode='wb'):
+        # write a temporary file and move it into place, so a crash never
+        # leaves a half written file
+        temporary = path + '.tmp'
+        with open(temporary, mode) as f:
+            f.write(data)
+        if os.name == 'nt' and os.path.exists(path):
+            os.remove(path)
+        os.rename(temporary, path)
+
+    def _saveIndex(self):
+        self._write(self._indexFile, json.dumps(self.index, indent=1,
+                                                sort_keys=True), 'w')
+
+    def _expired(self, entry, now):
+        return self.maxAge is not None and now - entry['saved'] > self.maxAge
+
+    def _remove(self, key):
+        self.index.pop(key, None)
+        path = self._path(key)
+        if os.path.exists(path):
+            os.remove(path)
+
+    def __len__(self):
+        return len(self.index)
+
+    def save(self, participant, productId, rawData, quality=None,
+             points=None):
+        # quality is a dict (e.g. calibrationquality.Quality.summary()),
+        # points a list of the calibration points (ACSD)
+        if not isinstance(rawData, bytes):
+            rawData = rawData.encode('utf-8')
+        key = self._key(participant, productId)
+        now = time.time()
+        self._write(self._path(key), rawData)
+        self.index[key] = {'participant': participant,
+                           'product_id': productId,
+                           'saved': now, 'used': now,
+                           'quality': quality,
+                           'points': [list(map(float, p))
+                                      for p in (points or [])]}
+        self.evict(now)
+
+    def load(self, participant, productId):
+        # returns (rawData, entry) or None if there is no calibration (or
+        # it has expired); entry is the index entry with quality and points
+        key = self._key(participant, productId)
+        entry = self.index.get(key)
+        if entry is None:
+            return None
+        now = time.time()
+        if self._expired(entry, now) or not os.path.exists(self._path(key)):
+            self._remove(key)
+            self._saveIndex()
+            return None
+        with open(self._path(key), 'rb') as f:
+            rawData = f.read()
+        entry['used'] = now
+        self._saveIndex()
+        return rawData, entry
+
+    def remove(self, participant, productId):
+        self._remove(self._key(participant, productId))
+        self._saveIndex()
+
+    def evict(self, now=None):
+        # drops expired entries, then the least recently used ones beyond
+        # maxEntries
+        if now is None:
+            now = time.time()
+        for key, entry in list(self.index.items()):
+            if self._expired(entry, now):
+                self._remove(key)
+        if self.maxEntries is not None and len(self.index) > self.maxEntries:
+            byUse = sorted(self.index, key=lambda k: self.index[k]['used'])
+            for key in byUse[:len(self.index) - self.maxEntries]:
+                self._remove(key)
+        self._saveIndex()
@@ -0,0 +1,119 @@
+#
+# Gaze conditions for the Tobii controller
+# - conditions are checked on every sample in on_gazedata and set a
+#   threading.Event when they are met, so waiting code wakes up within one
+#   sample instead of polling
+# - positions are in pixels relative to the screen centre, like acsd2pix
+#
+
+import math
+import threading
+
+import numpy as np
+
+from gazebuffer import SAMPLE_DTYPE
+
+
+class GazeCondition(object):
+    # Base class: subclasses implement check(record, point), where point is
+    # the (x, y) gaze position averaged over the valid eyes (None if no eye
+    # is valid). Once check returns True, event is set and sample holds the
+    # record that satisfied the condition.
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.sample = None
+
+    def reset(self):
+        self.sample = None
+        self.event.clear()
+
+    def update(self, record, point):
+        if not self.event.is_set() and self.check(record, point):
+            self.sample = np.array([tuple(record)], dtype=SAMPLE_DTYPE)[0]
+            self.event.set()
+
+    def check(self, record, point):
+        raise NotImplementedError
+
+    def wait(self, timeout=None):
+        # returns True once the condition was met, False after timeout (s)
+        return self.event.wait(timeout)
+
+
+class BothEyesValid(GazeCondition):
+
+    def check(self, record, point):
+        return record[4] != 4 and record[8] != 4
+
+
+class Fixation(GazeCondition):
+    # gaze stays within radius of pos for duration ms; with bothEyes only
+    # samples where both eyes are valid count
+
+    def __init__(self, pos, radius, duration=0, bothEyes=False):
+        GazeCondition.__init__(self)
+        self.pos = pos
+        self.radius = radius
+        # timestamps are in microseconds
+        self.duration = duration * 1000
+        self.bothEyes = bothEyes
+        self._since = None
+
+    def reset(self):
+        GazeCondition.reset(self)
+        self._since = None
+
+    def check(self, record, point):
+        if (point is None or
+                (self.bothEyes and (record[4] == 4 or record[8] == 4)) or
+                math.hypot(point[0] - self.pos[0],
+                           point[1] - self.pos[1]) > self.radius):
+            self._since = None
+            return False
+        if self._since is None:
+            self._since = record[0]
+        return record[0] - self._since >= self.duration
+
+
+class LeaveRegion(GazeCondition):
+    # gaze is (validly) further than radius from pos
+
+    def __init__(self, pos, radius):
+        GazeCondition.__init__(self)
+        self.pos = pos
+        self.radius = radius
+
+    def check(self, record, point):
+        return (point is not None and
+                math.hypot(point[0] - self.pos[0],
+                           point[1] - self.pos[1]) > self.radius)
+
+
+class Stable(GazeCondition):
+    # gaze stays within radius of where it was duration ms earlier,
+    # wherever that is (so it also works before calibration, when the gaze
+    # position may be off the target)
+
+    def __init__(self, radius, duration):
+        GazeCondition.__init__(self)
+        self.radius = radius
+        self.duration = duration * 1000
+        self._anchor = None
+        self._since = None
+
+    def reset(self):
+        GazeCondition.reset(self)
+        self._anchor = None
+        self._since = None
+
+    def check(self, record, point):
+        if point is None:
+            self._anchor = None
+            return False
+        if (self._anchor is None or
+                math.hypot(point[0] - self._anchor[0],
+                           point[1] - self._anchor[1]) > self.radius):
+            self._anchor = point
+            self._since = record[0]
+        return record[0] - self._since >= self.duration
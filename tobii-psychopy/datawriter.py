@@ -0,0 +1,305 @@
+#
+# Data file writers for the Tobii controller
+# - CsvWriter writes blocks of samples synchronously; metadata known only
+#   at close (e.g. instrumentation) goes into <filename>.meta.json
+# - StreamingWriter hands samples to a writer thread while tracking runs
+#
+
+import collections
+import datetime
+import json
+import threading
+
+import numpy as np
+
+from gazebuffer import SAMPLE_DTYPE
+
+
+CSV_COLUMNS = ['TimeStamp',
+               'GazePointXLeft',
+               'GazePointYLeft',
+               'PupilLeft',
+               'EyePositionXLeft',
+               'EyePositionYLeft',
+               'EyePositionZLeft',
+               'ValidityLeft',
+               'GazePointXRight',
+               'GazePointYRight',
+               'PupilRight',
+               'EyePositionXRight',
+               'EyePositionYRight',
+               'EyePositionZRight',
+               'ValidityRight',
+               'Event']
+
+# one csv line per sample; the event column stays empty
+CSV_ROW = ', '.join(['%.4f'] * 7 + ['%d'] + ['%.4f'] * 6 + ['%d']) + '\n'
+
+
+def sample_columns(samples, timeStampStart):
+    # returns the csv columns (without the event) of SAMPLE_DTYPE records
+    # as one (n, 15) float array, with time in ms relative to timeStampStart
+    columns = np.empty((len(samples), 15))
+    columns[:, 0] = (samples['timestamp'] - timeStampStart) / 1000.0
+    for offset, eye in ((1, 'left'), (8, 'right')):
+        columns[:, offset:offset + 2] = samples[eye + '_gaze']
+        columns[:, offset + 2] = samples[eye + '_pupil']
+        columns[:, offset + 3:offset + 6] = samples[eye + '_eye']
+        columns[:, offset + 6] = samples[eye + '_validity']
+    return columns
+
+
+class CsvWriter(object):
+    # Writes the comma-separated format: a header block once, then a column
+    # header plus all samples and events for every block (i.e. trial).
+    # Events are merged into the samples in timestamp order; an event goes
+    # after the samples with the same or an earlier timestamp.
+
+    streaming = False
+    chunkSize = 10000
+
+    def __init__(self, filename, resolution, recorded=None):
+        self.filename = filename
+        self.bytesWritten = 0
+        self.samplesWritten = 0
+        self._file = open(filename, 'w+')
+        now = recorded or datetime.datetime.now()
+        self._write('Recording date:\t' + now.strftime('%Y/%m/%d') + '\n')
+        self._write('Recording time:\t' + now.strftime('%H:%M:%S') + '\n')
+        self._write('Recording resolution\t%d x %d\n\n' % tuple(resolution))
+        self.timeStampStart = None
+        self._events = []
+        self.metadata = {}
+
+    def _write(self, text):
+        self._file.write(text)
+        self.bytesWritten += len(text)
+
+    def beginBlock(self):
+        # the next samples start a new block with its own column header
+        self.timeStampStart = None
+        self._events = []
+
+    def writeSamples(self, samples):
+        # writes an array of SAMPLE_DTYPE records, formatting them in chunks
+        # of chunkSize rows with one string operation per chunk
+        if len(samples) == 0:
+            return
+        if self.timeStampStart is None:
+            self._write(', '.join(CSV_COLUMNS) + '\n')
+            # first timepoint is 0s
+            self.timeStampStart = samples[0]['timestamp']
+        for start in range(0, len(samples), self.chunkSize):
+            chunk = samples[start:start + self.chunkSize]
+            rows = sample_columns(chunk, self.timeStampStart)
+            # merge the events that fall into this chunk
+            times = chunk['timestamp']
+            n = 0
+            while n < len(self._events) and self._events[n][0] <= times[-1]:
+                n += 1
+            positions = np.searchsorted(times, [e[0] for e in
+                                                self._events[:n]],
+                                        side='right')
+            last = 0
+            for position, event in zip(positions, self._events[:n]):
+                self._writeRows(rows[last:position])
+                self._writeEvent(event)
+                last = position
+            self._writeRows(rows[last:])
+            del self._events[:n]
+        self.samplesWritten += len(samples)
+
+    def _writeRows(self, rows):
+        if len(rows):
+            self._write((CSV_ROW * len(rows)) % tuple(rows.ravel().tolist()))
+
+    def _writeEvent(self, event):
+        self._write(('%.4f' + ', ' * 14 + '%s\n') %
+                    ((event[0] - self.timeStampStart) / 1000.0, event[1]))
+
+    def writeEvents(self, events):
+        # takes a list of (timestamp, event) tuples; they are written
+        # between the samples they were recorded at
+        self._events.extend(events)
+        self._events.sort(key=lambda e: e[0])
+
+    def endBlock(self):
+        # writes the events recorded after the last sample of the block
+        if self.timeStampStart is not None:
+            for event in self._events:
+                self._writeEvent(event)
+        self._events = []
+        self.flush()
+
+    def writeBlock(self, samples, events):
+        # writes one complete block of samples and events
+        self.beginBlock()
+        self.writeEvents(events)
+        self.writeSamples(samples)
+        self.endBlock()
+
+    def flush(self):
+        # flush the python data buffer (data written to file)
+        self._file.flush()
+
+    def setMetadata(self, key, value):
+        # the csv header is written when the file is opened, so metadata
+        # is kept and written next to the file at close
+        self.metadata[key] = value
+
+    def close(self):
+        self._file.close()
+        if self.metadata:
+            with open(self.filename + '.meta.json', 'w') as f:
+                json.dump(self.metadata, f, indent=1, default=str)
+
+
+class StreamingWriter(object):
+    # Wraps a writer (e.g. CsvWriter) and writes samples in batches on a
+    # dedicated thread. Samples are passed in through a bounded queue; when
+    # the queue is full the backpressure policy decides what happens:
+    #   'block'       - the caller waits until the writer catches up
+    #   'drop'        - the new sample is discarded
+    #   'drop_oldest' - the oldest queued sample is discarded
+    # Block boundaries and events are never dropped.
+
+    streaming = True
+    policies = ('block', 'drop', 'drop_oldest')
+
+    _SAMPLE, _EVENT, _BEGIN, _END, _CLOSE, _METADATA = range(6)
+
+    def __init__(self, writer, maxQueue=10000, backpressure='block'):
+        if backpressure not in self.policies:
+            raise ValueError("Unknown backpressure policy: %s" %
+                             backpressure)
+        self.writer = writer
+        self.maxQueue = maxQueue
+        self.backpressure = backpressure
+        self.droppedSamples = 0
+        self.maxQueueDepth = 0
+        self.blockOpen = False
+        self.error = None
+        self._queue = collections.deque()
+        self._queuedSamples = 0
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run,
+                                        name='StreamingWriter')
+        self._thread.daemon = True
+        self._thread.start()
+
+    @property
+    def filename(self):
+        return self.writer.filename
+
+    @property
+    def queueDepth(self):
+        return len(self._queue)
+
+    @property
+    def bytesWritten(self):
+        return self.writer.bytesWritten
+
+    @property
+    def samplesWritten(self):
+        return self.writer.samplesWritten
+
+    def _put(self, item):
+        with self._condition:
+            self._queue.append(item)
+            self.maxQueueDepth = max(self.maxQueueDepth, len(self._queue))
+            self._condition.notify_all()
+
+    def addSample(self, record):
+        # queues one record (a tuple in SAMPLE_DTYPE order)
+        with self._condition:
+            while self._queuedSamples >= self.maxQueue:
+                if self.backpressure == 'drop':
+                    self.droppedSamples += 1
+                    return
+                elif self.backpressure == 'drop_oldest':
+                    for i, item in enumerate(self._queue):
+                        if item[0] == self._SAMPLE:
+                            del self._queue[i]
+                            self._queuedSamples -= 1
+                            self.droppedSamples += 1
+                            break
+                elif not self._thread.is_alive():
+                    return
+                else:
+                    self._condition.wait(0.1)
+            self._queuedSamples += 1
+            self._queue.append((self._SAMPLE, record))
+            self.maxQueueDepth = max(self.maxQueueDepth, len(self._queue))
+            self._condition.notify_all()
+
+    def addEvent(self, t, event):
+        self._put((self._EVENT, (t, event)))
+
+    def beginBlock(self):
+        self.blockOpen = True
+        self._put((self._BEGIN, None))
+
+    def endBlock(self):
+        # only enqueues the end of the block; returns right away
+        if self.blockOpen:
+            self.blockOpen = False
+            self._put((self._END, None))
+
+    def setMetadata(self, key, value):
+        self._put((self._METADATA, (key, value)))
+
+    def close(self):
+        # writes out everything still queued, then closes the file
+        self.endBlock()
+        self._put((self._CLOSE, None))
+        self._thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def _run(self):
+        samples = []
+        closed = False
+        while not closed:
+            with self._condition:
+                while not self._queue:
+                    self._condition.wait()
+                items = self._queue
+                self._queue = collections.deque()
+                self._queuedSamples = 0
+                self._condition.notify_all()
+            # errors are handled per message, so a failing writer never
+            # stops the close from being seen, and producers never block
+            # on a dead writer; the first error is raised by close()
+            for kind, payload in items:
+                if kind == self._SAMPLE:
+                    samples.append(payload)
+                    continue
+                if kind == self._CLOSE:
+                    closed = True
+                try:
+                    # write all samples queued before this message
+                    self._writeSamples(samples)
+                    if kind == self._EVENT:
+                        self.writer.writeEvents([payload])
+                    elif kind == self._BEGIN:
+                        self.writer.beginBlock()
+                    elif kind == self._END:
+                        self.writer.endBlock()
+                    elif kind == self._METADATA:
+                        self.writer.setMetadata(*payload)
+                except Exception as error:
+                    self.error = self.error or error
+                samples = []
+            try:
+                self._writeSamples(samples)
+            except Exception as error:
+                self.error = self.error or error
+            samples = []
+        try:
+            self.writer.close()
+        except Exception as error:
+            self.error = self.error or error
+
+    def _writeSamples(self, samples):
+        if samples:
+            self.writer.writeSamples(np.array(samples, dtype=SAMPLE_DTYPE))
@@ -0,0 +1,255 @@
+#
+# Online fixation and saccade detection for the Tobii controller
+# - detectors are fed one sample at a time (from on_gazedata or from a
+#   saved recording) at constant cost per sample
+# - positions are in pixels relative to the screen centre, like acsd2pix;
+#   thresholds are in degrees and converted with pixPerDeg
+#
+
+import collections
+import math
+
+from gazebuffer import average_point
+
+
+# kind is 'fixation_start', 'fixation_end', 'saccade_start' or
+# 'saccade_end'; time is the tracker timestamp at which the fixation or
+# saccade started; x, y is the fixation centroid (or the saccade start and
+# end point) in pixels; duration is in ms (None for *_start events)
+GazeEvent = collections.namedtuple('GazeEvent',
+                                   ['kind', 'time', 'x', 'y', 'duration'])
+
+
+class _EventDetector(object):
+    # Averages the valid eyes of each sample, handles tracking loss and
+    # queues the detected events; subclasses implement _update.
+
+    def __init__(self, screenSize, pixPerDeg, minFixationDuration=60,
+                 maxGapDuration=75):
+        self.screenSize = screenSize
+        self.pixPerDeg = float(pixPerDeg)
+        # durations are given in ms, timestamps are in microseconds
+        self.minFixationDuration = minFixationDuration * 1000
+        self.maxGapDuration = maxGapDuration * 1000
+        self.events = collections.deque()
+        self.inFixation = False
+        self.inSaccade = False
+        self._lastValid = None
+
+    def addSample(self, record):
+        # record is a SAMPLE_DTYPE record or a tuple from unpack_gaze
+        t = record[0]
+        point = average_point(record)
+        if point is None:
+            # tracking loss ends whatever was going on after maxGapDuration
+            if (self._lastValid is not None and
+                    t - self._lastValid > self.maxGapDuration):
+                self._lastValid = None
+                self._reset(t)
+            return
+        if (self._lastValid is not None and
+                t - self._lastValid > self.maxGapDuration):
+            self._reset(t)
+        self._lastValid = t
+        self._update(t, (point[0] - 0.5) * self.screenSize[0],
+                     (0.5 - point[1]) * self.screenSize[1])
+
+    def addSamples(self, samples):
+        for record in samples:
+            self.addSample(record)
+
+    def finish(self):
+        # ends the current fixation, e.g. at the end of a recording
+        self._lastValid = None
+        self._reset(None)
+
+    def getEvents(self):
+        # returns (and forgets) the events detected since the last call
+        events = []
+        while self.events:
+            events.append(self.events.popleft())
+        return events
+
+    def _emit(self, kind, time, x, y, duration=None):
+        if duration is not None:
+            duration = duration / 1000.0
+        self.events.append(GazeEvent(kind, time, x, y, duration))
+
+    def _reset(self, t):
+        raise NotImplementedError
+
+    def _update(self, t, x, y):
+        raise NotImplementedError
+
+
+class IVTDetector(_EventDetector):
+    # Velocity-threshold identification: samples faster than
+    # velocityThreshold (deg/s) belong to saccades, the rest to fixations.
+    # Saccade onsets are reported on the first fast sample.
+
+    def __init__(self, screenSize, pixPerDeg, velocityThreshold=30.0,
+                 **kwargs):
+        _EventDetector.__init__(self, screenSize, pixPerDeg, **kwargs)
+        self.velocityThreshold = velocityThreshold
+        self._previous = None
+        self._startFixation()
+
+    def _startFixation(self, t=None):
+        self._fixationStart = t
+        self._fixationEnd = t
+        self._n = 0
+        self._sumX = self._sumY = 0.0
+
+    def _endFixation(self):
+        if self.inFixation:
+            self._emit('fixation_end', self._fixationStart,
+                       self._sumX / self._n, self._sumY / self._n,
+                       self._fixationEnd - self._fixationStart)
+        self.inFixation = False
+
+    def _reset(self, t):
+        self._endFixation()
+        self.inSaccade = False
+        self._previous = None
+        self._startFixation()
+
+    def _update(self, t, x, y):
+        previous, self._previous = self._previous, (t, x, y)
+        if previous is None or t <= previous[0]:
+            velocity = 0.0
+        else:
+            velocity = (math.hypot(x - previous[1], y - previous[2]) /
+                        self.pixPerDeg / ((t - previous[0]) / 1e6))
+        if velocity >= self.velocityThreshold:
+            if not self.inSaccade:
+                self._endFixation()
+                self.inSaccade = True
+                self._saccadeStart = previous
+                self._emit('saccade_start', previous[0],
+                           previous[1], previous[2])
+            return
+        if self.inSaccade:
+            self.inSaccade = False
+            self._emit('saccade_end', self._saccadeStart[0], x, y,
+                       t - self._saccadeStart[0])
+            self._startFixation()
+        if self._fixationStart is None:
+            self._fixationStart = t
+        self._fixationEnd = t
+        self._n += 1
+        self._sumX += x
+        self._sumY += y
+        if (not self.inFixation and
+                t - self._fixationStart >= self.minFixationDuration):
+            self.inFixation = True
+            self._emit('fixation_start', self._fixationStart,
+                       self._sumX / self._n, self._sumY / self._n)
+
+
+class IDTDetector(_EventDetector):
+    # Dispersion-threshold identification: a fixation is a window of at
+    # least minFixationDuration whose dispersion (x range + y range) stays
+    # below dispersionThreshold (deg). Running minima and maxima keep the
+    # cost per sample constant (amortised).
+
+    def __init__(self, screenSize, pixPerDeg, dispersionThreshold=1.0,
+                 **kwargs):
+        _EventDetector.__init__(self, screenSize, pixPerDeg, **kwargs)
+        self.dispersionThreshold = dispersionThreshold
+        self._clear()
+
+    def _clear(self):
+        self._window = collections.deque()
+        # monotonic deques of (index, value) for running min / max
+        self._minX = collections.deque()
+        self._maxX = collections.deque()
+        self._minY = collections.deque()
+        self._maxY = collections.deque()
+        self._index = 0
+        self._first = 0
+        self._sumX = self._sumY = 0.0
+
+    def _dispersion(self, x=None, y=None):
+        minX, maxX = self._minX[0][1], self._maxX[0][1]
+        minY, maxY = self._minY[0][1], self._maxY[0][1]
+        if x is not None:
+            minX, maxX = min(minX, x), max(maxX, x)
+            minY, maxY = min(minY, y), max(maxY, y)
+        return ((maxX - minX) + (maxY - minY)) / self.pixPerDeg
+
+    def _push(self, t, x, y):
+        self._window.append((t, x, y))
+        for extremes, value, smaller in ((self._minX, x, True),
+                                         (self._maxX, x, False),
+                                         (self._minY, y, True),
+                                         (self._maxY, y, False)):
+            while extremes and ((extremes[-1][1] >= value) if smaller
+                                else (extremes[-1][1] <= value)):
+                extremes.pop()
+            extremes.append((self._index, value))
+        self._index += 1
+        self._sumX += x
+        self._sumY += y
+
+    def _pop(self):
+        t, x, y = self._window.popleft()
+        for extremes in (self._minX, self._maxX, self._minY, self._maxY):
+            if extremes[0][0] == self._first:
+                extremes.popleft()
+        self._first += 1
+        self._sumX -= x
+        self._sumY -= y
+
+    def _duration(self):
+        return self._window[-1][0] - self._window[0][0]
+
+    def _endFixation(self):
+        if self.inFixation:
+            n = len(self._window)
+            self._emit('fixation_end', self._window[0][0],
+                       self._sumX / n, self._sumY / n, self._duration())
+        self.inFixation = False
+
+    def _reset(self, t):
+        self._endFixation()
+        self.inSaccade = False
+        self._clear()
+
+    def _update(self, t, x, y):
+        if self.inFixation:
+            if self._dispersion(x, y) <= self.dispersionThreshold:
+                self._push(t, x, y)
+                return
+            # gaze left the fixation: this sample starts a saccade
+            last = self._window[-1]
+            self._endFixation()
+            self._clear()
+            self.inSaccade = True
+            self._saccadeStart = last
+            self._emit('saccade_start', last[0], last[1], last[2])
+        self._push(t, x, y)
+        while (len(self._window) > 1 and
+               self._dispersion() > self.dispersionThreshold):
+            self._pop()
+        if (self._duration() >= self.minFixationDuration and
+                self._dispersion() <= self.dispersionThreshold):
+            if self.inSaccade:
+                self.inSaccade = False
+                first = self._window[0]
+                self._emit('saccade_end', self._saccadeStart[0],
+                           first[1], first[2],
+                           first[0] - self._saccadeStart[0])
+            self.inFixation = True
+            n = len(self._window)
+            self._emit('fixation_start', self._window[0][0],
+                       self._sumX / n, self._sumY / n)
+
+
+def detect_events(samples, screenSize, pixPerDeg, method='ivt', **kwargs):
+    # runs a detector over a whole array of samples (e.g. a Recording)
+    # and returns the list of GazeEvents
+    detectors = {'ivt': IVTDetector, 'idt': IDTDetector}
+    detector = detectors[method](screenSize, pixPerDeg, **kwargs)
+    detector.addSamples(samples)
+    detector.finish()
+    return detector.getEvents()
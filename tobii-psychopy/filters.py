@@ -0,0 +1,227 @@
+#
+# Real-time gaze filters for the Tobii controller
+# - every filter smooths one eye's 2D gaze point (in ACSD, i.e. screen
+#   fractions) with a fixed amount of state per eye
+# - GazeFilter runs a chain of filters on both eyes of every sample and
+#   can extrapolate the filtered gaze to a future time
+#
+
+import collections
+import copy
+import math
+
+import numpy as np
+
+from gazebuffer import GazeBuffer, SAMPLE_DTYPE
+
+
+class MovingAverage(object):
+
+    def __init__(self, n=5):
+        self.n = n
+        self.reset()
+
+    def reset(self):
+        self._window = collections.deque()
+        self._sumX = self._sumY = 0.0
+
+    def filter(self, t, x, y):
+        self._window.append((x, y))
+        self._sumX += x
+        self._sumY += y
+        if len(self._window) > self.n:
+            oldX, oldY = self._window.popleft()
+            self._sumX -= oldX
+            self._sumY -= oldY
+        n = len(self._window)
+        return self._sumX / n, self._sumY / n
+
+
+class Median(object):
+
+    def __init__(self, n=5):
+        self.n = n
+        self.reset()
+
+    def reset(self):
+        self._x = collections.deque(maxlen=self.n)
+        self._y = collections.deque(maxlen=self.n)
+
+    def filter(self, t, x, y):
+        self._x.append(x)
+        self._y.append(y)
+        xs, ys = sorted(self._x), sorted(self._y)
+        middle = len(xs) // 2
+        if len(xs) % 2:
+            return xs[middle], ys[middle]
+        return ((xs[middle - 1] + xs[middle]) / 2.0,
+                (ys[middle - 1] + ys[middle]) / 2.0)
+
+
+class OneEuro(object):
+    # Casiez et al. (2012): a low-pass filter whose cutoff (Hz) rises with
+    # speed, so fixations are smoothed hard and saccades barely lag.
+    # beta is per unit of speed in screen fractions per second.
+
+    def __init__(self, minCutoff=1.0, beta=10.0, dCutoff=1.0):
+        self.minCutoff = minCutoff
+        self.beta = beta
+        self.dCutoff = dCutoff
+        self.reset()
+
+    def reset(self):
+        self._last = None
+        self._dx = self._dy = 0.0
+
+    @staticmethod
+    def _alpha(cutoff, dt):
+        tau = 1.0 / (2 * math.pi * cutoff)
+        return 1.0 / (1.0 + tau / dt)
+
+    def filter(self, t, x, y):
+        if self._last is None:
+            self._last = (t, x, y)
+            return x, y
+        lastT, lastX, lastY = self._last
+        dt = (t - lastT) / 1e6
+        if dt <= 0:
+            return lastX, lastY
+        a = self._alpha(self.dCutoff, dt)
+        self._dx += a * ((x - lastX) / dt - self._dx)
+        self._dy += a * ((y - lastY) / dt - self._dy)
+        cutoff = self.minCutoff + self.beta * math.hypot(self._dx, self._dy)
+        a = self._alpha(cutoff, dt)
+        x = lastX + a * (x - lastX)
+        y = lastY + a * (y - lastY)
+        self._last = (t, x, y)
+        return x, y
+
+
+class Kalman(object):
+    # Constant-velocity Kalman filter, run independently on x and y.
+    # processNoise is the acceleration noise (screen fractions / s^2),
+    # measurementNoise the gaze noise (screen fractions).
+    # velocity holds the current velocity estimate (screen fractions / s).
+
+    def __init__(self, processNoise=50.0, measurementNoise=0.005):
+        self.processNoise = processNoise
+        self.measurementNoise = measurementNoise
+        self.reset()
+
+    def reset(self):
+        self._t = None
+        # per axis: state [position, velocity] and covariance [[a, b], [b, c]]
+        self._state = None
+        self.velocity = (0.0, 0.0)
+
+    def filter(self, t, x, y):
+        if self._t is None:
+            r = self.measurementNoise ** 2
+            self._state = [[x, 0.0, r, 0.0, 1.0], [y, 0.0, r, 0.0, 1.0]]
+            self._t = t
+            return x, y
+        dt = max((t - self._t) / 1e6, 1e-6)
+        self._t = t
+        q = self.processNoise ** 2
+        r = self.measurementNoise ** 2
+        out = []
+        for state, z in zip(self._state, (x, y)):
+            p, v, a, b, c = state
+            # predict
+            p += v * dt
+            a += dt * (2 * b + dt * c) + q * dt ** 4 / 4
+            b += dt * c + q * dt ** 3 / 2
+            c += q * dt ** 2
+            # update
+            s = a + r
+            kp, kv = a / s, b / s
+            residual = z - p
+            p += kp * residual
+            v += kv * residual
+            a, b, c = (1 - kp) * a, (1 - kp) * b, c - kv * b
+            state[:] = [p, v, a, b, c]
+            out.append(p)
+        self.velocity = (self._state[0][1], self._state[1][1])
+        return out[0], out[1]
+
+
+class GazeFilter(object):
+    # Runs a chain of filters on both eyes of each sample and keeps the
+    # filtered samples in their own GazeBuffer. Invalid eyes reset their
+    # chain. predict() extrapolates the newest filtered sample to a later
+    # tracker time with the estimated gaze velocity.
+
+    def __init__(self, filters, capacity=None):
+        self.filters = list(filters)
+        self._chains = {'left': [copy.deepcopy(f) for f in self.filters],
+                        'right': [copy.deepcopy(f) for f in self.filters]}
+        self._velocity = {'left': (0.0, 0.0), 'right': (0.0, 0.0)}
+        self._previous = {'left': None, 'right': None}
+        self.data = GazeBuffer(capacity=capacity)
+
+    def reset(self):
+        self.data.clear()
+        for eye in ('left', 'right'):
+            self._resetEye(eye)
+
+    def _resetEye(self, eye):
+        for f in self._chains[eye]:
+            f.reset()
+        self._velocity[eye] = (0.0, 0.0)
+        self._previous[eye] = None
+
+    def _filterEye(self, eye, t, point, valid):
+        if not valid:
+            self._resetEye(eye)
+            return point
+        x, y = point[0], point[1]
+        for f in self._chains[eye]:
+            x, y = f.filter(t, x, y)
+        velocity = getattr(self._chains[eye][-1], 'velocity', None)
+        previous = self._previous[eye]
+        if velocity is None and previous is not None and t > previous[0]:
+            # finite difference of the filtered output, lightly smoothed
+            dt = (t - previous[0]) / 1e6
+            vx, vy = self._velocity[eye]
+            velocity = (0.5 * vx + 0.5 * (x - previous[1]) / dt,
+                        0.5 * vy + 0.5 * (y - previous[2]) / dt)
+        if velocity is not None:
+            self._velocity[eye] = velocity
+        self._previous[eye] = (t, x, y)
+        return (x, y)
+
+    def addSample(self, record):
+        # filters a record (tuple from unpack_gaze or SAMPLE_DTYPE record),
+        # stores it and returns the filtered tuple
+        t = record[0]
+        filtered = (t,
+                    self._filterEye('left', t, record[1], record[4] != 4),
+                    record[2], record[3], record[4],
+                    self._filterEye('right', t, record[5], record[8] != 4),
+                    record[6], record[7], record[8])
+        self.data.append(filtered)
+        return filtered
+
+    def predict(self, t):
+        # returns ((left x, left y), (right x, right y)) in ACSD,
+        # extrapolated from the newest filtered sample to tracker time t
+        latest = self.data.latest()
+        if latest is None:
+            return None
+        dt = max(0.0, (t - latest['timestamp']) / 1e6)
+        points = []
+        for eye in ('left', 'right'):
+            x, y = latest[eye + '_gaze']
+            vx, vy = self._velocity[eye]
+            points.append((x + vx * dt, y + vy * dt))
+        return tuple(points)
+
+
+def filter_samples(samples, filters):
+    # runs a filter chain over an array of records and returns the filtered
+    # records as a new array
+    gazeFilter = GazeFilter(filters)
+    out = np.empty(len(samples), dtype=SAMPLE_DTYPE)
+    for i, record in enumerate(samples):
+        out[i] = gazeFilter.addSample(record)
+    return out
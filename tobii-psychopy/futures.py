@@ -0,0 +1,42 @@
+#
+# Futures for the callback-based calls of the Tobii SDK
+# - CallbackFuture.callback is passed to the SDK in place of a callback
+#   function; it is completed on the mainloop thread as soon as the SDK
+#   replies, and anyone waiting on the future wakes up at once
+# - the SDK replies with (error, result); error is 0 on success
+#
+
+import threading
+
+
+class CallbackFuture(object):
+
+    def __init__(self, handler=None):
+        # handler(error, result) is called on the mainloop thread before
+        # the future completes, like a plain SDK callback
+        self.handler = handler
+        self.error = None
+        self.value = None
+        self._event = threading.Event()
+
+    def callback(self, error, result=None):
+        try:
+            if self.handler is not None:
+                self.handler(error, result)
+        finally:
+            # complete the future even if the handler raised, so nobody is
+            # left waiting
+            self.error = error
+            self.value = result
+            self._event.set()
+        return False
+
+    def done(self):
+        return self._event.is_set()
+
+    def succeeded(self):
+        return self.done() and not self.error
+
+    def wait(self, timeout=None):
+        # returns True once the SDK has replied, False on timeout
+        return self._event.wait(timeout)
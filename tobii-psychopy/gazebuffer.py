@@ -0,0 +1,286 @@
+#
+# Columnar sample store for the Tobii controller
+# - every gaze sample is unpacked once, on arrival, into preallocated
+#   numpy columns instead of keeping the SDK objects alive
+#
+
+import numpy as np
+
+
+# one record per gaze sample; field order follows the csv columns
+SAMPLE_DTYPE = np.dtype([('timestamp', np.int64),
+                         ('left_gaze', np.float64, (2,)),
+                         ('left_pupil', np.float64),
+                         ('left_eye', np.float64, (3,)),
+                         ('left_validity', np.int8),
+                         ('right_gaze', np.float64, (2,)),
+                         ('right_pupil', np.float64),
+                         ('right_eye', np.float64, (3,)),
+                         ('right_validity', np.int8)])
+
+
+def unpack_gaze(gaze):
+    # turns an SDK gaze object into a plain tuple matching SAMPLE_DTYPE
+    return (gaze.Timestamp,
+            (gaze.LeftGazePoint2D.x, gaze.LeftGazePoint2D.y),
+            gaze.LeftPupil,
+            (gaze.LeftEyePosition3D.x, gaze.LeftEyePosition3D.y,
+             gaze.LeftEyePosition3D.z),
+            gaze.LeftValidity,
+            (gaze.RightGazePoint2D.x, gaze.RightGazePoint2D.y),
+            gaze.RightPupil,
+            (gaze.RightEyePosition3D.x, gaze.RightEyePosition3D.y,
+             gaze.RightEyePosition3D.z),
+            gaze.RightValidity)
+
+
+def average_point(record):
+    # returns the (x, y) gaze position of one record averaged over the valid
+    # eyes, or None if neither eye is valid
+    leftValid = record[4] != 4
+    rightValid = record[8] != 4
+    if leftValid and rightValid:
+        return ((record[1][0] + record[5][0]) / 2.0,
+                (record[1][1] + record[5][1]) / 2.0)
+    elif leftValid:
+        return record[1][0], record[1][1]
+    elif rightValid:
+        return record[5][0], record[5][1]
+    return None
+
+
+def average_gaze(samples):
+    # returns an (n, 2) array of gaze positions averaged over the valid eyes
+    # of an array of records; NaN where neither eye is valid
+    leftValid = (samples['left_validity'] != 4)[:, None]
+    rightValid = (samples['right_validity'] != 4)[:, None]
+    left = samples['left_gaze']
+    right = samples['right_gaze']
+    gaze = np.where(leftValid & rightValid, (left + right) / 2.0,
+                    np.where(leftValid, left, right))
+    gaze[~(leftValid | rightValid)[:, 0]] = np.nan
+    return gaze
+
+
+def eye_distance(samples):
+    # returns the distance of the eyes from the tracker (mm, the z of the
+    # eye positions) averaged over the valid eyes; NaN where neither eye is
+    # valid
+    leftValid = samples['left_validity'] != 4
+    rightValid = samples['right_validity'] != 4
+    left = samples['left_eye'][:, 2]
+    right = samples['right_eye'][:, 2]
+    distance = np.where(leftValid & rightValid, (left + right) / 2.0,
+                        np.where(leftValid, left, right))
+    distance[~(leftValid | rightValid)] = np.nan
+    return distance
+
+
+def epoch_times(events, startEvent, endEvent=None):
+    # returns the timestamps of the first startEvent in a list of
+    # (timestamp, event) tuples and of the first endEvent after it
+    # (None if there is no endEvent)
+    for i, (t, event) in enumerate(events):
+        if event == startEvent:
+            break
+    else:
+        raise KeyError("Event %r was not recorded." % (startEvent,))
+    if endEvent is None:
+        return t, None
+    for tEnd, event in events[i + 1:]:
+        if event == endEvent:
+            return t, tEnd
+    raise KeyError("Event %r was not recorded after %r." %
+                   (endEvent, startEvent))
+
+
+class GazeBuffer(object):
+    # Preallocated store of gaze samples.
+    # With capacity=None the buffer starts at chunkSize samples and doubles
+    # whenever it is full, so appending stays O(1) amortised;
+    # with a capacity it acts as a ring that overwrites the oldest samples.
+
+    def __init__(self, capacity=None, chunkSize=65536):
+        self.capacity = capacity
+        self.chunkSize = chunkSize
+        # number of times the buffer was cleared (see SampleCursor)
+        self.generation = 0
+        self.clear()
+
+    def clear(self):
+        size = self.capacity if self.capacity is not None else self.chunkSize
+        self._data = np.zeros(size, dtype=SAMPLE_DTYPE)
+        # total number of samples ever appended (never wraps)
+        self.count = 0
+        self.generation += 1
+
+    def __len__(self):
+        if self.capacity is None:
+            return self.count
+        return min(self.count, self.capacity)
+
+    def append(self, record):
+        # stores one record (a tuple in SAMPLE_DTYPE order). count is only
+        # increased once the record is in place, so readers on other
+        # threads can use it as a sequence number (see SampleCursor)
+        if self.capacity is None:
+            if self.count == len(self._data):
+                self._grow()
+            self._data[self.count] = record
+        else:
+            self._data[self.count % self.capacity] = record
+        self.count += 1
+
+    def _grow(self):
+        data = np.zeros(2 * len(self._data), dtype=SAMPLE_DTYPE)
+        data[:self.count] = self._data[:self.count]
+        self._data = data
+
+    def latest(self):
+        # returns the most recent record (or None if empty) - O(1)
+        if self.count == 0:
+            return None
+        if self.capacity is None:
+            return self._data[self.count - 1]
+        return self._data[(self.count - 1) % self.capacity]
+
+    def first(self):
+        # returns the oldest record still held (or None if empty)
+        if self.count == 0:
+            return None
+        if self.capacity is None or self.count <= self.capacity:
+            return self._data[0]
+        return self._data[self.count % self.capacity]
+
+    def data(self):
+        # returns all held samples in time order; this is a view unless
+        # the ring has wrapped, in which case it is a copy
+        if self.capacity is None:
+            return self._data[:self.count]
+        if self.count <= self.capacity:
+            return self._data[:self.count]
+        start = self.count % self.capacity
+        return np.concatenate((self._data[start:], self._data[:start]))
+
+    def searchTime(self, t, side='left'):
+        # returns the index (in time order) at which timestamp t would be
+        # inserted, like np.searchsorted - O(log n) also when wrapped
+        n = len(self)
+        if self.capacity is None or self.count <= self.capacity:
+            return int(np.searchsorted(self._data['timestamp'][:n], t, side))
+        start = self.count % self.capacity
+        older = self._data['timestamp'][start:]
+        if len(older) and (t < older[-1] or
+                           (side == 'left' and t == older[-1])):
+            return int(np.searchsorted(older, t, side))
+        return len(older) + int(np.searchsorted(
+            self._data['timestamp'][:start], t, side))
+
+    def timeRange(self, tStart, tEnd=None):
+        # returns (start, stop) indices of the samples with
+        # tStart <= timestamp < tEnd (tEnd=None means up to the newest)
+        start = self.searchTime(tStart)
+        stop = len(self) if tEnd is None else self.searchTime(tEnd)
+        return start, max(start, stop)
+
+    def between(self, tStart, tEnd=None):
+        # returns the samples with tStart <= timestamp < tEnd
+        return self.slice(*self.timeRange(tStart, tEnd))
+
+    def slice(self, start, stop):
+        # returns samples start:stop (in time order) - a view unless the
+        # range crosses the end of a wrapped ring
+        if self.capacity is None or self.count <= self.capacity:
+            return self._data[start:stop]
+        offset = self.count % self.capacity
+        start, stop = start + offset, stop + offset
+        if stop <= self.capacity:
+            return self._data[start:stop]
+        if start >= self.capacity:
+            return self._data[start - self.capacity:stop - self.capacity]
+        return np.concatenate((self._data[start:],
+                               self._data[:stop - self.capacity]))
+
+    def column(self, name):
+        # returns one column (e.g. 'timestamp', 'left_gaze') in time order
+        return self.data()[name]
+
+    @property
+    def nbytes(self):
+        return self._data.nbytes
+
+
+class SampleCursor(object):
+    # Reads the samples appended to a GazeBuffer since the last read, e.g.
+    # once per frame, as views of the buffer: no copying and no per-sample
+    # Python objects. The writer (the SDK thread) isn't locked; the cursor
+    # only relies on count being increased after each record is stored.
+    # - a growing buffer never changes stored samples (growing copies them
+    #   to a new array), so its views stay valid
+    # - in a ring, a view stays valid until capacity more samples have
+    #   arrived. Samples that were overwritten before the cursor read them
+    #   are skipped and counted in lost
+    # - after the buffer is cleared (startTracking) the cursor starts again
+    #   at its first sample
+
+    def __init__(self, buffer, fromStart=False):
+        self.buffer = buffer
+        self.lost = 0
+        self.generation = buffer.generation
+        # sequence number (buffer.count) of the next sample to read
+        self.position = 0 if fromStart else buffer.count
+
+    def available(self):
+        # the number of samples a read would return (before any losses)
+        if self.buffer.generation != self.generation:
+            return self.buffer.count
+        return self.buffer.count - self.position
+
+    def _views(self, data, start, stop):
+        capacity = self.buffer.capacity
+        if capacity is None:
+            return [data[start:stop]]
+        i, j = start % capacity, stop % capacity
+        if i < j:
+            return [data[i:j]]
+        return [view for view in (data[i:], data[:j]) if len(view)]
+
+    def readViews(self):
+        # returns the new samples as a list of views (none, one, or two
+        # where they wrap around the end of a ring), oldest first
+        buffer = self.buffer
+        # read count before _data: a buffer that grows meanwhile still
+        # holds the first count samples in either array
+        generation = buffer.generation
+        stop = buffer.count
+        data = buffer._data
+        if generation != self.generation:
+            self.generation = generation
+            self.position = 0
+        start = self.position
+        self.position = stop
+        capacity = buffer.capacity
+        if capacity is not None:
+            if stop - start > capacity:
+                self.lost += stop - capacity - start
+                start = stop - capacity
+            # the writer may have overwritten the oldest samples while they
+            # were being sliced; the record being written now has sequence
+            # number count, and replaces count - capacity
+            oldest = buffer.count - capacity + 1
+            if buffer.generation == generation and oldest > start:
+                self.lost += min(oldest, stop) - start
+                start = min(oldest, stop)
+        if stop <= start:
+            return []
+        return self._views(data, start, stop)
+
+    def read(self):
+        # returns the new samples as one array: a view, or a copy when
+        # they wrap around the end of a ring
+        views = self.readViews()
+        if len(views) == 1:
+            return views[0]
+        elif not views:
+            return np.zeros(0, dtype=SAMPLE_DTYPE)
+        return np.concatenate(views)
@@ -0,0 +1,140 @@
+#
+# Incremental gaze heatmaps
+# - Heatmap is a 2D histogram of gaze over the screen, in bins of binSize
+#   pixels, updated with batches of samples (e.g. from a SampleCursor).
+#   Each batch costs one bincount; reading the map costs O(bins) however
+#   many samples went into it
+# - samples are binned straight from ACSD, without converting them to
+#   pixels first; row 0 is the top of the screen
+# - heatmaps of the same screen and bin size can be added together, e.g.
+#   across trials or sessions, and saved with save / Heatmap.load
+# - smoothing (a Gaussian blur in numpy) is only done when asked for
+#
+
+import numpy as np
+
+from gazebuffer import average_gaze
+
+
+def gaussian_smooth(values, sigma):
+    # separable Gaussian blur of a 2D array, sigma in bins, with the
+    # outside of the array taken as zero
+    radius = int(np.ceil(3 * sigma))
+    if radius == 0:
+        return values.astype(float)
+    offsets = np.arange(-radius, radius + 1)
+    kernel = np.exp(-0.5 * (offsets / float(sigma)) ** 2)
+    kernel /= kernel.sum()
+    for axis in (0, 1):
+        values = np.swapaxes(values, 0, axis)
+        n = len(values)
+        padded = np.zeros((n + 2 * radius,) + values.shape[1:])
+        padded[radius:radius + n] = values
+        values = kernel[0] * padded[:n]
+        for i in range(1, len(kernel)):
+            values += kernel[i] * padded[i:i + n]
+        values = np.swapaxes(values, 0, axis)
+    return values
+
+
+class Heatmap(object):
+
+    def __init__(self, resolution, binSize=20):
+        # resolution is the screen size in pixels (width, height)
+        self.resolution = (int(resolution[0]), int(resolution[1]))
+        self.binSize = binSize
+        self.shape = (int(np.ceil(self.resolution[1] / float(binSize))),
+                      int(np.ceil(self.resolution[0] / float(binSize))))
+        self.counts = np.zeros(self.shape)
+        # number of samples with gaze outside the screen or none at all
+        self.missed = 0
+
+    @property
+    def total(self):
+        # number of samples in the map
+        return self.counts.sum()
+
+    def _check(self, other):
+        if (other.resolution != self.resolution or
+                other.binSize != self.binSize):
+            raise ValueError("Heatmaps of different screens or bin sizes "
+                             "can't be combined.")
+
+    def addPoints(self, points, weights=None):
+        # adds an (n, 2) array of ACSD points; NaN and off-screen points
+        # are counted in missed
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        with np.errstate(invalid='ignore'):
+            inside = np.all((points >= 0) & (points < 1), axis=1)
+        self.missed += len(points) - int(inside.sum())
+        points = points[inside]
+        rows = (points[:, 1] * self.resolution[1] // self.binSize)
+        cols = (points[:, 0] * self.resolution[0] // self.binSize)
+        index = rows.astype(int) * self.shape[1] + cols.astype(int)
+        if weights is not None:
+            weights = np.asarray(weights, dtype=float)[inside]
+        self.counts += np.bincount(index, weights,
+                                   self.counts.size).reshape(self.shape)
+
+    def addSamples(self, samples, weights=None):
+        # adds a batch of records (SAMPLE_DTYPE), at the gaze averaged
+        # over the valid eyes
+        if len(samples):
+            self.addPoints(average_gaze(samples), weights)
+
+    def merge(self, other):
+        # adds the counts of another heatmap of the same screen and bins
+        self._check(other)
+        self.counts += other.counts
+        self.missed += other.missed
+        return self
+
+    def __iadd__(self, other):
+        return self.merge(other)
+
+    def __add__(self, other):
+        return self.copy().merge(other)
+
+    def copy(self):
+        heatmap = Heatmap(self.resolution, self.binSize)
+        heatmap.merge(self)
+        return heatmap
+
+    def clear(self):
+        self.counts[:] = 0
+        self.missed = 0
+
+    def density(self, sigma=None):
+        # the share of samples in each bin (summing to 1), smoothed with a
+        # Gaussian of sigma pixels if given
+        values = self.counts
+        if sigma:
+            values = gaussian_smooth(values, sigma / float(self.binSize))
+        total = values.sum()
+        if total == 0:
+            return np.zeros(self.shape)
+        return values / total
+
+    def image(self, sigma=None):
+        # the density scaled to -1..1 (psychopy's colour range), with the
+        # densest bin at 1
+        values = self.density(sigma)
+        peak = values.max()
+        if peak > 0:
+            values = values / peak
+        return values * 2 - 1
+
+    def save(self, filename):
+        # saves the map (numpy .npz) to be loaded and merged later
+        np.savez(filename, counts=self.counts, missed=self.missed,
+                 resolution=self.resolution, binSize=self.binSize)
+
+    @classmethod
+    def load(cls, filename):
+        data = np.load(filename)
+        heatmap = cls(data['resolution'], data['binSize'].item())
+        if data['counts'].shape != heatmap.shape:
+            raise ValueError("%s has a damaged heatmap." % filename)
+        heatmap.counts[:] = data['counts']
+        heatmap.missed = int(data['missed'])
+        return heatmap
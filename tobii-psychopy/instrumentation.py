@@ -0,0 +1,151 @@
+#
+# Latency and sample-loss instrumentation for the Tobii controller
+# - Histogram is an HDR-style log-linear histogram of integer values
+#   (microseconds): constant time to record, fixed memory, and percentiles
+#   within about 3% of the true value
+# - Instrumentation collects, per sample: arrival lag, inter-sample
+#   interval, gaps, callback execution time and the age of the newest
+#   sample at each frame flip
+#
+
+import numpy as np
+
+
+class Histogram(object):
+
+    def __init__(self, subBucketBits=6, maxBits=40):
+        self.subBucketBits = subBucketBits
+        self.subBuckets = 1 << subBucketBits
+        self.counts = np.zeros((maxBits + 1) * self.subBuckets, np.int64)
+        self.reset()
+
+    def reset(self):
+        self.counts[:] = 0
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def _index(self, value):
+        # values below subBuckets get a bucket each; above, every power of
+        # two is split into subBuckets / 2 buckets
+        if value < self.subBuckets:
+            return value
+        shift = value.bit_length() - self.subBucketBits
+        return shift * (self.subBuckets >> 1) + (value >> shift)
+
+    def _value(self, index):
+        # the upper end of a bucket
+        half = self.subBuckets >> 1
+        if index < self.subBuckets:
+            return index
+        shift = index // half - 1
+        return ((index - shift * half + 1) << shift) - 1
+
+    def record(self, value):
+        value = max(0, int(value))
+        index = min(self._index(value), len(self.counts) - 1)
+        self.counts[index] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        self.counts += other.counts
+        self.count += other.count
+        self.total += other.total
+        for name, pick in (('min', min), ('max', max)):
+            values = [v for v in (getattr(self, name), getattr(other, name))
+                      if v is not None]
+            setattr(self, name, pick(values) if values else None)
+
+    @property
+    def mean(self):
+        return self.total / float(self.count) if self.count else None
+
+    def percentile(self, p):
+        if not self.count:
+            return None
+        rank = int(np.ceil(p / 100.0 * self.count))
+        index = int(np.searchsorted(np.cumsum(self.counts), max(rank, 1)))
+        return min(self._value(index), self.max)
+
+    def summary(self):
+        summary = {'count': self.count, 'mean': self.mean,
+                   'min': self.min, 'max': self.max}
+        for p in (50, 90, 99, 99.9):
+            summary['p%s' % p] = self.percentile(p)
+        return summary
+
+
+class Instrumentation(object):
+    # All times are in microseconds. A gap is an interval between two
+    # samples longer than gapFactor times the nominal sampling period; if
+    # no sampling rate is given, it is estimated from the first samples.
+
+    def __init__(self, samplingRate=None, gapFactor=1.5):
+        self.samplingRate = samplingRate
+        self.gapFactor = gapFactor
+        self.arrivalLag = Histogram()
+        self.interval = Histogram()
+        self.callbackTime = Histogram()
+        self.frameAge = Histogram()
+        self.reset()
+
+    def reset(self):
+        for histogram in (self.arrivalLag, self.interval, self.callbackTime,
+                          self.frameAge):
+            histogram.reset()
+        self.samples = 0
+        self.gaps = 0
+        self.gapDuration = 0
+        self.lostSamples = 0
+        self._lastTimestamp = None
+        self._firstIntervals = []
+        self.period = (1e6 / self.samplingRate if self.samplingRate
+                       else None)
+
+    def newBlock(self):
+        # tracking was restarted; the pause is not a gap
+        self._lastTimestamp = None
+
+    def addSample(self, timestamp, arrival):
+        # timestamp is the sample's tracker time and arrival the local time
+        # it reached python, both converted to the local clock
+        self.samples += 1
+        self.arrivalLag.record(arrival - timestamp)
+        last, self._lastTimestamp = self._lastTimestamp, timestamp
+        if last is None:
+            return
+        interval = timestamp - last
+        self.interval.record(interval)
+        if self.period is None:
+            self._firstIntervals.append(interval)
+            if len(self._firstIntervals) >= 100:
+                self.period = float(np.median(self._firstIntervals))
+            return
+        if interval > self.gapFactor * self.period:
+            self.gaps += 1
+            self.gapDuration += interval - self.period
+            self.lostSamples += int(round(interval / self.period)) - 1
+
+    def addCallbackTime(self, duration):
+        self.callbackTime.record(duration)
+
+    def addFrame(self, age):
+        # age of the newest sample when a frame was flipped
+        self.frameAge.record(age)
+
+    def summary(self):
+        return {'samples': self.samples,
+                'nominal_period_us': self.period,
+                'gaps': self.gaps,
+                'gap_duration_us': self.gapDuration,
+                'lost_samples': self.lostSamples,
+                'arrival_lag_us': self.arrivalLag.summary(),
+                'interval_us': self.interval.summary(),
+                'callback_time_us': self.callbackTime.summary(),
+                'frame_age_us': self.frameAge.summary()}
@@ -0,0 +1,61 @@
+#
+# Recording from several eye trackers at once
+# - TrackerStream is one activated eye tracker with its own sync manager
+#   and sample buffer. Its callback only touches its own buffer, so the
+#   trackers never wait for each other
+# - samples are stored with their timestamps converted to the local clock,
+#   so the streams share one time base and can be merged
+# - merge_streams makes one time-ordered array with the tracker's index
+#   in an extra field (MULTI_SAMPLE_DTYPE), e.g. for a binary recording
+#
+
+import numpy as np
+
+from gazebuffer import SAMPLE_DTYPE, GazeBuffer, unpack_gaze
+
+MULTI_SAMPLE_DTYPE = np.dtype(SAMPLE_DTYPE.descr + [('tracker', np.int8)])
+
+
+class TrackerStream(object):
+
+    def __init__(self, index, info, eyetracker, syncmanager, capacity=None):
+        self.index = index
+        self.info = info
+        self.eyetracker = eyetracker
+        self.syncmanager = syncmanager
+        self.buffer = GazeBuffer(capacity=capacity)
+
+    def on_gazedata(self, error, gaze):
+        record = unpack_gaze(gaze)
+        local = self.syncmanager.convert_from_remote_to_local(record[0])
+        self.buffer.append((local,) + record[1:])
+
+    def start(self):
+        self.buffer.clear()
+        self.eyetracker.events.OnGazeDataReceived += self.on_gazedata
+        self.eyetracker.StartTracking()
+
+    def stop(self):
+        self.eyetracker.StopTracking()
+        self.eyetracker.events.OnGazeDataReceived -= self.on_gazedata
+
+
+def merge_streams(streams, tStart=None, tEnd=None):
+    # returns the samples of all streams as one MULTI_SAMPLE_DTYPE array
+    # in time order (samples with equal timestamps keep the stream order).
+    # with tStart, only those with tStart <= timestamp < tEnd
+    parts = []
+    for stream in streams:
+        if tStart is None:
+            samples = stream.buffer.data()
+        else:
+            samples = stream.buffer.between(tStart, tEnd)
+        part = np.empty(len(samples), dtype=MULTI_SAMPLE_DTYPE)
+        for name in SAMPLE_DTYPE.names:
+            part[name] = samples[name]
+        part['tracker'] = stream.index
+        parts.append(part)
+    if not parts:
+        return np.zeros(0, dtype=MULTI_SAMPLE_DTYPE)
+    merged = np.concatenate(parts)
+    return merged[np.argsort(merged['timestamp'], kind='mergesort')]
@@ -0,0 +1,243 @@
+#
+# Binary recording format for the Tobii controller
+# - a small JSON header, then fixed-size records (SAMPLE_DTYPE, or another
+#   dtype given in the header), then the recorded events as JSON
+# - Recording opens a file with the samples memory-mapped, so large
+#   sessions are not loaded into memory
+#
+# File layout:
+#   bytes 0-7      magic 'TOBIIREC'
+#   bytes 8-11     little-endian uint32, length of the JSON header
+#   bytes 12-...   JSON header (utf-8), zero padded up to
+#                  header['data_offset']
+#   data_offset    sample_count records of header['dtype']
+#   events_offset  JSON list of [timestamp, event] pairs
+#
+
+import datetime
+import json
+import os
+import struct
+
+import numpy as np
+
+from gazebuffer import SAMPLE_DTYPE, epoch_times
+
+
+MAGIC = b'TOBIIREC'
+VERSION = 1
+HEADER_SPACE = 65536
+
+
+def _dtype_to_json(dtype):
+    return [[name, dtype.fields[name][0].base.str,
+             list(dtype.fields[name][0].shape)] for name in dtype.names]
+
+
+def _dtype_from_json(descr):
+    return np.dtype([(str(name), str(fmt), tuple(shape))
+                     for name, fmt, shape in descr])
+
+
+class BinaryWriter(object):
+    # Writes the binary format. Shares its interface with CsvWriter so it
+    # can be used by the controller and StreamingWriter interchangeably.
+
+    streaming = False
+
+    def __init__(self, filename, resolution, samplingRate=None,
+                 trackerInfo=None, headerSpace=HEADER_SPACE,
+                 dtype=SAMPLE_DTYPE):
+        # dtype is SAMPLE_DTYPE or an extension of it (such as
+        # multitracker.MULTI_SAMPLE_DTYPE)
+        self.filename = filename
+        self.dtype = np.dtype(dtype)
+        self.samplesWritten = 0
+        self.header = {
+            'version': VERSION,
+            'recording_date': datetime.datetime.now().strftime('%Y/%m/%d'),
+            'recording_time': datetime.datetime.now().strftime('%H:%M:%S'),
+            'resolution': [int(r) for r in resolution],
+            'sampling_rate': samplingRate,
+            'tracker': trackerInfo or {},
+            'dtype': _dtype_to_json(self.dtype),
+            'data_offset': headerSpace,
+            'sample_count': None,
+            'events_offset': None,
+            'blocks': [],
+        }
+        self._events = []
+        self._intervals = []
+        self._lastTimestamp = None
+        self._file = open(filename, 'wb')
+        self._writeHeader()
+        self._file.seek(headerSpace)
+        self.bytesWritten = headerSpace
+
+    def _writeHeader(self):
+        text = json.dumps(self.header, default=str).encode('utf-8')
+        if len(MAGIC) + 4 + len(text) > self.header['data_offset']:
+            raise ValueError("Recording header does not fit into %d bytes." %
+                             self.header['data_offset'])
+        self._file.seek(0)
+        self._file.write(MAGIC + struct.pack('<I', len(text)) + text)
+
+    def beginBlock(self):
+        # a block is [first sample, end sample, first event, end event]
+        n = len(self._events)
+        self.header['blocks'].append([self.samplesWritten,
+                                      self.samplesWritten, n, n])
+
+    def writeSamples(self, samples):
+        if len(samples) == 0:
+            return
+        if not self.header['blocks']:
+            self.beginBlock()
+        samples = np.ascontiguousarray(samples, dtype=self.dtype)
+        self._file.write(samples.tobytes())
+        self.bytesWritten += samples.nbytes
+        self.samplesWritten += len(samples)
+        self.header['blocks'][-1][1] = self.samplesWritten
+        # keep a few intervals to estimate the sampling rate at close
+        if len(self._intervals) < 10000:
+            timestamps = samples['timestamp']
+            if self._lastTimestamp is not None:
+                self._intervals.append(timestamps[0] - self._lastTimestamp)
+            self._intervals.extend(np.diff(timestamps)[:10000])
+        self._lastTimestamp = samples['timestamp'][-1]
+
+    def writeEvents(self, events):
+        if not self.header['blocks']:
+            self.beginBlock()
+        self._events.extend(events)
+        self.header['blocks'][-1][3] = len(self._events)
+
+    def endBlock(self):
+        self.flush()
+
+    def setMetadata(self, key, value):
+        # adds an entry to the header (written at close)
+        self.header[key] = value
+
+    def writeBlock(self, samples, events):
+        self.beginBlock()
+        self.writeSamples(samples)
+        self.writeEvents(events)
+        self.endBlock()
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        # writes the events after the samples and completes the header
+        self.header['sample_count'] = self.samplesWritten
+        self.header['events_offset'] = self._file.tell()
+        if self.header['sampling_rate'] is None and self._intervals:
+            interval = np.median(self._intervals)
+            if interval > 0:
+                # timestamps are in microseconds
+                self.header['sampling_rate'] = round(1e6 / interval, 1)
+        text = json.dumps([[int(t), e] for t, e in self._events],
+                          default=str).encode('utf-8')
+        self._file.write(text)
+        self.bytesWritten += len(text)
+        self._writeHeader()
+        self._file.close()
+
+
+class Recording(object):
+    # Opens a binary recording. samples is an np.memmap of the records, so
+    # opening is instant regardless of file size; columns are available as
+    # recording['left_gaze'] etc.
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError("%s is not a binary tobii recording." %
+                                 filename)
+            length, = struct.unpack('<I', f.read(4))
+            self.header = json.loads(f.read(length).decode('utf-8'))
+        self.dtype = _dtype_from_json(self.header['dtype'])
+        offset = self.header['data_offset']
+        count = self.header['sample_count']
+        # an unfinished file has no sample count; use whatever is complete
+        self.complete = count is not None
+        if count is None:
+            count = max(0, (os.path.getsize(filename) - offset) //
+                        self.dtype.itemsize)
+        if count > 0:
+            self.samples = np.memmap(filename, dtype=self.dtype, mode='r',
+                                     offset=offset, shape=(count,))
+        else:
+            self.samples = np.zeros(0, dtype=self.dtype)
+        self._events = None
+
+    def __len__(self):
+        return len(self.samples)
+
+    def __getitem__(self, key):
+        return self.samples[key]
+
+    @property
+    def events(self):
+        # list of (timestamp, event) tuples, read on first access
+        if self._events is None:
+            self._events = []
+            if self.header['events_offset'] is not None:
+                with open(self.filename, 'rb') as f:
+                    f.seek(self.header['events_offset'])
+                    self._events = [(t, e) for t, e in
+                                    json.loads(f.read().decode('utf-8'))]
+        return self._events
+
+    @property
+    def blocks(self):
+        # list of (start, stop) sample indices, one per tracking block
+        if self.header['blocks']:
+            return [(min(b[0], len(self)), min(b[1], len(self)))
+                    for b in self.header['blocks']]
+        return [(0, len(self))]
+
+    def blockEvents(self, block):
+        # the events recorded during one tracking block
+        if self.header['blocks']:
+            start, stop = self.header['blocks'][block][2:]
+            return self.events[start:stop]
+        return self.events
+
+    def timeRange(self, tStart, tEnd=None):
+        # returns (start, stop) indices of the samples with
+        # tStart <= timestamp < tEnd, found by binary search
+        timestamps = self.samples['timestamp']
+        start = int(np.searchsorted(timestamps, tStart))
+        if tEnd is None:
+            return start, len(self)
+        return start, max(start, int(np.searchsorted(timestamps, tEnd)))
+
+    def between(self, tStart, tEnd=None):
+        start, stop = self.timeRange(tStart, tEnd)
+        return self.samples[start:stop]
+
+    def getEpoch(self, startEvent, endEvent=None):
+        # returns the samples between the first startEvent and the first
+        # endEvent after it (or the end of the recording)
+        return self.between(*epoch_times(self.events, startEvent, endEvent))
+
+
+def export_csv(recording, filename):
+    # writes a binary recording (filename or Recording) in the csv format
+    # that setDataFile produces, one block per tracking block
+    from datawriter import CsvWriter
+    if not isinstance(recording, Recording):
+        recording = Recording(recording)
+    recorded = datetime.datetime.strptime(
+        recording.header['recording_date'] + ' ' +
+        recording.header['recording_time'], '%Y/%m/%d %H:%M:%S')
+    writer = CsvWriter(filename, recording.header['resolution'],
+                       recorded=recorded)
+    for i, (start, stop) in enumerate(recording.blocks):
+        if stop > start:
+            writer.writeBlock(recording.samples[start:stop],
+                              recording.blockEvents(i))
+    writer.close()
@@ -0,0 +1,451 @@
+#
+# Crash-safe segmented recording for the Tobii controller
+# - SegmentWriter writes a recording into a directory of segment files
+#   while tracking runs (the controller wraps it in a StreamingWriter).
+#   Samples are written in checksummed chunks at least every
+#   chunkInterval seconds, and a new segment is started when the current
+#   one reaches segmentBytes or is segmentSeconds old. A crash loses at
+#   most the last chunk, and a damaged segment only its damaged chunks
+# - index.jsonl has one JSON line per chunk, so the samples of a time
+#   range, and each event, can be found without reading the segments
+# - SegmentedRecording reads any time window from the chunks that
+#   overlap it; recover() rebuilds a binary recording (recording.py)
+#   from whatever chunks survive, without needing the index:
+#       python segments.py <directory> <recording.bin>
+#
+# Segment layout (segment-00000.seg, segment-00001.seg, ...): a sequence
+# of chunks, each a 32 byte header followed by its payload
+#   bytes 0-3      magic 'TSEG'
+#   byte 4         kind: 'H' header, 'S' samples, 'E' events, 'B' block
+#                  start, 'M' metadata, 'C' recording closed
+#   bytes 8-11     little-endian uint32, payload length
+#   bytes 12-15    little-endian uint32, crc32 of the payload
+#   bytes 16-31    little-endian int64s, first and last timestamp
+# Samples are records of header['dtype']; everything else is JSON. Every
+# segment starts with a header chunk, so each segment can be read alone.
+#
+
+import datetime
+import glob
+import json
+import os
+import struct
+import sys
+import time
+import zlib
+
+import numpy as np
+
+from gazebuffer import SAMPLE_DTYPE, epoch_times
+from recording import BinaryWriter, _dtype_from_json, _dtype_to_json
+
+
+CHUNK_MAGIC = b'TSEG'
+CHUNK = struct.Struct('<4sc3xIIqq')
+VERSION = 1
+INDEX = 'index.jsonl'
+
+
+def _crc(payload):
+    return zlib.crc32(payload) & 0xffffffff
+
+
+def _json(value):
+    return json.dumps(value, default=str).encode('utf-8')
+
+
+def _segment_name(n):
+    return 'segment-%05d.seg' % n
+
+
+def _entry(kind, payload, segment, offset, t0, t1, dtype=None):
+    # the index entry of a chunk; None for chunks that are not indexed
+    if kind == b'S':
+        return {'samples': [segment, offset,
+                            len(payload) // dtype.itemsize, t0, t1]}
+    value = json.loads(payload.decode('utf-8'))
+    if kind == b'H':
+        return {'header': value, 'segment': segment}
+    elif kind == b'E':
+        return {'events': value, 'segment': segment, 'offset': offset}
+    elif kind == b'B':
+        return {'block': [value, segment, offset]}
+    elif kind == b'M':
+        return {'metadata': value}
+    elif kind == b'C':
+        return {'closed': value}
+
+
+class SegmentWriter(object):
+    # Writes the segmented format. Shares its interface with CsvWriter and
+    # BinaryWriter; filename is the directory of the recording (existing
+    # segments in it are replaced).
+
+    streaming = False
+
+    def __init__(self, directory, resolution, samplingRate=None,
+                 trackerInfo=None, dtype=SAMPLE_DTYPE,
+                 segmentBytes=16 * 1024 * 1024, segmentSeconds=60.0,
+                 chunkInterval=0.5, fsync=False):
+        # fsync=True also forces every chunk to disk, which protects
+        # against power loss rather than only a crash of the experiment
+        self.filename = directory
+        self.dtype = np.dtype(dtype)
+        self.segmentBytes = segmentBytes
+        self.segmentSeconds = segmentSeconds
+        self.chunkInterval = chunkInterval
+        self.fsync = fsync
+        self.bytesWritten = 0
+        self.samplesWritten = 0
+        self.segments = 0
+        self.header = {
+            'version': VERSION,
+            'recording_date': datetime.datetime.now().strftime('%Y/%m/%d'),
+            'recording_time': datetime.datetime.now().strftime('%H:%M:%S'),
+            'resolution': [int(r) for r in resolution],
+            'sampling_rate': samplingRate,
+            'tracker': trackerInfo or {},
+            'dtype': _dtype_to_json(self.dtype),
+        }
+        self._blocks = 0
+        self._pending = []
+        self._pendingCount = 0
+        self._lastChunk = time.time()
+        self._file = None
+        self._segmentSize = 0
+        self._segmentOpened = None
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        for name in glob.glob(os.path.join(directory, 'segment-*.seg')):
+            os.remove(name)
+        self._index = open(os.path.join(directory, INDEX), 'w')
+
+    def _openSegment(self):
+        self._closeSegment()
+        self._file = open(os.path.join(self.filename,
+                                       _segment_name(self.segments)), 'wb')
+        self._segmentSize = 0
+        self._segmentOpened = time.time()
+        self.segments += 1
+        self._writeChunk(b'H', _json(self.header))
+
+    def _closeSegment(self):
+        if self._file is not None:
+            self._sync()
+            self._file.close()
+            self._file = None
+
+    def _sync(self):
+        self._file.flush()
+        self._index.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+            os.fsync(self._index.fileno())
+
+    def _full(self):
+        return (self._segmentSize >= self.segmentBytes or
+                (self.segmentSeconds is not None and
+                 time.time() - self._segmentOpened >= self.segmentSeconds))
+
+    def _writeChunk(self, kind, payload, t0=0, t1=0):
+        offset = self._segmentSize
+        self._file.write(CHUNK.pack(CHUNK_MAGIC, kind, len(payload),
+                                    _crc(payload), t0, t1) + payload)
+        self._segmentSize += CHUNK.size + len(payload)
+        self.bytesWritten += CHUNK.size + len(payload)
+        entry = _entry(kind, payload, self.segments - 1, offset, t0, t1,
+                       self.dtype)
+        self._index.write(json.dumps(entry, default=str) + '\n')
+        self._sync()
+
+    def _write(self, kind, payload, t0=0, t1=0):
+        # writes the pending samples first, so the chunks stay in order
+        self._writePending()
+        if self._file is None or self._full():
+            self._openSegment()
+        self._writeChunk(kind, payload, t0, t1)
+
+    def _writePending(self):
+        self._lastChunk = time.time()
+        if not self._pending:
+            return
+        samples = np.concatenate(self._pending)
+        self._pending = []
+        self._pendingCount = 0
+        # split the samples so the segments stay within segmentBytes
+        while len(samples):
+            if self._file is None or self._full():
+                self._openSegment()
+            room = max(1, (self.segmentBytes - self._segmentSize -
+                           CHUNK.size) // self.dtype.itemsize)
+            chunk, samples = samples[:room], samples[room:]
+            self._writeChunk(b'S', chunk.tobytes(),
+                             int(chunk['timestamp'][0]),
+                             int(chunk['timestamp'][-1]))
+
+    def beginBlock(self):
+        self._write(b'B', _json(self._blocks))
+        self._blocks += 1
+
+    def writeSamples(self, samples):
+        if len(samples) == 0:
+            return
+        if not self._blocks:
+            self.beginBlock()
+        self._pending.append(np.array(samples, dtype=self.dtype))
+        self._pendingCount += len(samples)
+        self.samplesWritten += len(samples)
+        if (self._pendingCount * self.dtype.itemsize >= self.segmentBytes or
+                time.time() - self._lastChunk >= self.chunkInterval):
+            self._writePending()
+
+    def writeEvents(self, events):
+        if not self._blocks:
+            self.beginBlock()
+        events = [[int(t), e] for t, e in events]
+        if events:
+            self._write(b'E', _json(events), min(t for t, e in events),
+                        max(t for t, e in events))
+
+    def endBlock(self):
+        self.flush()
+
+    def writeBlock(self, samples, events):
+        self.beginBlock()
+        self.writeSamples(samples)
+        self.writeEvents(events)
+        self.endBlock()
+
+    def flush(self):
+        self._writePending()
+        if self._file is not None:
+            self._sync()
+
+    def setMetadata(self, key, value):
+        self._write(b'M', _json([key, value]))
+
+    def close(self):
+        self._write(b'C', _json(self.samplesWritten))
+        self._closeSegment()
+        self._index.close()
+
+
+def scan(directory):
+    # reads every segment of a recording and yields (segment, offset,
+    # kind, payload, t0, t1) for each intact chunk. A damaged chunk is
+    # skipped by searching for the next chunk header; damaged counts the
+    # damaged stretches (damaged[0])
+    damaged = [0]
+
+    def chunks():
+        for path in sorted(glob.glob(os.path.join(directory,
+                                                  'segment-*.seg'))):
+            segment = int(os.path.basename(path)[8:13])
+            with open(path, 'rb') as f:
+                data = f.read()
+            offset = 0
+            while offset < len(data):
+                intact = False
+                if len(data) - offset >= CHUNK.size:
+                    magic, kind, length, crc, t0, t1 = \
+                        CHUNK.unpack_from(data, offset)
+                    start = offset + CHUNK.size
+                    payload = data[start:start + length]
+                    intact = (magic == CHUNK_MAGIC and
+                              len(payload) == length and
+                              _crc(payload) == crc)
+                if intact:
+                    yield segment, offset, kind, payload, t0, t1
+                    offset = start + length
+                else:
+                    damaged[0] += 1
+                    offset = data.find(CHUNK_MAGIC, offset + 1)
+                    if offset < 0:
+                        break
+    return chunks(), damaged
+
+
+def _scan_entries(directory):
+    # the index entries of the intact chunks, for a recording whose
+    # index is missing or damaged
+    chunks, damaged = scan(directory)
+    dtype = None
+    entries = []
+    for segment, offset, kind, payload, t0, t1 in chunks:
+        if kind == b'H':
+            dtype = _dtype_from_json(json.loads(
+                payload.decode('utf-8'))['dtype'])
+        elif kind == b'S' and dtype is None:
+            continue
+        entries.append(_entry(kind, payload, segment, offset, t0, t1, dtype))
+    return entries
+
+
+class SegmentedRecording(object):
+    # Opens a segmented recording. Only the index is read when opening;
+    # between() reads just the chunks that overlap the requested times.
+    # Without an index (or with rebuildIndex=True) the segments are
+    # scanned instead. verify=True checks each chunk's checksum on read.
+
+    def __init__(self, directory, verify=False, rebuildIndex=False):
+        self.directory = directory
+        self.verify = verify
+        entries = None
+        path = os.path.join(directory, INDEX)
+        if not rebuildIndex and os.path.exists(path):
+            entries = []
+            with open(path) as f:
+                for line in f:
+                    try:
+                        entries.append(json.loads(line))
+                    except ValueError:
+                        # a line cut short by a crash
+                        break
+        if not entries:
+            entries = _scan_entries(directory)
+
+        self.header = None
+        self.metadata = {}
+        self.events = []
+        self.complete = False
+        chunks = []
+        blocks = []
+        eventBlocks = []
+        count = 0
+        for entry in entries:
+            if 'header' in entry and self.header is None:
+                self.header = entry['header']
+            elif 'samples' in entry:
+                chunks.append(entry['samples'] + [count])
+                count += entry['samples'][2]
+            elif 'events' in entry:
+                self.events.extend((t, e) for t, e in entry['events'])
+            elif 'block' in entry:
+                blocks.append(count)
+                eventBlocks.append(len(self.events))
+            elif 'metadata' in entry:
+                key, value = entry['metadata']
+                self.metadata[key] = value
+            elif 'closed' in entry:
+                self.complete = True
+        if self.header is None:
+            raise ValueError("%s is not a segmented tobii recording." %
+                             directory)
+        self.dtype = _dtype_from_json(self.header['dtype'])
+        # one row per sample chunk: segment, offset, count, t0, t1, index
+        # of its first sample
+        self.chunks = np.array(chunks, dtype=np.int64).reshape(-1, 6)
+        self.blocks = [(start, stop) for start, stop in
+                       zip(blocks, blocks[1:] + [count])] or [(0, count)]
+        self._eventBlocks = list(zip(eventBlocks,
+                                     eventBlocks[1:] + [len(self.events)]))
+
+    def __len__(self):
+        return int(self.chunks[:, 2].sum())
+
+    def _read(self, rows):
+        parts = []
+        files = {}
+        try:
+            for segment, offset, count, t0, t1, first in rows:
+                if segment not in files:
+                    files[segment] = open(os.path.join(
+                        self.directory, _segment_name(segment)), 'rb')
+                f = files[segment]
+                f.seek(offset)
+                head = f.read(CHUNK.size)
+                payload = f.read(int(count) * self.dtype.itemsize)
+                if self.verify and (
+                        len(head) < CHUNK.size or
+                        CHUNK.unpack(head)[3] != _crc(payload)):
+                    raise ValueError("Damaged chunk at offset %d of "
+                                     "segment %d; use recover()." %
+                                     (offset, segment))
+                parts.append(np.frombuffer(payload, dtype=self.dtype))
+        finally:
+            for f in files.values():
+                f.close()
+        if not parts:
+            return np.zeros(0, dtype=self.dtype)
+        return np.concatenate(parts)
+
+    def read(self, start=0, stop=None):
+        # samples start to stop (indices over the whole recording)
+        if stop is None:
+            stop = len(self)
+        first = self.chunks[:, 5]
+        rows = self.chunks[(first + self.chunks[:, 2] > start) &
+                           (first < stop)]
+        if len(rows) == 0:
+            return np.zeros(0, dtype=self.dtype)
+        return self._read(rows)[start - rows[0, 5]:stop - rows[0, 5]]
+
+    def between(self, tStart, tEnd=None):
+        # the samples with tStart <= timestamp < tEnd, read from the
+        # chunks that overlap that range
+        overlap = self.chunks[:, 4] >= tStart
+        if tEnd is not None:
+            overlap &= self.chunks[:, 3] < tEnd
+        samples = self._read(self.chunks[overlap])
+        timestamps = samples['timestamp']
+        start = int(np.searchsorted(timestamps, tStart))
+        stop = (len(samples) if tEnd is None else
+                max(start, int(np.searchsorted(timestamps, tEnd))))
+        return samples[start:stop]
+
+    def blockEvents(self, block):
+        start, stop = self._eventBlocks[block] if self._eventBlocks else \
+            (0, len(self.events))
+        return self.events[start:stop]
+
+    def getEpoch(self, startEvent, endEvent=None):
+        # returns the samples between the first startEvent and the first
+        # endEvent after it (or the end of the recording)
+        return self.between(*epoch_times(self.events, startEvent, endEvent))
+
+
+def recover(directory, filename):
+    # rebuilds a binary recording (recording.Recording) from the intact
+    # chunks of a segmented recording, e.g. after a crash. Returns a dict
+    # with the number of segments, samples and events recovered and the
+    # number of damaged stretches skipped
+    chunks, damaged = scan(directory)
+    writer = None
+    segments = set()
+    events = 0
+    for segment, offset, kind, payload, t0, t1 in chunks:
+        segments.add(segment)
+        if kind == b'H':
+            if writer is None:
+                header = json.loads(payload.decode('utf-8'))
+                writer = BinaryWriter(
+                    filename, header['resolution'], header['sampling_rate'],
+                    header['tracker'],
+                    dtype=_dtype_from_json(header['dtype']))
+        elif writer is None:
+            # nothing can be read before the first header
+            continue
+        elif kind == b'S':
+            writer.writeSamples(np.frombuffer(payload, dtype=writer.dtype))
+        elif kind == b'E':
+            value = json.loads(payload.decode('utf-8'))
+            writer.writeEvents([(t, e) for t, e in value])
+            events += len(value)
+        elif kind == b'B':
+            writer.beginBlock()
+        elif kind == b'M':
+            writer.setMetadata(*json.loads(payload.decode('utf-8')))
+    if writer is None:
+        raise ValueError("No intact segments in %s." % directory)
+    result = {'segments': len(segments), 'samples': writer.samplesWritten,
+              'events': events, 'damaged': damaged[0]}
+    writer.setMetadata('recovered', result)
+    writer.close()
+    return result
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        print('usage: python segments.py <directory> <recording.bin>')
+        sys.exit(2)
+    print(recover(sys.argv[1], sys.argv[2]))
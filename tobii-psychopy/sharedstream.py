@@ -0,0 +1,271 @@
+#
+# Shared-memory gaze stream for consumers in other processes
+# - GazePublisher copies every sample into a ring buffer in shared memory
+#   (single producer); any number of GazeSubscribers in other local
+#   processes read the new samples from it directly, without pickling,
+#   sockets or locks, so online analysis never competes with the render
+#   loop for the GIL
+# - events from recordEvent are sent to the subscribers as JSON lines
+#   over a Unix socket (where the platform has them)
+# - the region is a file in /dev/shm (the temp directory where there is
+#   no /dev/shm), so on Linux it is the same memory that
+#   multiprocessing.shared_memory.SharedMemory(name) opens in Python 3
+#
+# Region layout (little-endian):
+#   bytes 0-7      magic 'TOBIISHM'
+#   bytes 8-11     uint32 layout version
+#   bytes 12-15    uint32 capacity: number of records in the ring
+#   bytes 16-19    uint32 data offset (DATA_OFFSET)
+#   bytes 20-23    uint32 length of the JSON dtype
+#   bytes 24-31    int64 count: records published so far. Record n is
+#                  stored at data offset + (n % capacity) * itemsize and
+#                  is complete once count > n
+#   bytes 32-39    int64 state: 1 while the publisher runs, 0 once closed
+#   bytes 40-...   JSON dtype (as in recording.py), default SAMPLE_DTYPE
+#   data offset    capacity records of that dtype
+#
+
+import json
+import mmap
+import os
+import socket
+import struct
+import tempfile
+import threading
+
+import numpy as np
+
+from gazebuffer import SAMPLE_DTYPE
+from recording import _dtype_from_json, _dtype_to_json
+
+
+MAGIC = b'TOBIISHM'
+VERSION = 1
+HEADER = struct.Struct('<8sIIIIqq')
+COUNT_OFFSET = 24
+DATA_OFFSET = 4096
+
+
+def region_path(name):
+    directory = '/dev/shm'
+    if not os.path.isdir(directory):
+        directory = tempfile.gettempdir()
+    return os.path.join(directory, name)
+
+
+def socket_path(name):
+    return os.path.join(tempfile.gettempdir(), name + '.sock')
+
+
+def _remove_own(path, inode):
+    # removes path unless another publisher has replaced it meanwhile
+    try:
+        if os.stat(path).st_ino == inode:
+            os.remove(path)
+    except OSError:
+        pass
+
+
+class GazePublisher(object):
+    # The producer side. addSample is called for every sample (by the
+    # controller's on_gazedata, see TobiiController.startPublishing) and
+    # addEvent for every event.
+
+    def __init__(self, name='tobii-gaze', capacity=65536, dtype=SAMPLE_DTYPE):
+        self.name = name
+        self.capacity = capacity
+        self.dtype = np.dtype(dtype)
+        descr = json.dumps(_dtype_to_json(self.dtype)).encode('utf-8')
+        if HEADER.size + len(descr) > DATA_OFFSET:
+            raise ValueError("The dtype description does not fit into the "
+                             "shared memory header.")
+        size = DATA_OFFSET + capacity * self.dtype.itemsize
+        self.path = region_path(name)
+        # the region is made under a new name and renamed into place, so a
+        # file left by an earlier publisher is replaced rather than
+        # truncated under subscribers that still have it mapped
+        temp = '%s.%d.tmp' % (self.path, os.getpid())
+        if os.path.exists(temp):
+            os.remove(temp)
+        fd = os.open(temp, os.O_RDWR | os.O_CREAT | os.O_EXCL, 0o600)
+        try:
+            os.ftruncate(fd, size)
+            self._mmap = mmap.mmap(fd, size)
+            self._inode = os.fstat(fd).st_ino
+        finally:
+            os.close(fd)
+        self._mmap[:HEADER.size + len(descr)] = HEADER.pack(
+            MAGIC, VERSION, capacity, DATA_OFFSET, len(descr), 0, 1) + descr
+        os.rename(temp, self.path)
+        self._count = np.ndarray((2,), np.int64, self._mmap, COUNT_OFFSET)
+        self._data = np.ndarray((capacity,), self.dtype, self._mmap,
+                                DATA_OFFSET)
+        self.count = 0
+
+        # event channel
+        self._clients = []
+        self._lock = threading.Lock()
+        self._server = None
+        if hasattr(socket, 'AF_UNIX'):
+            self.socketPath = socket_path(name)
+            if os.path.exists(self.socketPath):
+                os.remove(self.socketPath)
+            self._server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._server.bind(self.socketPath)
+            self._socketInode = os.stat(self.socketPath).st_ino
+            self._server.listen(8)
+            thread = threading.Thread(target=self._accept,
+                                      name='GazePublisher')
+            thread.daemon = True
+            thread.start()
+
+    def _accept(self):
+        while True:
+            try:
+                client, address = self._server.accept()
+            except (socket.error, AttributeError):
+                # the server socket was closed
+                return
+            # never let a slow subscriber hold up recordEvent
+            client.settimeout(0.01)
+            with self._lock:
+                self._clients.append(client)
+
+    def addSample(self, record):
+        # stores one record, then publishes it by increasing count
+        self._data[self.count % self.capacity] = record
+        self.count += 1
+        self._count[0] = self.count
+
+    def addSamples(self, samples):
+        for start in range(0, len(samples), self.capacity):
+            part = samples[start:start + self.capacity]
+            i = self.count % self.capacity
+            n = min(len(part), self.capacity - i)
+            self._data[i:i + n] = part[:n]
+            self._data[:len(part) - n] = part[n:]
+            self.count += len(part)
+            self._count[0] = self.count
+
+    def addEvent(self, t, event):
+        # sends [timestamp, event] to every connected subscriber; one that
+        # can't keep up is disconnected
+        line = (json.dumps([int(t), event], default=str) +
+                '\n').encode('utf-8')
+        with self._lock:
+            for client in list(self._clients):
+                try:
+                    client.sendall(line)
+                except socket.error:
+                    client.close()
+                    self._clients.remove(client)
+
+    def close(self):
+        # marks the stream closed and removes it; subscribers that are
+        # attached keep what they have mapped
+        self._count[1] = 0
+        if self._server is not None:
+            self._server.close()
+            self._server = None
+            with self._lock:
+                for client in self._clients:
+                    client.close()
+                self._clients = []
+            _remove_own(self.socketPath, self._socketInode)
+        # the mapping is released with the last array using it, which may
+        # still be in the hands of the thread calling addSample
+        self._mmap = None
+        _remove_own(self.path, self._inode)
+
+
+class GazeSubscriber(object):
+    # The consumer side, for any local process (it only needs numpy).
+    # read() returns the samples published since the last read, copied
+    # out of the ring in one go and checked against count afterwards, so
+    # samples overwritten while being copied are dropped (and counted in
+    # lost) rather than returned torn.
+
+    def __init__(self, name='tobii-gaze', fromStart=False):
+        self.name = name
+        with open(region_path(name), 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, self.capacity, offset, length, count,
+         state) = HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("%s is not a tobii gaze stream." % name)
+        self.dtype = _dtype_from_json(json.loads(self._mmap[
+            HEADER.size:HEADER.size + length].decode('utf-8')))
+        self._count = np.ndarray((2,), np.int64, self._mmap, COUNT_OFFSET)
+        self._data = np.ndarray((self.capacity,), self.dtype, self._mmap,
+                                offset)
+        self.lost = 0
+        # sequence number of the next sample to read
+        self.position = 0 if fromStart else int(self._count[0])
+
+        self._socket = None
+        self._pending = b''
+        if hasattr(socket, 'AF_UNIX') and os.path.exists(socket_path(name)):
+            self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                self._socket.connect(socket_path(name))
+                self._socket.setblocking(False)
+            except socket.error:
+                self._socket = None
+
+    @property
+    def closed(self):
+        # True once the publisher has closed the stream
+        return self._count[1] == 0
+
+    def read(self):
+        stop = int(self._count[0])
+        start = max(self.position, stop - self.capacity)
+        self.lost += start - self.position
+        i, j = start % self.capacity, stop % self.capacity
+        if stop <= start:
+            samples = np.zeros(0, dtype=self.dtype)
+        elif i < j:
+            samples = self._data[i:j].copy()
+        else:
+            samples = np.concatenate((self._data[i:], self._data[:j]))
+        # the record being written now replaces count - capacity
+        oldest = int(self._count[0]) - self.capacity + 1
+        if oldest > start:
+            drop = min(oldest, stop) - start
+            samples = samples[drop:]
+            self.lost += drop
+        self.position = stop
+        return samples
+
+    def latest(self):
+        # a copy of the newest record, or None if there is none yet
+        count = int(self._count[0])
+        if count == 0:
+            return None
+        return self._data[(count - 1) % self.capacity].copy()
+
+    def events(self):
+        # the (timestamp, event) tuples received since the last call
+        if self._socket is None:
+            return []
+        chunks = [self._pending]
+        while True:
+            try:
+                data = self._socket.recv(65536)
+            except socket.error:
+                break
+            if not data:
+                # the publisher has gone
+                self._socket.close()
+                self._socket = None
+                break
+            chunks.append(data)
+        lines = b''.join(chunks).split(b'\n')
+        self._pending = lines.pop()
+        return [tuple(json.loads(line.decode('utf-8'))) for line in lines]
+
+    def close(self):
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+        self._count = self._data = self._mmap = None
@@ -0,0 +1,464 @@
+#
+# Simulated eye tracker for the Tobii controller
+# - implements the SDK surface the controller uses (see backends.py), so
+#   experiments, benchmarks and tests run without hardware or the SDK
+# - samples are synthetic (fixations, saccades and blinks) or replayed from
+#   a recording, and are delivered on their own thread at up to 1200 Hz
+#
+# usage: TobiiController(win, backend=SimulatedBackend(samplingRate=300))
+#
+
+import collections
+import copy
+import json
+import threading
+import time
+
+import numpy as np
+
+from gazebuffer import SAMPLE_DTYPE
+
+
+class Point2D(object):
+
+    def __init__(self, x=0.0, y=0.0):
+        self.x = x
+        self.y = y
+
+    def __repr__(self):
+        return 'Point2D(%r, %r)' % (self.x, self.y)
+
+
+class Point3D(object):
+
+    def __init__(self, x=0.0, y=0.0, z=0.0):
+        self.x = x
+        self.y = y
+        self.z = z
+
+
+class GazeData(object):
+    # a sample with the attributes of the SDK's gaze data objects
+
+    __slots__ = ('Timestamp', 'LeftGazePoint2D', 'LeftPupil',
+                 'LeftEyePosition3D', 'LeftValidity', 'RightGazePoint2D',
+                 'RightPupil', 'RightEyePosition3D', 'RightValidity')
+
+    def __init__(self, record):
+        self.Timestamp = int(record[0])
+        self.LeftGazePoint2D = Point2D(*record[1])
+        self.LeftPupil = float(record[2])
+        self.LeftEyePosition3D = Point3D(*record[3])
+        self.LeftValidity = int(record[4])
+        self.RightGazePoint2D = Point2D(*record[5])
+        self.RightPupil = float(record[6])
+        self.RightEyePosition3D = Point3D(*record[7])
+        self.RightValidity = int(record[8])
+
+
+class EyetrackerInfo(object):
+
+    def __init__(self, product_id, model='Simulated', given_name='simulator',
+                 generation='sim', firmware_version='0'):
+        self.product_id = product_id
+        self.model = model
+        self.given_name = given_name
+        self.generation = generation
+        self.firmware_version = firmware_version
+        # how far this tracker's clock is ahead of the local one (us)
+        self.clockOffset = 0
+
+    def __repr__(self):
+        return '<EyetrackerInfo %s (%s)>' % (self.product_id, self.model)
+
+
+class Clock(object):
+    # microseconds, like the SDK clock; the simulated tracker shares it
+
+    def get_time(self):
+        return int(time.time() * 1e6)
+
+
+class SyncManager(object):
+    # the simulated tracker runs on the local clock, plus its clockOffset
+
+    def __init__(self, clock, eyetracker_info, mainloop_thread):
+        self.clock = clock
+        self.offset = eyetracker_info.clockOffset
+
+    def convert_from_local_to_remote(self, t):
+        return t + self.offset
+
+    def convert_from_remote_to_local(self, t):
+        return t - self.offset
+
+
+class MainloopThread(object):
+    # runs callbacks on a thread of its own, like the SDK mainloop
+
+    def __init__(self):
+        self._queue = collections.deque()
+        self._condition = threading.Condition()
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._run,
+                                        name='SimulatedMainloop')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        with self._condition:
+            self._running = False
+            self._condition.notify_all()
+        if (self._thread is not None and
+                self._thread is not threading.current_thread()):
+            self._thread.join()
+
+    def post(self, function, *args):
+        with self._condition:
+            self._queue.append((function, args))
+            self._condition.notify_all()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while self._running and not self._queue:
+                    self._condition.wait()
+                if not self._running:
+                    return
+                function, args = self._queue.popleft()
+            function(*args)
+
+
+class EyetrackerBrowser(object):
+    FOUND = 1
+    REMOVED = 2
+    UPDATED = 3
+
+    # set by SimulatedBackend
+    trackers = ()
+
+    def __init__(self, mainloop_thread, callback):
+        self.callback = callback
+        for info in self.trackers:
+            mainloop_thread.post(callback, self.FOUND, info.product_id, info)
+
+    def stop(self):
+        pass
+
+
+class Event(object):
+    # an SDK style event: handlers are added with += and removed with -=
+
+    def __init__(self):
+        self.handlers = []
+
+    def __iadd__(self, handler):
+        self.handlers = self.handlers + [handler]
+        return self
+
+    def __isub__(self, handler):
+        self.handlers = [h for h in self.handlers if h != handler]
+        return self
+
+    def __call__(self, *args):
+        for handler in self.handlers:
+            handler(*args)
+
+
+class Events(object):
+
+    def __init__(self):
+        self.OnGazeDataReceived = Event()
+
+
+class CalibrationPlotItem(object):
+
+    def __init__(self, true_point, left, right):
+        self.true_point = true_point
+        self.left = left
+        self.right = right
+
+
+class CalibrationPlotEye(object):
+
+    def __init__(self, status, map_point):
+        self.status = status
+        self.map_point = map_point
+
+
+class Calibration(object):
+    # Like the SDK's, made from the raw calibration data. Here that is JSON
+    # with a row [x, y, leftStatus, leftX, leftY, rightStatus, rightX,
+    # rightY] per sample.
+
+    def __init__(self, rawData):
+        self.rawData = rawData
+        self.plot_data = []
+        truePoints = {}
+        for row in json.loads(rawData):
+            x, y = row[0], row[1]
+            if (x, y) not in truePoints:
+                truePoints[x, y] = Point2D(x, y)
+            self.plot_data.append(CalibrationPlotItem(
+                truePoints[x, y],
+                CalibrationPlotEye(int(row[2]), Point2D(row[3], row[4])),
+                CalibrationPlotEye(int(row[5]), Point2D(row[6], row[7]))))
+
+
+class Eyetracker(object):
+    # Delivers samples from a SampleSource on a thread while tracking.
+    # Calibration calls answer through the mainloop like the SDK does.
+
+    def __init__(self, mainloop_thread, info, source, samplingRate,
+                 calibrationError, calibrationSamples):
+        self.mainloop_thread = mainloop_thread
+        self.info = info
+        self.source = source
+        self.samplingRate = samplingRate
+        self.calibrationError = calibrationError
+        self.calibrationSamples = calibrationSamples
+        self.events = Events()
+        self.illuminationMode = None
+        self._tracking = False
+        self._thread = None
+        self._points = []
+        self._calibration = None
+        self._rng = np.random.RandomState()
+
+    @classmethod
+    def create_async(cls, mainloop_thread, eyetracker_info, callback):
+        backend = eyetracker_info.backend
+        eyetracker = cls(mainloop_thread, eyetracker_info,
+                         eyetracker_info.source, backend.samplingRate,
+                         backend.calibrationError,
+                         backend.calibrationSamples)
+        mainloop_thread.post(callback, 0, eyetracker)
+
+    def _reply(self, callback, error=0, result=None):
+        if callback is not None:
+            self.mainloop_thread.post(callback, error, result)
+
+    # tracking
+    def StartTracking(self, callback=None):
+        if not self._tracking:
+            self._tracking = True
+            self._thread = threading.Thread(target=self._stream,
+                                            name='SimulatedEyetracker')
+            self._thread.daemon = True
+            self._thread.start()
+        self._reply(callback)
+
+    def StopTracking(self, callback=None):
+        self._tracking = False
+        if (self._thread is not None and
+                self._thread is not threading.current_thread()):
+            self._thread.join()
+        self._thread = None
+        self._reply(callback)
+
+    def _stream(self):
+        # emits every sample that is due, then sleeps until the next one;
+        # timestamps are exact multiples of the sampling period
+        period = 1e6 / self.samplingRate
+        start = int(time.time() * 1e6)
+        n = 0
+        while self._tracking:
+            due = int((time.time() * 1e6 - start) / period) + 1
+            while n < due and self._tracking:
+                record = self.source.next(int(start + n * period) +
+                                          self.info.clockOffset)
+                self.events.OnGazeDataReceived(0, GazeData(record))
+                n += 1
+            wait = (start + n * period) / 1e6 - time.time()
+            if wait > 0:
+                time.sleep(wait)
+
+    # calibration
+    def StartCalibration(self, callback=None):
+        self._reply(callback)
+
+    def StopCalibration(self, callback=None):
+        self._reply(callback)
+
+    def ClearCalibration(self, callback=None):
+        self._points = []
+        self._reply(callback)
+
+    def AddCalibrationPoint(self, point, callback=None):
+        self._points.append((point.x, point.y))
+        self._reply(callback)
+
+    def RemoveCalibrationPoint(self, point, callback=None):
+        self._points = [p for p in self._points if
+                        (abs(p[0] - point.x) > 1e-6 or
+                         abs(p[1] - point.y) > 1e-6)]
+        self._reply(callback)
+
+    def ComputeCalibration(self, callback=None):
+        if len(self._points) < 2:
+            self._calibration = None
+            self._reply(callback, 0x20000502)
+            return
+        rows = []
+        for x, y in self._points:
+            for i in range(self.calibrationSamples):
+                error = self._rng.normal(0, self.calibrationError, 4)
+                rows.append([x, y, 1, x + error[0], y + error[1],
+                             1, x + error[2], y + error[3]])
+        self._calibration = Calibration(json.dumps(rows))
+        self._reply(callback)
+
+    def GetCalibration(self, callback=None):
+        if self._calibration is None:
+            self._reply(callback, 0x20000502)
+        else:
+            self._reply(callback, 0, self._calibration)
+
+    def SetCalibration(self, calibration, callback=None):
+        self._calibration = calibration
+        self._points = []
+        if calibration is not None:
+            for item in calibration.plot_data:
+                point = (item.true_point.x, item.true_point.y)
+                if point not in self._points:
+                    self._points.append(point)
+        self._reply(callback)
+
+    def SetIlluminationMode(self, mode, callback=None):
+        self.illuminationMode = mode
+        self._reply(callback)
+
+
+class SyntheticSource(object):
+    # Fixations at random positions, joined by saccades, with noise and the
+    # occasional blink. Returns tuples in SAMPLE_DTYPE order.
+
+    def __init__(self, seed=None, noise=0.003, fixationDuration=(0.15, 0.5),
+                 saccadeDuration=0.03, blinkRate=0.2, blinkDuration=0.1):
+        self.rng = np.random.RandomState(seed)
+        self.noise = noise
+        self.fixationDuration = fixationDuration
+        self.saccadeDuration = saccadeDuration
+        self.blinkRate = blinkRate
+        self.blinkDuration = blinkDuration
+        self._target = np.array([0.5, 0.5])
+        self._from = self._target
+        self._segmentEnd = None
+        self._saccadeEnd = None
+        self._blinkEnd = None
+
+    def _newFixation(self, t):
+        self._from = self._target
+        self._target = self.rng.uniform(0.1, 0.9, 2)
+        self._saccadeEnd = t + self.saccadeDuration * 1e6
+        self._segmentEnd = self._saccadeEnd + \
+            self.rng.uniform(*self.fixationDuration) * 1e6
+        if self.rng.uniform() < self.blinkRate:
+            self._blinkEnd = self._saccadeEnd + self.blinkDuration * 1e6
+        else:
+            self._blinkEnd = None
+
+    def next(self, t):
+        if self._segmentEnd is None or t >= self._segmentEnd:
+            self._newFixation(t)
+        if t < self._saccadeEnd:
+            progress = 1 - (self._saccadeEnd - t) / (self.saccadeDuration * 1e6)
+            gaze = self._from + (self._target - self._from) * progress
+        else:
+            gaze = self._target
+        left = gaze + self.rng.normal(0, self.noise, 2)
+        right = gaze + self.rng.normal(0, self.noise, 2)
+        eyes = self.rng.normal(0, 1.0, 3)
+        validity = 0
+        if (self._blinkEnd is not None and self._saccadeEnd <= t and
+                t < self._blinkEnd):
+            validity = 4
+        return (t, tuple(left), 3.0 + eyes[0] * 0.05,
+                (-30.0 + eyes[0], eyes[1], 600.0 + eyes[2]), validity,
+                tuple(right), 3.0 + eyes[1] * 0.05,
+                (30.0 + eyes[0], eyes[1], 600.0 + eyes[2]), validity)
+
+
+class ReplaySource(object):
+    # Replays the samples of a recording (a recording.Recording, its file
+    # name, or an array of SAMPLE_DTYPE records) with new timestamps,
+    # starting over at the end if loop is True.
+
+    def __init__(self, samples, loop=True):
+        if not hasattr(samples, 'dtype'):
+            from recording import Recording
+            samples = Recording(samples).samples
+        self.samples = np.asarray(samples, dtype=SAMPLE_DTYPE)
+        if len(self.samples) == 0:
+            raise ValueError("There are no samples to replay.")
+        self.loop = loop
+        self._index = 0
+
+    def next(self, t):
+        if self._index >= len(self.samples):
+            if not self.loop:
+                # keep repeating a sample without valid eyes
+                record = list(self.samples[-1].tolist())
+                record[0], record[4], record[8] = t, 4, 4
+                return tuple(record)
+            self._index = 0
+        record = self.samples[self._index].tolist()
+        self._index += 1
+        return (t,) + tuple(record[1:])
+
+
+class SimulatedBackend(object):
+    # A stand-in for backends.TobiiBackend. source is None (synthetic
+    # gaze), a SyntheticSource / ReplaySource, or a recording to replay.
+    # With trackers > 1 there are several trackers (SIM-0001, SIM-0002, ...
+    # or productId-1, -2, ...), each with its own copy of the source and a
+    # clock 1 s ahead of the one before.
+
+    def __init__(self, samplingRate=300, source=None, productId=None,
+                 model='Simulated', calibrationError=0.01,
+                 calibrationSamples=10, trackers=1):
+        if not 0 < samplingRate <= 1200:
+            raise ValueError("The sampling rate has to be up to 1200 Hz.")
+        if source is None:
+            source = SyntheticSource()
+        elif not hasattr(source, 'next'):
+            source = ReplaySource(source)
+        self.samplingRate = samplingRate
+        self.source = source
+        self.calibrationError = calibrationError
+        self.calibrationSamples = calibrationSamples
+        infos = []
+        for i in range(trackers):
+            if productId is None:
+                name = 'SIM-%04d' % (i + 1)
+            elif trackers == 1:
+                name = productId
+            else:
+                name = '%s-%d' % (productId, i + 1)
+            info = EyetrackerInfo(name, model=model)
+            if i == 0:
+                info.source = source
+            else:
+                info.source = copy.deepcopy(source)
+                info.clockOffset = i * 1000000
+                if isinstance(source, SyntheticSource):
+                    info.source.rng = np.random.RandomState()
+            info.backend = self
+            infos.append(info)
+        self.Clock = Clock
+        self.MainloopThread = MainloopThread
+        self.SyncManager = SyncManager
+        self.Eyetracker = Eyetracker
+        self.Point2D = Point2D
+        self.Calibration = Calibration
+        # each backend gets its own browser class listing its trackers
+        self.EyetrackerBrowser = type('EyetrackerBrowser',
+                                      (EyetrackerBrowser,),
+                                      {'trackers': tuple(infos)})
+
+    def init(self):
+        pass
@@ -4,51 +4,124 @@
 # author: Hiroyuki Sogo
 #         Modified by Soyogu Matsushita
 #         Further modified by Jan Freyberg
-# - Tobii SDK 3.0 is required
+# - Tobii SDK 3.0 is required (or the simulator, see simulator.py)
 # - no guarantee
 #
 
-from tobii.eye_tracking_io.basic import EyetrackerException
+from __future__ import print_function
 
-import datetime
-
-import tobii.eye_tracking_io.mainloop
-import tobii.eye_tracking_io.browsing
-import tobii.eye_tracking_io.eyetracker
-import tobii.eye_tracking_io.time.clock
-import tobii.eye_tracking_io.time.sync
-
-from tobii.eye_tracking_io.types import Point2D
-
-import psychopy.visual
-import psychopy.event
-import psychopy.core
-import psychopy.monitors
-from psychopy.tools.monitorunittools import deg2pix
+import threading
+import timeit
 
 import numpy as np
 
+from gazebuffer import (GazeBuffer, SampleCursor, unpack_gaze, epoch_times,
+                        average_point, average_gaze)
+from datawriter import CsvWriter, StreamingWriter
+from recording import BinaryWriter
+from segments import SegmentWriter
+from eventdetection import IVTDetector, IDTDetector
+from aoi import AOIRegistry
+import conditions
+import filters
+import backends
+from instrumentation import Instrumentation
+from transforms import ScreenTransform
+from futures import CallbackFuture
+from calibrationplot import CalibrationPlot, plot_arrays
+from calibrationquality import (calibration_quality, binocular_quality,
+                                failing_points)
+from multitracker import TrackerStream, merge_streams, MULTI_SAMPLE_DTYPE
+from sharedstream import GazePublisher
+from heatmap import Heatmap
+
+# psychopy is imported when the first controller is made (see
+# import_psychopy), so this module can be imported without a display
+psychopy = None
+deg2pix = None
+
+
+def import_psychopy():
+    global psychopy, deg2pix
+    if psychopy is None:
+        import psychopy.visual
+        import psychopy.event
+        import psychopy.core
+        import psychopy.monitors
+        from psychopy.tools.monitorunittools import deg2pix
+
 
 class TobiiController:
 
-    def __init__(self, win):
+    def __init__(self, win, bufferCapacity=None, backend=None):
+        # bufferCapacity=None keeps every sample of a recording; an integer
+        # turns the sample store into a ring holding the newest samples only.
+        # backend defaults to the Tobii SDK (backends.TobiiBackend); pass
+        # a simulator.SimulatedBackend to run without a tracker
+        import_psychopy()
         self.eyetracker = None
+        self.eyetracker_info = None
         self.eyetrackers = {}
         self.win = win
-        self.gazeData = []
+        # window size and monitor geometry, read once (see acsd2pix and
+        # getGazeData)
+        self.transform = ScreenTransform.fromWindow(win)
+        self.gazeData = GazeBuffer(capacity=bufferCapacity)
         self.eventData = []
         self.datafile = None
-
-        tobii.eye_tracking_io.init()
-        self.clock = tobii.eye_tracking_io.time.clock.Clock()
-        self.mainloop_thread = tobii.eye_tracking_io.mainloop.MainloopThread()
+        self.eventDetector = None
+        # areas of interest, in the pixel space of acsd2pix
+        self.aois = AOIRegistry(tuple(win.size))
+        # gaze conditions checked on every sample (see waitForCondition)
+        self.conditions = []
+        self.gazeFilter = None
+        self.bufferCapacity = bufferCapacity
+        self.instrumentation = None
+        self.syncmanager = None
+        # set while at least one eye tracker is known
+        self.trackerFound = threading.Event()
+        # the eye trackers of multi-tracker mode (see activateAll)
+        self.streams = []
+        # continuous recording (see startSession): True while a session
+        # runs, and its trials as dicts of name, start and end timestamps
+        self.session = False
+        self.trials = []
+        # True between startTracking and stopTracking
+        self.tracking = False
+        # True while the helpers track for themselves (see
+        # _startGazeTracking)
+        self.helperTracking = False
+        # the cursor of getNewSamples, made on first use
+        self.sampleCursor = None
+        # shared-memory stream for other processes (see startPublishing)
+        self.publisher = None
+        # gaze heatmap of the session and the cursor feeding it (see
+        # setHeatmap)
+        self.heatmap = None
+        self.heatmapCursor = None
+        # the last calibration and its points (ACSD)
+        self.calib = None
+        self.points = None
+        self.calibrationPlot = None
+        # quality (calibrationquality.Quality) of the last calibration and
+        # validation, and the limits for accepting a calibration without
+        # asking (see setAutoAccept)
+        self.calibrationQuality = None
+        self.validationQuality = None
+        self.autoAccept = None
+
+        if backend is None:
+            backend = backends.TobiiBackend()
+        self.backend = backend
+        self.backend.init()
+        self.clock = self.backend.Clock()
+        self.mainloop_thread = self.backend.MainloopThread()
         self.mainloop_thread.start()
-        self.browser = tobii.eye_tracking_io.browsing.EyetrackerBrowser(
+        self.browser = self.backend.EyetrackerBrowser(
             self.mainloop_thread, self.on_eyetracker_browser_event)
 
     def waitForFindEyeTracker(self):
-        while len(self.eyetrackers.keys()) == 0:
-            psychopy.core.wait(0.1)
+        while not self.trackerFound.wait(0.01):
             if psychopy.event.getKeys(keyList=['escape']):
                 raise KeyboardInterrupt("You interrupted the script.")
 
@@ -58,8 +131,9 @@ class TobiiController:
                                     eyetracker_info):
         # When a new eyetracker is found we add it to the treeview and to the
         # internal list of eyetracker_info objects
-        if event_type is tobii.eye_tracking_io.browsing.EyetrackerBrowser.FOUND:
+        if event_type is self.backend.EyetrackerBrowser.FOUND:
             self.eyetrackers[eyetracker_info.product_id] = eyetracker_info
+            self.trackerFound.set()
             return False
 
         # Otherwise we remove the tracker from the treeview and the
@@ -67,11 +141,24 @@ class TobiiController:
         del self.eyetrackers[eyetracker_info.product_id]
 
         # ...and add it again if it is an update message
-        if event_type is (tobii.eye_tracking_io.browsing.
-                          EyetrackerBrowser.UPDATED):
+        if event_type is self.backend.EyetrackerBrowser.UPDATED:
             self.eyetrackers[eyetracker_info.product_id] = eyetracker_info
+        if not self.eyetrackers:
+            self.trackerFound.clear()
         return False
 
+    def getTrackerInfo(self, eyetracker_info=None):
+        # returns the details of the activated eye tracker (or of
+        # eyetracker_info) as a dict
+        if eyetracker_info is None:
+            eyetracker_info = self.eyetracker_info
+        info = {}
+        for key in ('product_id', 'given_name', 'model', 'generation',
+                    'firmware_version'):
+            if hasattr(eyetracker_info, key):
+                info[key] = str(getattr(eyetracker_info, key))
+        return info
+
     def destroy(self):
         self.eyetracker = None
         self.browser.stop()
@@ -83,36 +170,143 @@ class TobiiController:
     ############################################################################
     def activate(self, eyetracker):
         eyetracker_info = self.eyetrackers[eyetracker]
-        print "Connecting to:", eyetracker_info
-        (tobii.eye_tracking_io.
-         eyetracker.Eyetracker.
-         create_async(self.mainloop_thread,
-                      eyetracker_info, lambda error,
-                      eyetracker: self.on_eyetracker_created(error,
-                                                             eyetracker,
-                                                             eyetracker_info)))
-
-        while self.eyetracker is None:
-            psychopy.core.wait(0.1)
-            if psychopy.event.getKeys(keyList=['escape']):
-                raise KeyboardInterrupt("You interrupted the script.")
-        self.syncmanager = tobii.eye_tracking_io.time.sync.SyncManager(
+        print("Connecting to:", eyetracker_info)
+        future = CallbackFuture(
+            lambda error, eyetracker: self.on_eyetracker_created(
+                error, eyetracker, eyetracker_info))
+        self.backend.Eyetracker.create_async(
+            self.mainloop_thread, eyetracker_info, future.callback)
+        # check this connection's own result: a tracker connected before
+        # stays in self.eyetracker if it fails
+        if self.waitForFuture(future) is None or future.error:
+            raise ValueError("Could not connect to %s." % eyetracker_info)
+        self.eyetracker_info = eyetracker_info
+        self.syncmanager = self.backend.SyncManager(
             self.clock, eyetracker_info, self.mainloop_thread)
 
     def on_eyetracker_created(self, error, eyetracker, eyetracker_info):
         if error:
-            print ("Connection to %s failed because "
-                   "of an exception: %s") % (eyetracker_info, error)
+            print(("Connection to %s failed because "
+                   "of an exception: %s") % (eyetracker_info, error))
             if error == 0x20000402:
-                print ("The selected unit is too old, a unit which "
+                print(("The selected unit is too old, a unit which "
                        "supports protocol version 1.0 is required.\n\n"
-                       "<b>Details:</b> <i>%s</i>") % error
+                       "<b>Details:</b> <i>%s</i>") % error)
             else:
-                print "Could not connect to %s" % (eyetracker_info)
+                print("Could not connect to %s" % (eyetracker_info))
             return False
 
         self.eyetracker = eyetracker
 
+    def activateAll(self, productIds=None):
+        # multi-tracker mode: connects to several eye trackers at once
+        # (default: all that were found). each gets its own sync manager
+        # and buffer (self.streams[i].buffer) with timestamps on the local
+        # clock; startTracking / stopTracking then run all of them, and
+        # the data file gets one time-ordered recording of all trackers.
+        # the tracker chosen with selectTracker (the first to begin with)
+        # is the one calibrated and read by the other methods
+        if productIds is None:
+            productIds = sorted(self.eyetrackers.keys())
+        # connect to all trackers before waiting for any
+        pending = []
+        for productId in productIds:
+            eyetracker_info = self.eyetrackers[productId]
+            print("Connecting to:", eyetracker_info)
+            future = CallbackFuture()
+            self.backend.Eyetracker.create_async(
+                self.mainloop_thread, eyetracker_info, future.callback)
+            pending.append((eyetracker_info, future))
+        self.streams = []
+        for index, (eyetracker_info, future) in enumerate(pending):
+            eyetracker = self.waitForFuture(future)
+            if future.error or eyetracker is None:
+                raise ValueError("Could not connect to %s." % eyetracker_info)
+            syncmanager = self.backend.SyncManager(
+                self.clock, eyetracker_info, self.mainloop_thread)
+            self.streams.append(TrackerStream(index, eyetracker_info,
+                                              eyetracker, syncmanager,
+                                              self.bufferCapacity))
+        self.selectTracker(0)
+
+    def selectTracker(self, index):
+        # in multi-tracker mode, makes stream index the tracker that is
+        # calibrated, feeds gazeData and is used by the other methods
+        if self.tracking or self.helperTracking:
+            raise ValueError("The tracker can't be changed while tracking.")
+        stream = self.streams[index]
+        self.eyetracker = stream.eyetracker
+        self.eyetracker_info = stream.info
+        self.syncmanager = stream.syncmanager
+
+    def getMergedData(self):
+        # multi-tracker mode: the samples of all trackers in time order
+        # (local clock), with the index of the tracker in the 'tracker'
+        # field (see multitracker.py)
+        return merge_streams(self.streams)
+
+    def waitForFuture(self, future, timeout=None):
+        # waits for the SDK to reply to a call (see futures.py) and returns
+        # the result, or None on timeout. wakes up as soon as the reply
+        # arrives; escape aborts the wait
+        if timeout is not None:
+            deadline = timeit.default_timer() + timeout
+        while not future.wait(0.01):
+            if psychopy.event.getKeys(keyList=['escape']):
+                raise KeyboardInterrupt("You interrupted the script.")
+            if timeout is not None and timeit.default_timer() > deadline:
+                return None
+        return future.value
+
+    def _sdkCall(self, method, handler, *args):
+        # calls an SDK method with a future as its callback; handler is the
+        # controller's own callback, run before the future completes
+        future = CallbackFuture(handler)
+        method(*args, callback=future.callback)
+        return future
+
+    # The following return a futures.CallbackFuture that completes when the
+    # eye tracker replies
+    def startCalibrationAsync(self):
+        self.initcalibration_completed = False
+        return self._sdkCall(self.eyetracker.StartCalibration,
+                             self.on_calib_start)
+
+    def clearCalibrationAsync(self):
+        self.deletecalibration_completed = False
+        return self._sdkCall(self.eyetracker.ClearCalibration,
+                             self.on_calib_deleted)
+
+    def addCalibrationPointAsync(self, point):
+        # point is a backend Point2D in ACSD
+        self.add_point_completed = False
+        return self._sdkCall(self.eyetracker.AddCalibrationPoint,
+                             self.on_add_completed, point)
+
+    def removeCalibrationPointAsync(self, point):
+        return self._sdkCall(self.eyetracker.RemoveCalibrationPoint, None,
+                             point)
+
+    def computeCalibrationAsync(self):
+        self.computeCalibration_completed = False
+        self.computeCalibration_succeeded = False
+        return self._sdkCall(self.eyetracker.ComputeCalibration,
+                             self.on_calib_compute)
+
+    def getCalibrationAsync(self):
+        self.getcalibration_completed = False
+        return self._sdkCall(self.eyetracker.GetCalibration,
+                             self.on_calib_response)
+
+    def setIlluminationAsync(self, mode):
+        self.illuminationChanged = False
+        return self._sdkCall(self.eyetracker.SetIlluminationMode,
+                             self.on_illumchange, mode)
+
+    def setCalibrationAsync(self, calibration):
+        return self._sdkCall(self.eyetracker.SetCalibration, None,
+                             calibration)
+
     ############################################################################
     # calibration methods
     ############################################################################
@@ -122,6 +316,8 @@ class TobiiController:
         # eyes on the screen for the researcher to see.
         if self.eyetracker is None:
             return
+        if self.session:
+            raise ValueError("findEyes can't be used during a session.")
 
         # Set default colors
         self.correctColor = (-1.0, 1.0, -1.0)
@@ -146,37 +342,39 @@ class TobiiController:
                                             units='norm', lineWidth=3,
                                             width=0.5, height=0.5,
                                             autoDraw=True)
-        # Start tracking
-        self.datafile = None  # we don't want to save this data
-        self.startTracking()
+        # Start tracking (without saving the data)
+        started = self._startGazeTracking()
         psychopy.core.wait(0.1)
         self.response = []
-        while not self.response:
-            self.lxyz, self.rxyz = self.getCurrentEyePosition()
-            # update the left eye if the values are reasonable
-            self.leftStim.pos = (self.lxyz[0] / 10,
-                                 self.lxyz[1] / 10)
-            # update the right eye if the values are reasonable
-            self.rightStim.pos = (self.rxyz[0] / 10,
-                                  self.rxyz[1] / 10)
-            # update the distance if the values are reasonable
-            self.distance = np.mean([self.lxyz[2], self.rxyz[2]]) / 10
-            if self.distance > 56 and self.distance < 64:
-                # correct distance
-                self.findmsg.color = (-1, 1, -1)
-            else:
-                # not really correct
-                self.findmsg.color = (1, 1, 0.2)
-            self.findmsg.text = "You're currently " + \
-                                str(int(self.distance)) + \
-                                ("cm away from the screen.\n"
-                                 "Press space to calibrate or "
-                                 "esc to abort.")
-            self.win.flip()
-            self.response = psychopy.event.getKeys(keyList=['space', 'escape'])
-            psychopy.core.wait(0.01)
-        # Once responded, stop tracking
-        self.stopTracking()
+        try:
+            while not self.response:
+                self.lxyz, self.rxyz = self.getCurrentEyePosition()
+                # update the left eye if the values are reasonable
+                self.leftStim.pos = (self.lxyz[0] / 10,
+                                     self.lxyz[1] / 10)
+                # update the right eye if the values are reasonable
+                self.rightStim.pos = (self.rxyz[0] / 10,
+                                      self.rxyz[1] / 10)
+                # update the distance if the values are reasonable
+                self.distance = np.mean([self.lxyz[2], self.rxyz[2]]) / 10
+                if self.distance > 56 and self.distance < 64:
+                    # correct distance
+                    self.findmsg.color = (-1, 1, -1)
+                else:
+                    # not really correct
+                    self.findmsg.color = (1, 1, 0.2)
+                self.findmsg.text = "You're currently " + \
+                                    str(int(self.distance)) + \
+                                    ("cm away from the screen.\n"
+                                     "Press space to calibrate or "
+                                     "esc to abort.")
+                self.win.flip()
+                self.response = psychopy.event.getKeys(
+                    keyList=['space', 'escape'])
+                psychopy.core.wait(0.01)
+        finally:
+            # Once responded, stop tracking
+            self._stopGazeTracking(started)
         if 'escape' in self.response:
             raise KeyboardInterrupt("You interrupted the script manually.")
         else:
@@ -192,7 +390,12 @@ class TobiiController:
     def doCalibration(self, calibrationPoints=[(0.5, 0.5), (0.1, 0.9),
                                                (0.1, 0.1), (0.9, 0.9),
                                                (0.9, 0.1)],
-                      calinRadius=2.0, caloutRadius=None, moveFrames=60):
+                      calinRadius=2.0, caloutRadius=None, moveFrames=60,
+                      adaptive=False, maxError=1.0):
+        # with adaptive, a retry only presents the points that failed in
+        # the previous calibration (no valid data, or an error above
+        # maxError degrees) and keeps the data of the others. each point
+        # is added as soon as gaze is stable instead of after fixed waits
         if self.eyetracker is None:
             return
 
@@ -203,36 +406,56 @@ class TobiiController:
             calibrationPoints = [(0.5, 0.5), (0.1, 0.9),
                                  (0.1, 0.1), (0.9, 0.9), (0.9, 0.1)]
 
-        self.points = np.random.permutation(calibrationPoints)
+        # in adaptive mode, find the points of the last calibration to redo
+        redo = None
+        if (adaptive and self.calib is not None and
+                self.points is not None and
+                sorted(map(tuple, self.points)) ==
+                sorted(map(tuple, calibrationPoints))):
+            transform = None
+            if self._calibrationQuality() is not None:
+                transform = self.transform
+            failing = failing_points(self.calib, self.points, transform,
+                                     maxError)
+            if failing.any() and not failing.all():
+                redo = self.points[failing]
+        if redo is None:
+            self.points = np.random.permutation(calibrationPoints)
+            presented = self.points
+        else:
+            presented = redo
 
         # Make the "outer" circle
         self.calout = psychopy.visual.Circle(self.win, radius=caloutRadius,
                                              lineColor=(0, 1.0, 0),
                                              fillColor=(0.5, 1.0, 0.5),
                                              units='pix', autoDraw=True,
-                                             pos=self.acsd2pix(self.points[-1]))
+                                             pos=self.acsd2pix(presented[-1]))
         # Make a dummy message
         self.calmsg = psychopy.visual.TextStim(self.win, color=0.0,
                                                units='norm', height=0.07,
                                                pos=(0.0, -0.5))
 
         # Put the eye tracker into the calibration state
-        self.initcalibration_completed = False
-        print "Start new calibration..."
-        self.eyetracker.StartCalibration(callback=self.on_calib_start)
-        while not self.initcalibration_completed:
-            psychopy.core.wait(0.1)
-            if psychopy.event.getKeys(keyList=['escape']):
-                raise KeyboardInterrupt("You interrupted the script.")
-        self.deletecalibration_completed = False
-        # Clear out previous calibrations (tobii scanners
-        # sometimes store these across many sessions)
-        print "Delete old calibration..."
-        self.eyetracker.ClearCalibration(callback=self.on_calib_deleted)
-        while not self.deletecalibration_completed:
-            psychopy.core.wait(0.1)
-            if psychopy.event.getKeys(keyList=['escape']):
-                raise KeyboardInterrupt("You interrupted the script.")
+        print("Start new calibration...")
+        self.waitForFuture(self.startCalibrationAsync())
+        if not self.initcalibration_completed:
+            raise ValueError("Could not start calibration!")
+        if redo is None:
+            # Clear out previous calibrations (tobii scanners
+            # sometimes store these across many sessions)
+            print("Delete old calibration...")
+            self.waitForFuture(self.clearCalibrationAsync())
+            if not self.deletecalibration_completed:
+                raise ValueError("Could not delete calibration!")
+        else:
+            # only drop the data of the points that are presented again
+            print("Recalibrating %d of %d points..." % (len(redo),
+                                                        len(self.points)))
+            for point in redo:
+                p = self.backend.Point2D()
+                p.x, p.y = point
+                self.waitForFuture(self.removeCalibrationPointAsync(p))
 
         # Draw instructions and wait for space key
         self.calmsg.text = ("Please focus your eyes on the green dot, and "
@@ -243,73 +466,88 @@ class TobiiController:
         self.win.flip()
         psychopy.event.waitKeys(keyList=['space'])
 
-        # Go through the calibration points
-        for self.point_index in range(len(self.points)):
-            # The dot starts at the previous point
-            self.calout.pos = \
-                self.acsd2pix((self.points[self.point_index - 1][0],
-                               self.points[self.point_index - 1][1]))
-            # The steps for the movement is new - old divided by frames
-            self.step = (self.acsd2pix((self.points[self.point_index][0],
-                                        self.points[self.point_index][1])) -
-                         self.calout.pos) / moveFrames
-
-            # Create a tobii 2D class
-            p = Point2D()
-            # Add the X and Y coordinates to the tobii point
-            p.x, p.y = self.points[self.point_index]
-
-            # Move the point in position (smooth pursuit)
-            for frame in range(moveFrames):
-                self.calout.pos += self.step
-                # draw & flip
-                self.win.flip()
-
-            # Shrink the outer point (gaze fixation)
-            for frame in range(moveFrames / 2):
-                self.calout.radius -= (caloutRadius -
-                                       calinRadius) / (moveFrames / 2)
-                self.win.flip()
-
-            # Add this point to the tobii
-            psychopy.core.wait(1)  # first wait to let the eyes settle (MIN 0.5)
-            self.add_point_completed = False  # this gets updated by callback
-            self.eyetracker.AddCalibrationPoint(p,
-                                                callback=self.on_add_completed)
-            # While this point is being added, do nothing:
-            while not self.add_point_completed:
-                psychopy.core.wait(0.1)
-                if psychopy.event.getKeys(keyList=['escape']):
-                    raise KeyboardInterrupt("You interrupted the script.")
-            psychopy.core.wait(0.5)  # wait before continuing
-
-            # Reset the radius of the large circle
-            self.calout.radius = caloutRadius
+        started = False
+        if adaptive:
+            # gaze is needed to see when the eyes have settled
+            started = self._startGazeTracking()
+            settled = conditions.Stable(deg2pix(1.0, self.win.monitor), 200)
+
+        # Go through the calibration points (tracking is stopped and the
+        # data file restored even if escape is pressed)
+        try:
+            for self.point_index in range(len(presented)):
+                # The dot starts at the previous point
+                self.calout.pos = \
+                    self.acsd2pix((presented[self.point_index - 1][0],
+                                   presented[self.point_index - 1][1]))
+                # The steps for the movement is new - old divided by frames
+                self.step = (self.acsd2pix((presented[self.point_index][0],
+                                            presented[self.point_index][1])) -
+                             self.calout.pos) / moveFrames
+
+                # Create a tobii 2D class
+                p = self.backend.Point2D()
+                # Add the X and Y coordinates to the tobii point
+                p.x, p.y = presented[self.point_index]
+
+                # Move the point in position (smooth pursuit)
+                for frame in range(moveFrames):
+                    self.calout.pos += self.step
+                    # draw & flip
+                    self.win.flip()
+
+                # Shrink the outer point (gaze fixation)
+                for frame in range(moveFrames // 2):
+                    self.calout.radius -= (caloutRadius -
+                                           calinRadius) / (moveFrames // 2)
+                    self.win.flip()
+
+                # Add this point to the tobii
+                if adaptive:
+                    # as soon as gaze is stable (at most the fixed wait)
+                    self.waitForCondition(settled, timeout=1.0)
+                else:
+                    psychopy.core.wait(1)  # first wait to let the eyes settle (MIN 0.5)
+                # While this point is being added, do nothing:
+                future = self.addCalibrationPointAsync(p)
+                self.waitForFuture(future)
+                if future.error:
+                    raise ValueError("Could not add calibration point "
+                                     "(0x%0x)." % future.error)
+                if not adaptive:
+                    psychopy.core.wait(0.5)  # wait before continuing
+
+                # Reset the radius of the large circle
+                self.calout.radius = caloutRadius
+        finally:
+            self._stopGazeTracking(started)
 
         # After calibration, make sure the stimuli aren't drawn
         self.calout.autoDraw = False
         self.calout = None
 
-        # The following two will be set by the tobii SDK
-        self.computeCalibration_completed = False
-        self.computeCalibration_succeeded = False
-        # Do the computation
-        self.eyetracker.ComputeCalibration(self.on_calib_compute)
-        while not self.computeCalibration_completed:
-            psychopy.core.wait(0.1)
-            if psychopy.event.getKeys(keyList=['escape']):
-                raise KeyboardInterrupt("You interrupted the script.")
+        # Do the computation (sets computeCalibration_succeeded). too little
+        # data is offered as a retry below; any other error is fatal
+        future = self.computeCalibrationAsync()
+        self.waitForFuture(future)
         self.eyetracker.StopCalibration(None)
+        if future.error and future.error != 0x20000502:
+            raise ValueError("Could not compute calibration (0x%0x)." %
+                             future.error)
 
         self.win.flip()
 
-        # Now we retrieve the calibration data
-        self.getcalibration_completed = False
-        self.calib = self.eyetracker.GetCalibration(self.on_calib_response)
-        while not self.getcalibration_completed:
-            psychopy.core.wait(0.1)
-            if psychopy.event.getKeys(keyList=['escape']):
-                raise KeyboardInterrupt("You interrupted the script.")
+        # Now we retrieve the calibration data (there is none to get when
+        # the computation failed)
+        future = self.getCalibrationAsync()
+        self.calib = self.waitForFuture(future)
+        if self.computeCalibration_succeeded:
+            if future.error:
+                raise ValueError("Could not get calibration (0x%0x)." %
+                                 future.error)
+            if self.calib is None:
+                raise ValueError("The eye tracker returned no calibration.")
+        self.calibrationQuality = None
 
         if not self.computeCalibration_succeeded:
             # computeCalibration failed.
@@ -321,58 +559,46 @@ class TobiiController:
                                 "(Retry:[r] Abort:[ESC])")
         else:
             # calibration seems to have worked out
-            points = {}
-            for data in self.calib.plot_data:
-                points[data.true_point] = {'left': data.left,
-                                           'right': data.right}
-
-            if len(points) == 0:
+            if len(self.calib.plot_data) == 0:
                 # no points in the calibration results
                 self.calmsg.text = ("No calibration data "
                                     "(Retry:[r] Abort:[ESC])")
             else:
-                # draw the calibration result
-                for p, d in points.iteritems():
-                    psychopy.visual.Circle(self.win, radius=calinRadius,
-                                           fillColor=(1, 1, 1),
-                                           units='pix',
-                                           pos=(p.x - 0.5, 0.5 - p.y)).draw()
-                    if d['left'].status == 1:
-                        psychopy.visual.Line(self.win, units='pix',
-                                             lineColor='yellow',
-                                             start=(self.acsd2pix((p.x, p.y))),
-                                             end=(self.acsd2pix((d['left'].
-                                                                 map_point.x,
-                                                                 d['left'].
-                                                                 map_point.y)))
-                                             ).draw()
-                    if d['right'].status == 1:
-                        psychopy.visual.Line(self.win, units='pix',
-                                             lineColor='blue',
-                                             start=(self.acsd2pix((p.x, p.y))),
-                                             end=(self.acsd2pix((d['right'].
-                                                                 map_point.x,
-                                                                 d['right'].
-                                                                 map_point.y)))
-                                             ).draw()
-                for p in self.points:
-                    psychopy.visual.Circle(self.win, radius=calinRadius,
-                                           fillColor=1,
-                                           units='pix',
-                                           pos=self.acsd2pix(p),
-                                           ).draw()
-                    psychopy.visual.Circle(self.win, units='pix',
-                                           lineColor=-0.5,
-                                           radius=deg2pix(0.9,
-                                                          self.win.monitor),
-                                           pos=self.acsd2pix(p),
-                                           ).draw()
-                self.calmsg.text = ("Accept calibration results\n"
+                # draw the calibration result (the stimuli are kept for
+                # the next retry)
+                if self.calibrationPlot is None:
+                    self.calibrationPlot = CalibrationPlot(
+                        self.win, self.transform,
+                        toleranceRadius=deg2pix(0.9, self.win.monitor))
+                self.calibrationPlot.targetRadius = calinRadius
+                self.calibrationPlot.update(self.calib.plot_data,
+                                            self.points)
+                self.calibrationPlot.draw()
+                self.calibrationQuality = self._calibrationQuality()
+                self.calmsg.text = (self._qualityText(self.calibrationQuality)
+                                    + "Accept calibration results\n"
                                     "(Accept:[a] Retry:[r] Abort:[ESC])")
 
         # Update the screen, then wait for response
         self.calmsg.draw()
         self.win.flip()
+        if self.autoAccept is not None and self.calibrationQuality is not None:
+            limits = dict(self.autoAccept)
+            validate = limits.pop('validate')
+            if self.calibrationQuality.passes(**limits):
+                if not validate:
+                    return 'accept'
+                quality = self.validateCalibration()
+                if quality.passes(**limits):
+                    return 'accept'
+                # show the result again, with the validation
+                self.calibrationPlot.draw()
+                self.calmsg.text = ("Validation: " +
+                                    self._qualityText(quality) +
+                                    "Accept calibration results\n"
+                                    "(Accept:[a] Retry:[r] Abort:[ESC])")
+                self.calmsg.draw()
+                self.win.flip()
         self.response = psychopy.event.waitKeys(keyList=['a', 'r', 'escape'])
         if 'a' in self.response:
             retval = 'accept'
@@ -383,25 +609,155 @@ class TobiiController:
 
         return retval
 
+    def saveCalibration(self, store, participant):
+        # saves the last calibration in a calibrationstore.CalibrationStore
+        # under the participant and this eye tracker's product_id
+        quality = None
+        if self.calibrationQuality is not None:
+            quality = self.calibrationQuality.summary()
+        points = np.unique(plot_arrays(self.calib.plot_data)[0], axis=0)
+        store.save(participant, self.eyetracker_info.product_id,
+                   self.calib.rawData, quality, points.tolist())
+
+    def loadCalibration(self, store, participant):
+        # loads the participant's calibration for this eye tracker from a
+        # store into the eye tracker. returns False if there is none
+        stored = store.load(participant, self.eyetracker_info.product_id)
+        if stored is None:
+            return False
+        rawData, entry = stored
+        calibration = self.backend.Calibration(rawData)
+        future = self.setCalibrationAsync(calibration)
+        self.waitForFuture(future)
+        if future.error:
+            print("Could not set the stored calibration (0x%0x)" %
+                  future.error)
+            return False
+        self.calib = calibration
+        self.points = np.array(entry['points'])
+        self.calibrationQuality = self._calibrationQuality()
+        return True
+
+    def doCachedCalibration(self, store, participant, calibrationPoints=None,
+                            accuracy=1.0, rms=None, sd=None, duration=300,
+                            **kwargs):
+        # tries the participant's stored calibration first: if a quick
+        # validation (duration ms per point) is within the limits (deg), it
+        # is used as is and 'cached' is returned. otherwise doCalibration
+        # (with calibrationPoints and kwargs) runs until it is accepted
+        # ('accept', and the calibration is stored) or aborted ('abort')
+        if self.loadCalibration(store, participant):
+            try:
+                quality = self.validateCalibration(duration=duration,
+                                                   settle=200)
+            except ValueError as e:
+                # e.g. no monitor geometry: calibrate afresh instead
+                print("Could not validate the stored calibration:", e)
+            else:
+                if quality.passes(accuracy, rms, sd):
+                    return 'cached'
+        while True:
+            ret = self.doCalibration(calibrationPoints, **kwargs)
+            if ret == 'accept':
+                self.saveCalibration(store, participant)
+                return ret
+            elif ret == 'abort':
+                return ret
+
+    def _calibrationQuality(self):
+        # None if the monitor has no width or distance
+        if self.transform.sizeCm is None or self.transform.distanceCm is None:
+            return None
+        return calibration_quality(self.calib, self.transform)
+
+    def _qualityText(self, quality):
+        if quality is None:
+            return ""
+        summary = quality.summary()
+        if summary['accuracy'] is None:
+            return "No valid samples\n"
+        return ("Accuracy %.2f deg, precision %.2f deg (RMS)\n" %
+                (summary['accuracy'], summary['rms'] or 0.0))
+
+    def setAutoAccept(self, accuracy=None, rms=None, sd=None,
+                      validate=False):
+        # doCalibration accepts a calibration without asking if every
+        # point is within these limits (deg; None ignores a metric). with
+        # validate, validateCalibration has to pass the same limits too.
+        # call setAutoAccept() without limits to always ask again
+        if accuracy is None and rms is None and sd is None:
+            self.autoAccept = None
+            return
+        self.autoAccept = {'accuracy': accuracy, 'rms': rms, 'sd': sd,
+                           'validate': validate}
+
+    def validateCalibration(self, points=None, duration=500, settle=300,
+                            targetRadius=5.0):
+        # shows a target at each point (ACSD, default: the points of the
+        # last calibration) and records gaze for duration ms, after settle
+        # ms to let the eyes land. returns the accuracy and precision as a
+        # calibrationquality.Quality (also kept in validationQuality).
+        # uses tracking if it is running (e.g. in a session); otherwise
+        # starts it for the validation only, without saving the data
+        if points is None:
+            points = self.points
+        # check everything that is needed before anything is drawn
+        if points is None or len(points) == 0:
+            raise ValueError("There are no points to validate; calibrate "
+                             "first or pass points.")
+        if self.transform.sizeCm is None or self.transform.distanceCm is None:
+            raise ValueError("The monitor width and distance are needed to "
+                             "validate a calibration.")
+        target = psychopy.visual.Circle(self.win, radius=targetRadius,
+                                        fillColor=1, lineColor=1,
+                                        units='pix')
+        started = self._startGazeTracking()
+        targets = []
+        samples = []
+        try:
+            for point in points:
+                target.pos = self.acsd2pix(point)
+                target.draw()
+                self.win.flip()
+                psychopy.core.wait(settle / 1000.0)
+                latest = self.gazeData.latest()
+                tStart = 0 if latest is None else latest['timestamp'] + 1
+                psychopy.core.wait(duration / 1000.0)
+                window = np.array(self.gazeData.between(tStart))
+                samples.append(window)
+                targets.append(np.tile(point, (len(window), 1)))
+                if psychopy.event.getKeys(keyList=['escape']):
+                    raise KeyboardInterrupt("You interrupted the script.")
+        finally:
+            self._stopGazeTracking(started)
+        samples = np.concatenate(samples)
+        self.validationQuality = binocular_quality(
+            np.concatenate(targets),
+            samples['left_gaze'], samples['left_validity'] != 4,
+            samples['right_gaze'], samples['right_validity'] != 4,
+            self.transform, samples['left_eye'][:, 2] / 10.0,
+            samples['right_eye'][:, 2] / 10.0)
+        return self.validationQuality
+
     # The following are given as callback functions to the tobii SDK
     def on_calib_deleted(self, error, r):
         if error:
-            print ("Could not delete calibration because of error "
-                   "(0x%0x)" % error)
-            raise ValueError("Could not delete calibration!")
+            print(("Could not delete calibration because of error "
+                   "(0x%0x)" % error))
+            return False
         self.deletecalibration_completed = True
 
     def on_calib_start(self, error, r):
         if error:
-            print ("Could not start calibration because of error "
-                   "(0x%0x)" % error)
+            print(("Could not start calibration because of error "
+                   "(0x%0x)" % error))
             return False
         self.initcalibration_completed = True
 
     def on_add_completed(self, error, r):
         if error:
-            print ("Add Calibration Point failed because of error "
-                   "(0x%0x)" % error)
+            print(("Add Calibration Point failed because of error "
+                   "(0x%0x)" % error))
             return False
 
         self.add_point_completed = True
@@ -409,17 +765,17 @@ class TobiiController:
 
     def on_calib_compute(self, error, r):
         if error == 0x20000502:
-            print ("CalibCompute failed because not enough data was "
-                   "collected:"), error
-            print "Not enough data was collected during calibration procedure."
+            print(("CalibCompute failed because not enough data was "
+                   "collected:"), error)
+            print("Not enough data was collected during calibration procedure.")
             self.computeCalibration_succeeded = False
         elif error != 0:
-            print "CalibCompute failed because of a server error:", error
-            print ("Could not compute calibration because of a server "
-                   "error.\n\n<b>Details:</b>\n<i>%s</i>") % (error)
+            print("CalibCompute failed because of a server error:", error)
+            print(("Could not compute calibration because of a server "
+                   "error.\n\n<b>Details:</b>\n<i>%s</i>") % (error))
             self.computeCalibration_succeeded = False
         else:
-            print ""
+            print("")
             self.computeCalibration_succeeded = True
 
         self.computeCalibration_completed = True
@@ -427,12 +783,12 @@ class TobiiController:
 
     def on_calib_response(self, error, calib):
         if error:
-            print "On_calib_response: Error =", error
+            print("On_calib_response: Error =", error)
             self.calib = None
             self.getcalibration_completed = True
             return False
 
-        print "On_calib_response: Success"
+        print("On_calib_response: Success")
         self.calib = calib
         self.getcalibration_completed = True
         return False
@@ -440,7 +796,7 @@ class TobiiController:
     def on_calib_done(self, status, msg):
         # When the calibration procedure is done we update the calibration plot
         if not status:
-            print msg
+            print(msg)
 
         self.calibration = None
         return False
@@ -450,200 +806,596 @@ class TobiiController:
     ############################################################################
 
     def startTracking(self):
-        # creates a gaze data list and starts tobii tracking, appending
-        # each data point to the list
-        self.gazeData = []
+        # empties the gaze data buffer and starts tobii tracking, adding
+        # each data point to the buffer
+        if self.session:
+            raise ValueError("A session is running; mark trials with "
+                             "beginTrial and endTrial instead.")
+        self.tracking = True
+        self.gazeData.clear()
+        if self.heatmap is not None:
+            # only the samples of this block go into the heatmap
+            self.heatmapCursor = self.getCursor()
         self.eventData = []
+        if self.gazeFilter is not None:
+            self.gazeFilter.reset()
+        if self.instrumentation is not None:
+            self.instrumentation.newBlock()
+        self.aois.newBlock()
+        if self.datafile is not None and self.datafile.streaming:
+            self.datafile.beginBlock()
         self.eyetracker.events.OnGazeDataReceived += self.on_gazedata
-        self.eyetracker.StartTracking()
+        if self.streams:
+            # multi-tracker mode: every tracker also feeds its own stream
+            for stream in self.streams:
+                stream.start()
+        else:
+            self.eyetracker.StartTracking()
 
     def stopTracking(self):
         # stops tobii tracking, writes data to file, and empties the
-        # gaze data list
-        self.eyetracker.StopTracking()
+        # gaze data buffer
+        if self.session:
+            raise ValueError("A session is running; use stopSession.")
+        if self.streams:
+            for stream in self.streams:
+                stream.stop()
+        else:
+            self.eyetracker.StopTracking()
         self.eyetracker.events.OnGazeDataReceived -= self.on_gazedata
+        self.updateHeatmap()
+        self.tracking = False
         self.flushData()
-        self.gazeData = []
+        self.gazeData.clear()
+        for stream in self.streams:
+            stream.buffer.clear()
         self.eventData = []
 
     def on_gazedata(self, error, gaze):
         # this gets called by tobii when its event OnGazeDataReceived fires
-        self.gazeData.append(gaze)
+        instrumentation = self.instrumentation
+        if instrumentation is not None:
+            arrival = self.clock.get_time()
+            started = timeit.default_timer()
+        record = unpack_gaze(gaze)
+        if self.streams:
+            # multi-tracker mode: gazeData is on the local clock, like the
+            # events and the merged data of all trackers
+            record = ((self.syncmanager.convert_from_remote_to_local(
+                record[0]),) + record[1:])
+        self.gazeData.append(record)
+        datafile = self.datafile
+        if datafile is not None and datafile.streaming:
+            datafile.addSample(record)
+        publisher = self.publisher
+        if publisher is not None:
+            publisher.addSample(record)
+        gazeFilter = self.gazeFilter
+        if gazeFilter is not None:
+            gazeFilter.addSample(record)
+        detector = self.eventDetector
+        if detector is not None:
+            detector.addSample(record)
+        gazeConditions = self.conditions
+        if gazeConditions or len(self.aois):
+            point = average_point(record)
+            if point is not None:
+                point = self.acsd2pix(point)
+            if len(self.aois):
+                self.aois.addSample(record[0], *(point or (None, None)))
+            for condition in gazeConditions:
+                condition.update(record, point)
+        if instrumentation is not None:
+            instrumentation.addSample(self.toLocalTime(record[0]), arrival)
+            instrumentation.addCallbackTime(
+                (timeit.default_timer() - started) * 1e6)
+
+    def on_helpergaze(self, error, gaze):
+        # the callback of the helpers' own tracking (see
+        # _startGazeTracking): only fills gazeData and updates the
+        # conditions
+        record = unpack_gaze(gaze)
+        if self.streams:
+            record = ((self.syncmanager.convert_from_remote_to_local(
+                record[0]),) + record[1:])
+        self.gazeData.append(record)
+        gazeConditions = self.conditions
+        if gazeConditions:
+            point = average_point(record)
+            if point is not None:
+                point = self.acsd2pix(point)
+            for condition in gazeConditions:
+                condition.update(record, point)
+
+    def toLocalTime(self, timestamp):
+        # converts a gazeData timestamp to the local clock (microseconds);
+        # in multi-tracker mode they are local already
+        if self.syncmanager is None or self.streams:
+            return timestamp
+        return self.syncmanager.convert_from_remote_to_local(timestamp)
+
+    def getGazeClockTime(self, offset=0):
+        # the current time (plus offset microseconds) on the clock of the
+        # gazeData timestamps: the tracker's clock, or the local clock in
+        # multi-tracker mode
+        t = self.clock.get_time() + offset
+        if self.streams:
+            return t
+        return self.syncmanager.convert_from_local_to_remote(t)
+
+    def setInstrumentation(self, enabled=True, samplingRate=None):
+        # switches on latency and sample-loss statistics (see
+        # instrumentation.py). samplingRate is the nominal rate used to find
+        # gaps; it is estimated from the data if not given
+        if enabled:
+            self.instrumentation = Instrumentation(samplingRate=samplingRate)
+        else:
+            self.instrumentation = None
+
+    def getInstrumentation(self):
+        # returns the current statistics as a dict (None if switched off)
+        if self.instrumentation is None:
+            return None
+        return self.instrumentation.summary()
+
+    def recordFlip(self):
+        # call right after win.flip() to record how old the newest sample
+        # was when the frame was shown
+        lastGaze = self.gazeData.latest()
+        if self.instrumentation is not None and lastGaze is not None:
+            self.instrumentation.addFrame(
+                self.clock.get_time() - self.toLocalTime(lastGaze['timestamp']))
+
+    def setGazeFilter(self, *gazeFilters):
+        # filters every sample with a chain of filters from filters.py,
+        # e.g. setGazeFilter(filters.Median(3), filters.OneEuro()).
+        # call without filters to switch filtering off
+        if not gazeFilters:
+            self.gazeFilter = None
+        else:
+            self.gazeFilter = filters.GazeFilter(gazeFilters,
+                                                 capacity=self.bufferCapacity)
+
+    def getCurrentFilteredGazePosition(self):
+        # like getCurrentGazePosition, but from the filtered samples
+        if self.gazeFilter is None:
+            return self.getCurrentGazePosition()
+        lastGaze = self.gazeFilter.data.latest()
+        if lastGaze is None:
+            return (None, None, None, None)
+        return self.getGazePosition(lastGaze)
+
+    def getPredictedGazePosition(self, lookahead=None):
+        # extrapolates the filtered gaze to lookahead seconds from now
+        # (default: one frame, i.e. the next win.flip()), which makes up
+        # for the delay between a sample and the frame that shows it.
+        # format is ((left.x, left.y), (right.x, right.y))
+        if self.gazeFilter is None:
+            return self.getCurrentGazePosition()
+        if lookahead is None:
+            lookahead = getattr(self.win, 'monitorFramePeriod', None) or 0.0
+        t = self.getGazeClockTime(int(lookahead * 1e6))
+        predicted = self.gazeFilter.predict(t)
+        if predicted is None:
+            return (None, None, None, None)
+        return (self.acsd2pix(predicted[0]), self.acsd2pix(predicted[1]))
+
+    def setEventDetection(self, method='ivt', **kwargs):
+        # switches on online fixation / saccade detection ('ivt' or 'idt',
+        # None switches it off). kwargs are passed to the detector, e.g.
+        # velocityThreshold (deg/s), dispersionThreshold (deg),
+        # minFixationDuration (ms)
+        if method is None:
+            self.eventDetector = None
+            return
+        detectors = {'ivt': IVTDetector, 'idt': IDTDetector}
+        self.eventDetector = detectors[method](
+            tuple(self.win.size), deg2pix(1.0, self.win.monitor), **kwargs)
+
+    def getGazeEvents(self):
+        # returns the fixation / saccade events detected since the last call
+        # (see eventdetection.GazeEvent); never blocks
+        if self.eventDetector is None:
+            return []
+        return self.eventDetector.getEvents()
+
+    def getCursor(self, fromStart=False, tracker=None):
+        # a gazebuffer.SampleCursor over the gaze buffer, or in
+        # multi-tracker mode over the buffer of streams[tracker]. each
+        # read returns the samples that arrived since the last one, as
+        # views of the buffer
+        if tracker is not None:
+            return SampleCursor(self.streams[tracker].buffer, fromStart)
+        return SampleCursor(self.gazeData, fromStart)
+
+    def getNewSamples(self):
+        # the samples that arrived since the last call (e.g. all samples
+        # between two flips rather than only the newest), without copying
+        if self.sampleCursor is None:
+            self.sampleCursor = self.getCursor(fromStart=True)
+        return self.sampleCursor.read()
 
     def getGazePosition(self, gaze):
         # returns gaze position in pixl relative to center
-        return (self.acsd2pix((gaze.LeftGazePoint2D.x,
-                               gaze.LeftGazePoint2D.y)),
-                self.acsd2pix((gaze.RightGazePoint2D.x,
-                               gaze.RightGazePoint2D.y)))
+        # gaze is a record from the gaze data buffer
+        return (self.acsd2pix(gaze['left_gaze']),
+                self.acsd2pix(gaze['right_gaze']))
 
     def getCurrentGazePosition(self):
         # returns the most recent gaze data point
         # format is ((left.x, left.y), (right.x, right.y))
-        if len(self.gazeData) == 0:
+        lastGaze = self.gazeData.latest()
+        if lastGaze is None:
             return (None, None, None, None)
         else:
-            return self.getGazePosition(self.gazeData[-1])
+            return self.getGazePosition(lastGaze)
 
     def getCurrentGazeAverage(self):
         # returns the most recent average gaze position
         # x and y
-        if len(self.gazeData) == 0:
+        lastGaze = self.gazeData.latest()
+        if lastGaze is None:
             return (None, None, None, None)
-        else:
-            lastGaze = self.gazeData[-1]
-            if lastGaze.LeftValidity != 4 and lastGaze.RightValidity != 4:
-                # return average data
-                return self.acsd2pix((np.mean((lastGaze.LeftGazePoint2D.x,
-                                               lastGaze.RightGazePoint2D.x)),
-                                      np.mean((lastGaze.LeftGazePoint2D.y,
-                                               lastGaze.RightGazePoint2D.y))))
-            elif lastGaze.LeftValidity != 4 and lastGaze.RightValidity == 4:
-                # only return left data
-                return self.acsd2pix(lastGaze.LeftGazePoint2D.x,
-                                     lastGaze.LeftGazePoint2D.y)
-            elif lastGaze.LeftValidity == 4 and lastGaze.RightValidity != 4:
-                # only return right data
-                return self.acsd2pix(lastGaze.RightGazePoint2D.x,
-                                     lastGaze.RightGazePoint2D.y)
+        leftValid = lastGaze['left_validity'] != 4
+        rightValid = lastGaze['right_validity'] != 4
+        if leftValid and rightValid:
+            # return average data
+            return self.acsd2pix((lastGaze['left_gaze'] +
+                                  lastGaze['right_gaze']) / 2.0)
+        elif leftValid:
+            # only return left data
+            return self.acsd2pix(lastGaze['left_gaze'])
+        elif rightValid:
+            # only return right data
+            return self.acsd2pix(lastGaze['right_gaze'])
+
+    def addAOI(self, name, pos=None, size=None, radius=None, vertices=None):
+        # registers an area of interest (in pixels relative to the centre):
+        # a rectangle (pos, size), a circle (pos, radius) or a polygon
+        # (vertices)
+        if vertices is not None:
+            return self.aois.addPolygon(name, vertices)
+        elif radius is not None:
+            return self.aois.addCircle(name, pos, radius)
+        return self.aois.addRect(name, pos, size)
+
+    def getCurrentAOI(self):
+        # returns the name of the AOI the most recent sample fell in, or None
+        return self.aois.currentAOI
+
+    def getDwellTimes(self):
+        # returns the time (ms) gaze spent in each AOI since the AOIs were
+        # added or resetDwell was called
+        return dict(self.aois.dwellTimes)
+
+    def labelSamples(self, samples=None):
+        # labels every sample (default: all buffered samples) with the index
+        # of its AOI in self.aois.names, or -1 if it is in none
+        if samples is None:
+            samples = self.gazeData.data()
+        pix = self.transform.toPix(average_gaze(samples))
+        return self.aois.label(pix[:, 0], pix[:, 1])
+
+    def getGazeData(self, units='pix', eye='average', samples=None):
+        # returns the gaze positions of many samples (default: all buffered
+        # samples) as an (n, 2) array in 'acsd', 'pix', 'norm', 'cm' or
+        # 'deg'. eye is 'left', 'right' or 'average' (over the valid eyes;
+        # NaN where none is valid). deg is the visual angle from the screen
+        # centre at each sample's eye distance
+        if samples is None:
+            samples = self.gazeData.data()
+        return self.transform.convertSamples(samples, units, eye)
 
     def getCurrentValidity(self):
-        if len(self.gazeData) == 0:
+        lastGaze = self.gazeData.latest()
+        if lastGaze is None:
             return (None, None, None, None)
         else:
-            return (self.gazeData[-1].LeftValidity,
-                    self.gazeData[-1].RightValidity)
+            return (lastGaze['left_validity'], lastGaze['right_validity'])
+
+    def addCondition(self, condition):
+        # checks a conditions.GazeCondition on every sample from now on
+        self.conditions = self.conditions + [condition]
+
+    def removeCondition(self, condition):
+        self.conditions = [c for c in self.conditions if c is not condition]
+
+    def _startGazeTracking(self):
+        # for the helpers that need live gaze (findEyes, waitForFixation,
+        # validation, adaptive calibration): reuses tracking that is
+        # already running, e.g. in a session. otherwise tracks the selected
+        # eye tracker into gazeData for the helper only, leaving the data
+        # file, events, AOIs, heatmap, event detector, publisher and
+        # instrumentation alone. returns whether tracking was started here
+        if self.tracking or self.helperTracking:
+            return False
+        self.helperTracking = True
+        self.gazeData.clear()
+        self.eyetracker.events.OnGazeDataReceived += self.on_helpergaze
+        self.eyetracker.StartTracking()
+        return True
+
+    def _stopGazeTracking(self, started):
+        # undoes _startGazeTracking
+        if started:
+            self.eyetracker.StopTracking()
+            self.eyetracker.events.OnGazeDataReceived -= self.on_helpergaze
+            self.gazeData.clear()
+            self.helperTracking = False
+
+    def waitForCondition(self, condition, timeout=None):
+        # blocks until condition is met (waking up within one sample) and
+        # returns the sample that met it, or None after timeout seconds.
+        # tracking has to be running.
+        condition.reset()
+        self.addCondition(condition)
+        try:
+            clock = psychopy.core.Clock()
+            while True:
+                wait = 0.05  # check for escape every 50ms
+                if timeout is not None:
+                    wait = min(wait, timeout - clock.getTime())
+                    if wait <= 0:
+                        return None
+                if condition.wait(wait):
+                    return condition.sample
+                if psychopy.event.getKeys(keyList=['escape']):
+                    raise KeyboardInterrupt("You interrupted the script.")
+        finally:
+            self.removeCondition(condition)
 
     def waitForFixation(self, fixationPoint=(0, 0),
-                        bothEyes=True, errorMargin=0.1):
+                        bothEyes=True, errorMargin=None, duration=0,
+                        timeout=None):
         # this function waits until the eye tracker detects one (or both)
-        # eyes to be at a certain point, +- some margin of error
-        # fixation point should be given in pixels
-        # first, make sure data is not saved:
-        self.datafile_temp, self.datafile = self.datafile, None
-        self.startTracking()  # kick off tracking
-        psychopy.core.wait(0.5)  # allow the tracker to gather some data
-        while (abs(self.getCurrentGazeAverage()[0] -
-                   fixationPoint[0]) < errorMargin and
-               abs(self.getCurrentGazeAverage()[1] -
-                   fixationPoint[1]) < errorMargin and
-               (not bothEyes or (self.getCurrentValidity()[0] != 4 and
-                                 self.getCurrentValidity()[1] != 4))):
-            psychopy.core.wait(0.05)  # wait 50ms before checking again
-        self.stopTracking()  # stop tracking
-        # then restore data file so tracking can continue
-        self.datafile, self.datafile_temp = self.datafile_temp, None
+        # eyes to be at a certain point, +- some margin of error, for
+        # duration ms. fixation point and margin should be given in pixels
+        # (the margin defaults to 1 degree). returns the sample that
+        # completed the fixation, or None after timeout seconds
+        if errorMargin is None:
+            errorMargin = deg2pix(1.0, self.win.monitor)
+        # kick off tracking (unless it runs already), without saving data
+        started = self._startGazeTracking()
+        try:
+            return self.waitForCondition(
+                conditions.Fixation(fixationPoint, errorMargin,
+                                    duration=duration, bothEyes=bothEyes),
+                timeout=timeout)
+        finally:
+            # stop tracking and restore the data file
+            self._stopGazeTracking(started)
 
     def getCurrentEyePosition(self):
         # returns the most recent eye position
-        if len(self.gazeData) == 0:
+        lastGaze = self.gazeData.latest()
+        if lastGaze is None:
             return((None, None, None), (None, None, None))
         else:
-            self.gaze = self.gazeData[-1]
-            return ((self.gaze.LeftEyePosition3D.x,
-                     self.gaze.LeftEyePosition3D.y,
-                     self.gaze.LeftEyePosition3D.z),
-                    (self.gaze.RightEyePosition3D.x,
-                     self.gaze.RightEyePosition3D.y,
-                     self.gaze.RightEyePosition3D.z))
+            return (tuple(lastGaze['left_eye']),
+                    tuple(lastGaze['right_eye']))
 
     def getCurrentPupilSize(self):
-        if len(self.gazeData) == 0:
-            return(none, none)
+        lastGaze = self.gazeData.latest()
+        if lastGaze is None:
+            return(None, None)
         else:
-            return(self.gazeData[-1].LeftPupil,
-                   self.gazeData[-1].RightPupil)
-
-    def setDataFile(self, filename):
+            return(lastGaze['left_pupil'], lastGaze['right_pupil'])
+
+    def startPublishing(self, name='tobii-gaze', capacity=65536):
+        # mirrors every sample into shared memory and every recorded event
+        # onto a Unix socket, for sharedstream.GazeSubscriber(name) in
+        # other processes
+        self.stopPublishing()
+        self.publisher = GazePublisher(name, capacity)
+
+    def stopPublishing(self):
+        publisher = self.publisher
+        if publisher is not None:
+            self.publisher = None
+            publisher.close()
+
+    def setDataFile(self, filename, streaming=False, maxQueue=10000,
+                    backpressure='block', dataFormat='csv'):
+        # dataFormat is 'csv' or 'binary' (see recording.py; read binary
+        # files with recording.Recording and export them with export_csv),
+        # or 'segments' for a crash-safe recording into the directory
+        # filename (see segments.py), which is always streamed.
+        # with streaming=True samples are written on a background thread
+        # while tracking runs, so stopTracking returns right away.
+        # backpressure ('block', 'drop' or 'drop_oldest') decides what
+        # happens when more than maxQueue samples are waiting to be written
         if filename is None:
             self.datafile = None
+        elif self.streams:
+            # multi-tracker mode: one binary recording of all trackers
+            if dataFormat != 'binary' or streaming:
+                raise ValueError("Data of several trackers can only be "
+                                 "saved as binary, without streaming.")
+            print('set datafile ' + filename)
+            self.datafile = BinaryWriter(filename, self.win.size,
+                                         dtype=MULTI_SAMPLE_DTYPE)
+            self.datafile.setMetadata('trackers', [
+                self.getTrackerInfo(stream.info) for stream in self.streams])
         else:
-            print 'set datafile ' + filename
-            self.datafile = open(filename, 'w+')
-            self.datafile.write('Recording date:\t' +
-                                datetime.datetime.now().strftime('%Y/%m/%d') +
-                                '\n')
-            self.datafile.write('Recording time:\t' +
-                                datetime.datetime.now().strftime('%H:%M:%S') +
-                                '\n')
-            self.datafile.write('Recording resolution\t%d x %d\n\n' %
-                                tuple(self.win.size))
+            print('set datafile ' + filename)
+            if dataFormat == 'csv':
+                self.datafile = CsvWriter(filename, self.win.size)
+            elif dataFormat == 'binary':
+                self.datafile = BinaryWriter(filename, self.win.size,
+                                             trackerInfo=self.getTrackerInfo())
+            elif dataFormat == 'segments':
+                self.datafile = SegmentWriter(filename, self.win.size,
+                                              trackerInfo=self.getTrackerInfo())
+                streaming = True
+            else:
+                raise ValueError("Unknown data format: %s" % dataFormat)
+            if streaming:
+                self.datafile = StreamingWriter(self.datafile,
+                                                maxQueue=maxQueue,
+                                                backpressure=backpressure)
 
     def closeDataFile(self):
-        print 'datafile closed'
+        print('datafile closed')
         if self.datafile is not None:
             self.flushData()
+            if self.instrumentation is not None:
+                self.datafile.setMetadata('instrumentation',
+                                          self.getInstrumentation())
             self.datafile.close()
 
         self.datafile = None
 
     def recordEvent(self, event):
-        t = self.syncmanager.convert_from_local_to_remote(self.clock.get_time())
+        # events are timed on the clock of the samples (getGazeClockTime)
+        t = self.getGazeClockTime()
         self.eventData.append((t, event))
+        datafile = self.datafile
+        if datafile is not None and datafile.streaming:
+            datafile.addEvent(t, event)
+        if self.publisher is not None:
+            self.publisher.addEvent(t, event)
+
+    def getEpoch(self, startEvent, endEvent=None):
+        # returns the buffered samples between the first startEvent recorded
+        # with recordEvent and the first endEvent after it (or the newest
+        # sample if endEvent is None)
+        return self.gazeData.between(*epoch_times(self.eventData,
+                                                  startEvent, endEvent))
+
+    def startSession(self):
+        # starts tracking for a whole block. Trials are then only marked
+        # with beginTrial and endTrial, so the tracker keeps streaming,
+        # no samples are lost between trials and the data file gets one
+        # block. stopSession stops tracking and writes the data
+        if self.tracking:
+            raise ValueError("Tracking is already running.")
+        self.trials = []
+        self.startTracking()
+        self.session = True
+
+    def stopSession(self):
+        if self.trials and self.trials[-1]['end'] is None:
+            self.endTrial()
+        self.session = False
+        self.stopTracking()
+
+    def beginTrial(self, name=None):
+        # marks the start of a trial (recording a 'TRIAL_START name'
+        # event) and returns its index in self.trials
+        if not self.session:
+            raise ValueError("beginTrial needs a running session "
+                             "(see startSession).")
+        if self.trials and self.trials[-1]['end'] is None:
+            self.endTrial()
+        if name is None:
+            name = str(len(self.trials))
+        self.recordEvent('TRIAL_START %s' % name)
+        self.trials.append({'name': name, 'start': self.eventData[-1][0],
+                            'end': None, 'heatmap': None})
+        if self.heatmap is not None:
+            self.trials[-1]['heatmap'] = Heatmap(self.win.size,
+                                                 self.heatmap.binSize)
+        return len(self.trials) - 1
+
+    def endTrial(self):
+        # marks the end of the current trial ('TRIAL_END name')
+        if not self.trials or self.trials[-1]['end'] is not None:
+            raise ValueError("No trial has begun.")
+        trial = self.trials[-1]
+        self.recordEvent('TRIAL_END %s' % trial['name'])
+        trial['end'] = self.eventData[-1][0]
+
+    def getTrialData(self, trial=-1):
+        # the samples of a trial (by default the current or last one), up
+        # to the newest sample if it hasn't ended. this is a view of the
+        # session buffer (found by binary search), not a copy, unless the
+        # ring buffer has wrapped within the trial. in multi-tracker mode
+        # it is a new array of the trial's samples of all trackers
+        trial = self.trials[trial]
+        if self.streams:
+            return merge_streams(self.streams, trial['start'], trial['end'])
+        return self.gazeData.between(trial['start'], trial['end'])
+
+    def setHeatmap(self, binSize=20):
+        # starts a gaze heatmap (heatmap.Heatmap) of the session, with bins
+        # of binSize pixels, and one of every trial begun after this (see
+        # beginTrial). binSize=None stops it
+        if binSize is None:
+            self.heatmap = self.heatmapCursor = None
+            return
+        self.heatmap = Heatmap(self.win.size, binSize)
+        self.heatmapCursor = self.getCursor()
+
+    def updateHeatmap(self):
+        # adds the samples that arrived since the last update to the
+        # session heatmap and to the heatmaps of the trials they fall in.
+        # call it e.g. once per frame for a live view; getHeatmap and
+        # stopTracking call it too. only samples of the user's own tracking
+        # or session count, not those of the helpers
+        if self.heatmap is None:
+            return None
+        if not self.tracking:
+            return self.heatmap
+        samples = self.heatmapCursor.read()
+        self.heatmap.addSamples(samples)
+        if not len(samples):
+            return self.heatmap
+        timestamps = samples['timestamp']
+        # trials are in time order and don't overlap: go back from the
+        # newest until a trial ended before the oldest new sample
+        for trial in reversed(self.trials):
+            if trial['end'] is not None and trial['end'] <= timestamps[0]:
+                break
+            if trial['heatmap'] is None or trial['start'] > timestamps[-1]:
+                continue
+            start = np.searchsorted(timestamps, trial['start'])
+            stop = (len(samples) if trial['end'] is None else
+                    np.searchsorted(timestamps, trial['end']))
+            trial['heatmap'].addSamples(samples[start:stop])
+        return self.heatmap
+
+    def getHeatmap(self, trial=None):
+        # the up to date heatmap of the session, or of trial (an index
+        # into self.trials)
+        self.updateHeatmap()
+        if trial is None:
+            return self.heatmap
+        return self.trials[trial]['heatmap']
+
+    def getTrialEvents(self, trial=-1):
+        # the events recorded during a trial, including its markers
+        trial = self.trials[trial]
+        return [(t, event) for t, event in self.eventData
+                if t >= trial['start'] and
+                (trial['end'] is None or t <= trial['end'])]
 
     def flushData(self):
         if self.datafile is None:
-            print "Data file is not set, data not saved."
+            print("Data file is not set, data not saved.")
             return
-        elif len(self.gazeData) == 0:
-            print "No gazedata collected, no data saved."
+        elif self.datafile.streaming:
+            # the writer thread has the data already; just end the block
+            self.datafile.endBlock()
+            return
+        if self.streams:
+            samples = self.getMergedData()
+        else:
+            samples = self.gazeData.data()
+        if len(samples) == 0:
+            print("No gazedata collected, no data saved.")
             return
 
-        print "Saving data."
-        self.datafile.write(', '.join(['TimeStamp',
-                                       'GazePointXLeft',
-                                       'GazePointYLeft',
-                                       'PupilLeft',
-                                       'EyePositionXLeft',
-                                       'EyePositionYLeft',
-                                       'EyePositionZLeft',
-                                       'ValidityLeft',
-                                       'GazePointXRight',
-                                       'GazePointYRight',
-                                       'PupilRight',
-                                       'EyePositionXRight',
-                                       'EyePositionYRight',
-                                       'EyePositionZRight',
-                                       'ValidityRight',
-                                       'Event']) + '\n')
-        timeStampStart = self.gazeData[0].Timestamp  # first timepoint is 0s
-        # Write eye info
-        for g in self.gazeData:
-            self.datafile.write(', '.join([
-                '%.4f' % ((g.Timestamp - timeStampStart) / 1000.0),
-                # Print the left eye data:
-                '%.4f' % g.LeftGazePoint2D.x,
-                '%.4f' % g.LeftGazePoint2D.y,
-                '%.4f' % g.LeftPupil,
-                '%.4f' % g.LeftEyePosition3D.x,
-                '%.4f' % g.LeftEyePosition3D.y,
-                '%.4f' % g.LeftEyePosition3D.z,
-                '%d' % g.LeftValidity,
-                # Print the right eye data:
-                '%.4f' % g.RightGazePoint2D.x,
-                '%.4f' % g.RightGazePoint2D.y,
-                '%.4f' % g.RightPupil,
-                '%.4f' % g.RightEyePosition3D.x,
-                '%.4f' % g.RightEyePosition3D.y,
-                '%.4f' % g.RightEyePosition3D.z,
-                '%d' % g.RightValidity
-            ]) + '\n')
-        # Write the additional event data added
-        for e in self.eventData:
-            self.datafile.write(('%.4f' + ', ' * 14 + '%s\n') %
-                                ((e[0] - timeStampStart) / 1000.0, e[1]))
-        # flush the python data buffer (data written to file)
-        self.datafile.flush()
+        print("Saving data.")
+        self.datafile.writeBlock(samples, self.eventData)
 
     def setIllumination(self, mode):
-        self.illuminationChanged = False
-        self.eyetracker.SetIlluminationMode(mode,
-                                            callback=self.on_illumchange)
+        # returns a future; pass it to waitForFuture to wait for the change
+        return self.setIlluminationAsync(mode)
 
     def on_illumchange(self, error, resp):
         if error:
             raise ValueError("Illumination Change didn't work.")
-            print "on_illumchange: Error =", error
+            print("on_illumchange: Error =", error)
         self.illuminationChanged = True
         return False
 
@@ -655,8 +1407,11 @@ class TobiiController:
         # Convert the tobii coordinates (acsd) to pixels
         # in tobii, (0, 0) is top left
         # in psychopy, (0, 0) is the middle
-        return ((xy[0] - 0.5) * self.win.size[0],
-                (0.5 - xy[1]) * self.win.size[1])
+        # xy may also be an (n, 2) array of points
+        if getattr(xy, 'ndim', 1) > 1:
+            return self.transform.toPix(xy)
+        width, height = self.transform.sizePix
+        return ((xy[0] - 0.5) * width, (0.5 - xy[1]) * height)
 
 ############################################################################
 # run following codes if this file is executed directly
@@ -664,17 +1419,23 @@ class TobiiController:
 
 if __name__ == "__main__":
     import sys
+    import_psychopy()
     screen = psychopy.monitors.Monitor(name='tobiix300', width=51, distance=60)
     screen.setSizePix([1920, 1080])
     screen.setWidth(51)
     screen.setDistance(60)
     win = psychopy.visual.Window(fullscr=True, units='pix',
                                  monitor=screen, color=-1.0)
-    controller = TobiiController(win)
+    # run with --simulate to try this out without an eye tracker
+    backend = None
+    if '--simulate' in sys.argv:
+        from simulator import SimulatedBackend
+        backend = SimulatedBackend()
+    controller = TobiiController(win, backend=backend)
 
     # check eye trackers and open the first one
     controller.waitForFindEyeTracker()
-    controller.activate(controller.eyetrackers.keys()[0])
+    controller.activate(list(controller.eyetrackers.keys())[0])
 
     # help the person find the eyes
     controller.findEyes()
@@ -696,11 +1457,13 @@ if __name__ == "__main__":
                                   fillColor=(1.0, 0.7, 0.7),
                                   units='pix',
                                   autoDraw=True)
+    # Smooth the gaze so the marker doesn't jitter
+    controller.setGazeFilter(filters.OneEuro())
     # Start tracking and update the position of the marker
     controller.startTracking()
     response = []
     while 'space' not in response:
-        currentGazePosition = controller.getCurrentGazePosition()
+        currentGazePosition = controller.getPredictedGazePosition()
         if None not in currentGazePosition:
             # set marker to arithmetic mean of the two gaze poisitions
             marker.pos = (np.mean((currentGazePosition[0][0],
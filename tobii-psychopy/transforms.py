@@ -0,0 +1,121 @@
+#
+# Coordinate transforms for the Tobii controller
+# - converts whole arrays of ACSD gaze points (active display coordinates,
+#   (0, 0) top left, (1, 1) bottom right) to pix, norm, cm and deg
+# - pix, norm and cm are relative to the screen centre with y pointing up,
+#   like psychopy's units
+# - the scale factors are computed once from the window size and the
+#   monitor's width and distance
+#
+
+import numpy as np
+
+from gazebuffer import average_gaze, eye_distance
+
+
+class ScreenTransform(object):
+
+    def __init__(self, sizePix, widthCm=None, distanceCm=None):
+        self.sizePix = (float(sizePix[0]), float(sizePix[1]))
+        self.widthCm = widthCm
+        self.distanceCm = distanceCm
+        if widthCm is not None:
+            # square pixels: the height follows from the aspect ratio
+            self.sizeCm = (float(widthCm),
+                           widthCm * self.sizePix[1] / self.sizePix[0])
+        else:
+            self.sizeCm = None
+
+    @classmethod
+    def fromWindow(cls, win):
+        # reads the size of a psychopy window and, if it has a monitor, the
+        # monitor's width and viewing distance (both in cm)
+        widthCm = distanceCm = None
+        monitor = getattr(win, 'monitor', None)
+        if monitor is not None:
+            widthCm = monitor.getWidth()
+            distanceCm = monitor.getDistance()
+        return cls(win.size, widthCm, distanceCm)
+
+    def _centred(self, xy, size):
+        xy = np.asarray(xy, dtype=float)
+        out = np.empty(xy.shape)
+        out[..., 0] = (xy[..., 0] - 0.5) * size[0]
+        out[..., 1] = (0.5 - xy[..., 1]) * size[1]
+        return out
+
+    def toPix(self, xy):
+        # xy is an (..., 2) array of ACSD points
+        return self._centred(xy, self.sizePix)
+
+    def toNorm(self, xy):
+        return self._centred(xy, (2.0, 2.0))
+
+    def toCm(self, xy):
+        if self.sizeCm is None:
+            raise ValueError("The monitor width is needed for cm units.")
+        return self._centred(xy, self.sizeCm)
+
+    def _distance(self, eyeDistance):
+        # eyeDistance is the viewing distance in cm, a float or one value
+        # per point (e.g. EyePosition3D z / 10); NaN or missing values fall
+        # back to the monitor distance
+        distance = self.distanceCm
+        if eyeDistance is not None:
+            eyeDistance = np.asarray(eyeDistance, dtype=float)
+            if distance is not None:
+                with np.errstate(invalid='ignore'):
+                    valid = eyeDistance > 0
+                eyeDistance = np.where(valid, eyeDistance, distance)
+            distance = eyeDistance
+        if distance is None:
+            raise ValueError("The viewing distance is needed for deg units.")
+        return distance
+
+    def toDeg(self, xy, eyeDistance=None):
+        # visual angle of each point from the screen centre, per axis. this
+        # is exact for any eccentricity (unlike a fixed deg-per-pixel
+        # factor). for eyeDistance see _distance
+        cm = self.toCm(xy)
+        distance = np.asarray(self._distance(eyeDistance))
+        return np.degrees(np.arctan2(cm, distance[..., None]))
+
+    def angularDistance(self, a, b, eyeDistance=None):
+        # angle (deg) between two arrays of ACSD points as seen from an eye
+        # in front of the screen centre
+        a, b = self.toCm(a), self.toCm(b)
+        d = self._distance(eyeDistance)
+        # the angle between (ax, ay, d) and (bx, by, d)
+        cross = np.sqrt((d * (a[..., 1] - b[..., 1])) ** 2 +
+                        (d * (b[..., 0] - a[..., 0])) ** 2 +
+                        (a[..., 0] * b[..., 1] - a[..., 1] * b[..., 0]) ** 2)
+        dot = a[..., 0] * b[..., 0] + a[..., 1] * b[..., 1] + d * d
+        return np.degrees(np.arctan2(cross, dot))
+
+    def convert(self, xy, units, eyeDistance=None):
+        if units == 'acsd':
+            return np.asarray(xy, dtype=float)
+        elif units == 'pix':
+            return self.toPix(xy)
+        elif units == 'norm':
+            return self.toNorm(xy)
+        elif units == 'cm':
+            return self.toCm(xy)
+        elif units == 'deg':
+            return self.toDeg(xy, eyeDistance)
+        raise ValueError("Unknown units: %s" % units)
+
+    def convertSamples(self, samples, units='pix', eye='average'):
+        # the gaze of an array of samples (gazebuffer.SAMPLE_DTYPE) as an
+        # (n, 2) array in units. eye is 'left', 'right' or 'average' (over
+        # the valid eyes; NaN where none is valid). deg uses each sample's
+        # eye distance
+        if eye == 'average':
+            gaze = average_gaze(samples)
+            distance = eye_distance(samples)
+        else:
+            gaze = samples[eye + '_gaze']
+            distance = samples[eye + '_eye'][:, 2]
+        if units != 'deg':
+            return self.convert(gaze, units)
+        return self.toDeg(gaze, distance / 10.0)